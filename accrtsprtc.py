@@ -2,18 +2,27 @@
 import platform
 import os
 import argparse
+import asyncio
 import subprocess
 import signal
 import time
 import json
-import cgi
-import queue
 
 from pathlib import Path
-from janus import print
+import certstore
+import ingest
+import logpipe
+import metrics
+from admission import CapacityModel
+from registry import AdoptedProcess, Registry, is_publisher
+from telemetry import Telemetry
+from timeline import PHASES, PhaseHistograms, shift
+
+from logpipe import timestamped_print as print
 from collections import namedtuple
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from socketserver import ThreadingMixIn
+from httpserver import HTTPServer, Response, StreamResponse
+from ipc import command_message, encode_frame, read_frame
+from supervisor import RestartPolicy, Supervisor
 
 
 ROOT = os.path.abspath(os.path.dirname(__file__))
@@ -26,13 +35,33 @@ HTTP_STATUS = {"OK": ResponseStatus(code=200, message="OK"),
                "INTERNAL_SERVER_ERROR": ResponseStatus(code=500, message="Internal server error")}
 
 ROUTE_INDEX = "/index.html"
+ROUTE_METRICS = "/metrics"
+ROUTE_TELEMETRY = "/telemetry"
+ROUTE_TIMELINE = "/publishers/timeline"
 ROUTE_STOP = "/camera/push/stop"
 ROUTE_START = "/camera/push/start"
+ROUTE_BATCH_STOP = "/camera/push/stop/batch"
+ROUTE_BATCH_START = "/camera/push/start/batch"
 ROUTE_PRIVATE_SUB = "/camera/subprocess"
-
-
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
+ROUTE_DRAIN = "/server/drain"
+ROUTE_HANDOFF = "/server/handoff"
+
+# Seconds a start request waits for the publisher to report `webrtc: up`
+START_TIMEOUT = 30
+# Default number of publishers a batch request launches at the same time
+BATCH_CONCURRENCY = 20
+# Seconds a terminated publisher gets to exit before it is killed
+REAP_TIMEOUT = 5
+# Default maximum number of publisher restarts per second across the host
+RESTART_RATE = 5
+# Seconds a metrics scrape waits for the publishers to report fresh counters
+STATS_TIMEOUT = 1
+# Stats older than this are refreshed before deciding whether a new publisher fits
+ADMISSION_STATS_AGE = 5
+# Seconds publishers wait for a restarting control server to adopt them
+ADOPT_GRACE = 30
+# Seconds the control server keeps running after accepting a handoff, for the response to go out
+HANDOFF_DELAY = 0.5
 
 
 class RTSPClient:
@@ -42,7 +71,6 @@ class RTSPClient:
         self.rtsp = rtsp
         self.display = display
         self.process = None
-        self.log_handler = None
         self.request_session = None
         self.mic = mic
 
@@ -52,8 +80,35 @@ class RTSPClient:
 
         self.stun = None
 
-        self.queue = queue.Queue(3)
+        # Resolved with (success, message) by the first `webrtc`/`close`/`exception` event
+        self.started = None
         self.janus = None
+        self.debug_log_level = 0
+        # Last counters reported by the publisher (see `WebRTCClient.get_stats`) and when they arrived
+        self.stats = {}
+        self.stats_time = 0
+        self.restarts = 0
+        # starting, up, restarting, stopped or the last PeerConnection state reported
+        self.state = "starting"
+        # time.time() of the last launch, and the phases of the setup that followed as seconds since then
+        self.launched = 0
+        self.timeline = {}
+        # set once WebRTC is up after the last launch, before that its CPU is the start's, not its cost
+        self.came_up = False
+        # launches so far, the events of an engine-hosted publisher carry the one they come from
+        self.generation = 0
+        # Writing end of the IPC channel to the publisher process
+        self.ipc = None
+
+    def relaunched(self):
+        """
+        The publisher is (re)started from now on, its setup timeline starts over.
+        """
+        self.launched = time.time()
+        self.timeline = {}
+        self.stats.pop("timeline", None)
+        self.came_up = False
+        self.generation += 1
 
 
 class HTTPStatusError(Exception):
@@ -70,81 +125,119 @@ class HTTPStatusError(Exception):
         self.explain = description
 
 
-# This class will handles any incoming request from
-# the browser
-class RequestHandler(BaseHTTPRequestHandler):
-    clients = {}
-    debug_log_level = 1
+# Handles every incoming request on the asyncio HTTP server
+class ControlServer:
+    def __init__(self, engine=None, batch_concurrency=BATCH_CONCURRENCY, restart_policy=None,
+                 restart_rate=RESTART_RATE, capacity=None, admission_wait=0, registry=None,
+                 adopt_grace=ADOPT_GRACE):
+        self.clients = {}
+        self.batch_concurrency = batch_concurrency
+        # `CapacityModel` deciding whether a new publisher fits on the host, every start is admitted when None
+        self.capacity = capacity
+        # Seconds a start waits for capacity before it is refused
+        self.admission_wait = admission_wait
+        # Starts admitted but not up yet, counted at the expected cost
+        self.pending_starts = 0
+        # `Registry` of the publishers that outlive this control server, None when they stop with it
+        self.registry = registry
+        self.adopt_grace = adopt_grace
+        # Refusing new publishers, see `drain`, and leaving the running ones to the next control server
+        self.draining = False
+        self.handed_off = False
+        # `HTTPServer` and unix socket server publishers connect to, set by `serve`
+        self.http = None
+        self.control_server = None
+        self.supervisor = Supervisor(self.restart_client, self.give_up, restart_policy, restart_rate)
+        # `PublisherEngine` or `WorkerPool` hosting the publishers, they run as `janus.py` subprocesses when None.
+        self.engine = engine
+        # `Zygote` forking the publisher processes instead of starting `janus.py` from scratch
+        self.zygote = None
+        self.loop = None
+        # Resolved once every publisher answered the last stats request
+        self._stats_waiter = None
+        self._stats_requested = 0
+        self.telemetry = Telemetry(self)
+        # Phases of the completed publisher setups
+        self.setup_histograms = PhaseHistograms()
 
     # 404 Not found.
     def route_not_found(self, path, query):
         """Handles routing for unexpected paths"""
         raise HTTPStatusError(HTTP_STATUS["NOT_FOUND"], "Page not found")
 
-    # Handler for the GET requests
-    def do_GET(self):
-        print("Current requesting path: %s", self.path)
-
-        path, _, query_string = self.path.partition('?')
-        query_components = dict(qc.split("=") for qc in query_string.split("&"))
-
-        print(u"[START]\n"
-              u"Received GET for %s with query: %s" % (path, query_components))
-
+    async def handle(self, request):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
         try:
-            if path == ROUTE_INDEX:
-                self.send_response(200)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
-                # Send the html message
-                self.wfile.write("RTSP Stream push to Janus!".encode())
-            else:
-                response = self.route_not_found(path, query_components)
+            if request.method == "GET":
+                return await self.do_GET(request)
+            elif request.method == "POST":
+                return await self.do_POST(request)
+            raise HTTPStatusError(HTTP_STATUS["BAD_REQUEST"], "Unsupported method")
         except HTTPStatusError as err:
-            self.send_error(err.code, err.message)
+            return Response.error(err.code, err.message)
 
-        print("[END]\n")
+    # Handler for the GET requests
+    async def do_GET(self, request):
+        print("Current requesting path: %s", request.target)
+        print(u"[START]\n"
+              u"Received GET for %s with query: %s" % (request.path, request.query))
+
+        if request.path == ROUTE_INDEX:
+            # Send the html message
+            response = Response(200, "RTSP Stream push to Janus!")
+        elif request.path == ROUTE_METRICS:
+            await self.collect_stats()
+            capacity = None
+            if self.capacity is not None:
+                capacity = (self.capacity.load(self.publisher_costs())[0], self.capacity.budget)
+            response = Response(200, metrics.render(list(self.clients.values()), self.supervisor.restart_count,
+                                                    capacity, self.setup_histograms),
+                                content_type=metrics.CONTENT_TYPE)
+        elif request.path == ROUTE_TELEMETRY:
+            queue = self.telemetry.subscribe()
+            response = StreamResponse(self.telemetry.events(queue), content_type="text/event-stream",
+                                      headers={"Cache-Control": "no-cache"})
+        elif request.path == ROUTE_TIMELINE:
+            await self.collect_stats()
+            response = Response.json(self.json_response(True, 1, self.timelines()))
+        else:
+            response = self.route_not_found(request.path, request.query)
 
-        return
+        print("[END]\n")
+        return response
 
     # Handler for the POST requests
-    def do_POST(self):
-        path, _, _ = self.path.partition('?')
+    async def do_POST(self, request):
+        path = request.path
 
         print(u"[START]\n"
               u"Received POST for %s" % path)
 
-        try:
-            fs = cgi.FieldStorage(
-                fp=self.rfile,
-                headers=self.headers,
-                environ={'REQUEST_METHOD': 'POST',
-                         'CONTENT_TYPE': self.headers['Content-Type'],
-                         })
-
-            form = {}
-            for field in fs.list or ():
-                form[field.name] = field.value
-
-            print("In coming form: ", form)
-
-            if path == ROUTE_START:
-                r = self.check_start(form)
-                self.send_json_response(r)
-            elif path == ROUTE_STOP:
-                r = self.check_stop(form)
-                self.send_json_response(r)
-            elif path == ROUTE_PRIVATE_SUB:
-                r = self.subprocess_msg(form)
-                self.send_json_response(r)
-
-        except Exception as err:
-            print("Response error", err)
-            self.send_error(500, "Internal error")
+        if path == ROUTE_BATCH_START:
+            return self.check_batch(request, self.check_start)
+        elif path == ROUTE_BATCH_STOP:
+            return self.check_batch(request, self.check_stop)
+
+        form = request.form()
+        print("In coming form: ", form)
+
+        if path == ROUTE_START:
+            r = await self.check_start(form)
+        elif path == ROUTE_STOP:
+            r = self.check_stop(form)
+        elif path == ROUTE_PRIVATE_SUB:
+            r = self.subprocess_msg(form)
+        elif path == ROUTE_DRAIN:
+            r = self.drain()
+        elif path == ROUTE_HANDOFF:
+            r = self.handoff()
+        else:
+            r = self.route_not_found(path, request.query)
 
+        print("Send response: ", r)
         print("[END]\n")
-
-        return
+        return Response.json(r)
 
     # Clean resources
     def shutdown(self):
@@ -153,19 +246,9 @@ class RequestHandler(BaseHTTPRequestHandler):
         for key in self.clients.keys():
             client = self.clients[key]
             self.kill_subprocess(client)
-            if client.log_handler is not None:
-                client.log_handler.close()
         self.clients.clear()
-
-    # Send a JSON Response.
-    def send_json_response(self, json_dict):
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        obj = json.dumps(json_dict, indent=4)
-        self.wfile.write(obj.encode(encoding='utf_8'))
-        print("Send response: ", obj)
-        return
+        if self.engine is not None:
+            self.engine.shutdown()
 
     @staticmethod
     def check_mic(mic):
@@ -200,48 +283,239 @@ class RequestHandler(BaseHTTPRequestHandler):
         return resp
 
     @staticmethod
-    def file_logger(identify):
+    def log_file_path(identify):
         time_str = str(int(time.time()))
         log_path = os.path.join(ROOT, 'log')
         Path(log_path).mkdir(parents=True, exist_ok=True)
         log_file_path = os.path.join(log_path, '{id}_{t}.txt'.format(id=identify, t=time_str))
         print("---------- Log enabled file at: ", log_file_path)
-        log = open(log_file_path, 'w', 1)
-        return log
-
-    def launch_janus(self, client):
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        janus_path = dir_path + "/janus.py"
-        if platform.system() == "Windows":
-            python = "python"
-        else:
-            python = "python3"
-        cmd = [python, janus_path, client.janus, '--rtsp', client.rtsp, '--name', client.display, '--room',
-               client.room, '--id', client.publisher, '--mic', client.mic]
+        return log_file_path
+
+    async def launch_janus(self, client):
+        client.relaunched()
+        if self.engine is not None:
+            self.engine.launch(client)
+            return None
+
+        argv = [client.janus, '--rtsp', client.rtsp, '--name', client.display, '--room',
+                client.room, '--id', client.publisher, '--mic', client.mic]
 
         if client.turn is not None and client.turn_user is not None and client.turn_passwd is not None:
-            cmd.extend(['--turn', client.turn, '--turn_user', client.turn_user, '--turn_passwd', client.turn_passwd])
+            argv.extend(['--turn', client.turn, '--turn_user', client.turn_user, '--turn_passwd', client.turn_passwd])
         if client.stun is not None:
-            cmd.extend(['--stun', client.stun])
-
-        if self.debug_log_level > 0:
-            cmd.extend(['-L', str(self.debug_log_level)])
-            log = self.file_logger(client.publisher)
-            p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=log, stderr=log, bufsize=1,
-                                 universal_newlines=True, encoding="utf-8")
-            client.log_handler = log
+            argv.extend(['--stun', client.stun])
+        if client.debug_log_level > 0:
+            # the publisher writes and rotates its log itself
+            argv.extend(['-L', str(client.debug_log_level), '--log_file', self.log_file_path(client.publisher)])
+
+        if self.zygote is not None:
+            p, reader, writer = await self.zygote.spawn(argv, name="Publisher-" + client.publisher)
         else:
-            p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            dir_path = os.path.dirname(os.path.realpath(__file__))
+            janus_path = dir_path + "/janus.py"
+            if platform.system() == "Windows":
+                python = "python"
+            else:
+                python = "python3"
+
+            if self.registry is not None:
+                # in its own session and without pipes to us, the publisher survives a control server
+                # restart; its IPC channel is attached once it connects and says hello
+                cmd = [python, janus_path] + argv + ['--control_socket', self.registry.socket_path,
+                                                     '--adopt_grace', str(self.adopt_grace)]
+                p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL, start_new_session=True)
+                self.loop.create_task(self.watch_unattached(client, p))
+                return p
+
+            cmd = [python, janus_path] + argv + ['--ipc']
+
+            # stdin/stdout carry the IPC frames, the publisher prints to stderr or its --log_file
+            p = await asyncio.create_subprocess_exec(*cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                     stderr=subprocess.DEVNULL)
+            reader, writer = p.stdout, p.stdin
+
+        client.ipc = writer
+        self.loop.create_task(self.read_ipc(client, p, reader))
 
         return p
 
+    async def read_ipc(self, client: RTSPClient, proc, reader):
+        """
+        Dispatch the messages a publisher process writes on its IPC channel until it exits.
+        """
+        while True:
+            try:
+                message = await read_frame(reader)
+            except Exception as e:
+                print("Read IPC message exception: ", e)
+                break
+            if message is None:
+                break
+            if client.process is not proc:
+                # a replaced process still talking before it dies
+                continue
+            kind = message.get("type")
+            if kind == "event":
+                self.subprocess_msg({'event': message["event"], 'data': str(message["data"]), 'id': message["id"]})
+            elif kind == "stats":
+                self.update_stats(message["stats"], client.publisher)
+
+        if client.process is proc and self.clients.get(client.publisher) is client and not self.handed_off:
+            # the publisher died on its own
+            self.supervisor.schedule(client.publisher, "process exited")
+
+    async def watch_unattached(self, client, proc, interval=0.2):
+        """
+        Poll a publisher started in registry mode until it says hello, its IPC channel
+        reports its exit from then on; one dying before that is restarted.
+        """
+        while True:
+            # first sleep: the caller sets `client.process` once `launch_janus` returned
+            await asyncio.sleep(interval)
+            if client.process is not proc or client.ipc is not None:
+                return
+            if proc.poll() is not None:
+                break
+        print("Publisher ID: {p} exited with {c} before its hello".format(p=client.publisher, c=proc.returncode))
+        client.process = None
+        if self.clients.get(client.publisher) is client and not self.handed_off:
+            self.supervisor.schedule(client.publisher, "process exited before its hello")
+
+    async def attach_publisher(self, reader, writer):
+        """
+        A publisher connected to the control socket: after its hello, its messages
+        are dispatched like those of the stdin/stdout channel.
+        """
+        try:
+            message = await asyncio.wait_for(read_frame(reader), START_TIMEOUT)
+        except Exception as e:
+            print("Read IPC hello exception: ", e)
+            message = None
+        if message is None or message.get("type") != "hello":
+            writer.close()
+            return
+        publisher = str(message.get("id"))
+        client = self.clients.get(publisher)
+        if client is None or client.process is None or client.process.pid != message.get("pid"):
+            print("Publisher ID: {p} (pid {pid}) is not ours, stopping it".format(p=publisher, pid=message.get("pid")))
+            writer.write(encode_frame(command_message("stop")))
+            writer.close()
+            return
+        client.ipc = writer
+        if client.state == "adopting":
+            client.state = "up"
+            client.came_up = True
+            print("Publisher ID: " + publisher + " re-adopted")
+        await self.read_ipc(client, client.process, reader)
+
+    @staticmethod
+    def send_command(client: RTSPClient, command, **kwargs):
+        if client.ipc is None or client.ipc.is_closing():
+            return False
+        client.ipc.write(encode_frame(command_message(command, **kwargs)))
+        return True
+
+    async def collect_stats(self, timeout=STATS_TIMEOUT):
+        """
+        Ask every publisher for fresh counters and wait for them at most `timeout` seconds,
+        publishers that do not answer in time keep their last counters.
+        Concurrent callers share the same request.
+        """
+        if self._stats_waiter is None or self._stats_waiter.done():
+            self._stats_requested = time.monotonic()
+            self._stats_waiter = self.loop.create_future()
+            if self.engine is not None:
+                self.engine.request_stats()
+            else:
+                for client in self.clients.values():
+                    self.send_command(client, "stats")
+            self.check_stats()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._stats_waiter), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def update_stats(self, stats, publisher):
+        client = self.clients.get(publisher)
+        if client is None:
+            return
+        client.stats = stats
+        client.stats_time = time.monotonic()
+        self.check_stats()
+
+    def check_stats(self):
+        waiter = self._stats_waiter
+        if waiter is None or waiter.done():
+            return
+        if all(client.stats_time >= self._stats_requested for client in self.clients.values()):
+            waiter.set_result(None)
+
+    def timelines(self):
+        """
+        The setup timeline of every publisher, the one in progress when not complete
+        yet, and the histograms of the completed ones.
+        """
+        publishers = {}
+        for publisher, client in self.clients.items():
+            timeline = client.timeline
+            if not timeline and "timeline" in client.stats:
+                timeline = shift(client.stats["timeline"], client.launched)
+            publishers[publisher] = {"room": client.room, "state": client.state, "timeline": timeline}
+        return {"phases": PHASES, "publishers": publishers, "histograms": self.setup_histograms.as_dict()}
+
+    def host_pid(self, client: RTSPClient):
+        """
+        Pid of the process hosting `client`, None when it has none yet.
+        """
+        if self.engine is None:
+            return client.process.pid if client.process is not None else None
+        if hasattr(self.engine, "worker_for"):
+            return self.engine.worker_for(client.publisher).process.pid
+        return os.getpid()
+
+    def publisher_costs(self):
+        """
+        `CapacityModel.sample` of the publishers not stopped, those that did not come up yet
+        count at the expected cost.
+        """
+        running = [(publisher, client) for publisher, client in self.clients.items() if client.state != "stopped"]
+        costs = self.capacity.sample([(publisher, self.host_pid(client), client.stats)
+                                      for publisher, client in running])
+        for publisher, client in running:
+            if not client.came_up:
+                costs[publisher] = None
+        return costs
+
+    async def admit(self):
+        """
+        (admitted, reason) for one more publisher, waiting up to `admission_wait` seconds for capacity.
+        """
+        if self.capacity is None:
+            return True, None
+        deadline = time.monotonic() + self.admission_wait
+        while True:
+            if time.monotonic() - self._stats_requested > ADMISSION_STATS_AGE:
+                await self.collect_stats()
+            admitted, reason = self.capacity.admit(self.publisher_costs(), self.pending_starts)
+            if admitted or time.monotonic() >= deadline:
+                return admitted, reason
+            await asyncio.sleep(1)
+
+    # Counters from publishers hosted by the engine, called from its threads
+    def engine_stats(self, stats, publisher):
+        self.loop.call_soon_threadsafe(self.update_stats, stats, publisher)
+
     # check start command
-    def check_start(self, form):
-        self.debug_log_level = 0
+    async def check_start(self, form):
+        if self.draining:
+            return self.json_response(False, -11, "Server is draining, it does not start new publishers!")
+
+        debug_log_level = 0
         if 'debug' in form:
             debug = form['debug']
             if debug.isdigit():
-                self.debug_log_level = int(debug)
+                debug_log_level = int(debug)
 
         if 'room' not in form:
             return self.json_response(False, -1, "Please input Room number!")
@@ -266,7 +540,9 @@ class RequestHandler(BaseHTTPRequestHandler):
                 if len(str(mic)) == 0:
                     mic = "mute"
                 if str(mic) != 'mute':
-                    if not self.check_mic(mic):
+                    # ffmpeg device listing blocks, keep it off the event loop
+                    found = await self.loop.run_in_executor(None, self.check_mic, mic)
+                    if not found:
                         return self.json_response(False, -4, "Invalid microphone device!")
 
         turn_server = None
@@ -297,43 +573,86 @@ class RequestHandler(BaseHTTPRequestHandler):
         if rtsp in self.clients:
             print("Current RTSP stream ", rtsp, " is publishing...")
             return self.json_response(False, -3, "You've published the stream!")
-        else:
-            client = RTSPClient(publisher=publisher, rtsp=rtsp, mic=mic, display=display, room=room)
-            client.janus = janus
-            if turn_passwd and turn_user and turn_server:
-                client.turn = turn_server
-                client.turn_user = turn_user
-                client.turn_passwd = turn_passwd
-            if stun_server:
-                client.stun = stun_server
-
-            proc = self.launch_janus(client)
-            client.process = proc
-            msg = publisher + " has been published to VideoRoom " + room
-            self.clients[publisher] = client
-
-            # Set a timeout 30s
-            timeout = time.time() + 30
-            while True:
-                if time.time() > timeout:
-                    return self.json_response(False, -9, 'Request subprocess timeout...')
-
-                time.sleep(1)
-                if not client.queue.empty():
-                    obj = client.queue.get()
-                    event = obj['event']
-                    if event == 'close':
-                        msg = str(obj['data'])
-                        break
-                    if event == 'webrtc':
-                        data = str(obj['data'])
-                        if data == 'up':
-                            break
-                    elif event == 'exception':
-                        msg = str(obj['data'])
-                        return self.json_response(False, -7, msg)
 
-            return self.json_response(True, 1, msg)
+        admitted, reason = await self.admit()
+        if not admitted:
+            print("Refused publisher ", publisher, ": ", reason)
+            return self.json_response(False, -10, "Host at capacity, " + reason)
+
+        client = RTSPClient(publisher=publisher, rtsp=rtsp, mic=mic, display=display, room=room)
+        client.janus = janus
+        client.debug_log_level = debug_log_level
+        if turn_passwd and turn_user and turn_server:
+            client.turn = turn_server
+            client.turn_user = turn_user
+            client.turn_passwd = turn_passwd
+        if stun_server:
+            client.stun = stun_server
+
+        client.started = self.loop.create_future()
+        # reserve its share of the capacity until it is counted among the clients
+        self.pending_starts += 1
+        try:
+            proc = await self.launch_janus(client)
+        finally:
+            self.pending_starts -= 1
+        client.process = proc
+        msg = publisher + " has been published to VideoRoom " + room
+        self.clients[publisher] = client
+        self.persist()
+
+        try:
+            success, data = await asyncio.wait_for(asyncio.shield(client.started), START_TIMEOUT)
+        except asyncio.TimeoutError:
+            return self.json_response(False, -9, 'Request subprocess timeout...')
+
+        if not success:
+            return self.json_response(False, -7, data)
+        if data is not None:
+            msg = data
+        return self.json_response(True, 1, msg)
+
+    def check_batch(self, request, check):
+        """
+        Run `check` on every camera descriptor of a batch request, at most
+        `concurrency` at a time, and stream one JSON line per camera as it completes.
+
+        The body is a JSON list of descriptors (the form fields of the single
+        camera route), or an object with a `cameras` list and an optional `concurrency`.
+        """
+        try:
+            body = request.json()
+        except ValueError:
+            return Response.json(self.json_response(False, -1, "Please input a JSON list of cameras!"))
+        concurrency = self.batch_concurrency
+        if isinstance(body, dict):
+            if 'concurrency' in body and str(body['concurrency']).isdigit():
+                concurrency = max(1, min(int(body['concurrency']), self.batch_concurrency))
+            body = body.get('cameras')
+        if not isinstance(body, list) or not all(isinstance(item, dict) for item in body):
+            return Response.json(self.json_response(False, -1, "Please input a JSON list of cameras!"))
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(index, item):
+            form = {str(k): str(v) for k, v in item.items()}
+            async with semaphore:
+                r = check(form)
+                if asyncio.iscoroutine(r):
+                    r = await r
+            r["index"] = index
+            r["id"] = form.get("id")
+            return r
+
+        async def results():
+            pending = [run(index, item) for index, item in enumerate(body)]
+            for future in asyncio.as_completed(pending):
+                r = await future
+                print("Send batch response: ", r)
+                yield json.dumps(r) + "\n"
+            print("[END]\n")
+
+        return StreamResponse(results())
 
     # Check stop command
     def check_stop(self, form):
@@ -351,41 +670,185 @@ class RequestHandler(BaseHTTPRequestHandler):
             print("Stopping Subprocess first!")
             self.kill_subprocess(client)
             self.clients.pop(publisher, None)
+            self.supervisor.forget(publisher)
+            self.persist()
             msg = "Publisher ID: " + publisher + " Stopped!"
-
-            if client.log_handler is not None:
-                client.log_handler.flush()
-                client.log_handler.close()
+            # release a start request still waiting on this publisher
+            self.resolve_start(client, 'exception', msg)
 
             return self.json_response(True, 1, msg)
 
         return self.json_response(False, -4, "No subprocess Found!")
 
-    @staticmethod
-    def kill_subprocess(client: RTSPClient):
-        if client.process is None:
+    def kill_subprocess(self, client: RTSPClient):
+        if self.engine is not None:
+            self.engine.kill(client.publisher)
+            return True
+        proc = client.process
+        if proc is None:
             return False
+        # from now on its exit is expected
+        client.process = None
+        if client.ipc is not None:
+            client.ipc.close()
+            client.ipc = None
         try:
-            os.kill(client.process.pid, signal.SIGTERM)
-            client.process.terminate()
-            return True
+            if isinstance(proc, AdoptedProcess):
+                # only if its pid still belongs to the publisher
+                proc.terminate()
+            else:
+                os.kill(proc.pid, signal.SIGTERM)
         except Exception as e:
             print("Kill subprocess exception: ", e)
-            client.process.terminate()
-            return True
+        if self.loop is not None:
+            self.loop.create_task(self.reap(proc))
+        return True
 
-    def restart_client(self, publisher):
-        client = self.clients[publisher]
-        r = self.kill_subprocess(client)
-        if r:
-            if client.log_handler is not None:
-                # 停止日志写入
-                client.log_handler.flush()
-                client.log_handler.close()
-            proc = self.launch_janus(client)
+    async def reap(self, proc, timeout=REAP_TIMEOUT):
+        """
+        Wait for a terminated publisher process so it does not linger as a zombie,
+        SIGKILL it when it ignores SIGTERM for `timeout` seconds.
+        """
+        if isinstance(proc, asyncio.subprocess.Process):
+            try:
+                await asyncio.wait_for(proc.wait(), timeout)
+                return
+            except asyncio.TimeoutError:
+                print("Publisher process {pid} did not exit, killing it".format(pid=proc.pid))
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+        elif isinstance(proc, (subprocess.Popen, AdoptedProcess)):
+            # a publisher outliving us (see `Registry`)
+            try:
+                await self.loop.run_in_executor(None, proc.wait, timeout)
+                return
+            except subprocess.TimeoutExpired:
+                print("Publisher process {pid} did not exit, killing it".format(pid=proc.pid))
+            proc.kill()
+            await self.loop.run_in_executor(None, proc.wait)
+        else:
+            # multiprocessing.Process forked by the zygote
+            await self.loop.run_in_executor(None, proc.join, timeout)
+            if proc.is_alive():
+                print("Publisher process {pid} did not exit, killing it".format(pid=proc.pid))
+                proc.kill()
+                await self.loop.run_in_executor(None, proc.join)
+
+    async def restart_client(self, publisher):
+        client = self.clients.get(publisher)
+        if client is None:
+            return
+        if self.engine is not None:
+            client.restarts += 1
+            client.state = "restarting"
+            client.relaunched()
+            self.engine.restart(client)
+            print(publisher + " has been republished to VideoRoom " + client.room)
+            return
+        client.restarts += 1
+        client.state = "restarting"
+        self.kill_subprocess(client)
+        proc = await self.launch_janus(client)
+        if self.clients.get(publisher) is not client:
+            # stopped while launching
             client.process = proc
-            msg = publisher + " has been republished to VideoRoom " + client.room
-            print(msg)
+            self.kill_subprocess(client)
+            return
+        client.process = proc
+        self.persist()
+        msg = publisher + " has been republished to VideoRoom " + client.room
+        print(msg)
+
+    def persist(self):
+        if self.registry is None:
+            return
+        try:
+            self.registry.save(self.clients.values())
+        except OSError as e:
+            print("Save publisher registry exception: ", e)
+
+    def restore(self):
+        """
+        Take over the publishers recorded by the previous control server: running ones are
+        expected to reconnect within `adopt_grace` seconds, the others are republished.
+        """
+        for entry in self.registry.load():
+            client = RTSPClient(room=entry["room"], publisher=entry["publisher"], rtsp=entry["rtsp"],
+                                display=entry["display"], mic=entry["mic"])
+            client.janus = entry["janus"]
+            client.turn = entry["turn"]
+            client.turn_user = entry["turn_user"]
+            client.turn_passwd = entry["turn_passwd"]
+            client.stun = entry["stun"]
+            client.debug_log_level = entry.get("debug_log_level", 0)
+            self.clients[client.publisher] = client
+            pid = entry.get("pid")
+            # the pid may belong to another process by now (reboot, pid reuse)
+            if pid is not None and is_publisher(pid, client.publisher, entry.get("started")):
+                client.process = AdoptedProcess(pid, client.publisher, entry.get("started"))
+                client.state = "adopting"
+            else:
+                self.supervisor.schedule(client.publisher, "not running after a control server restart")
+        if self.clients:
+            print("Restored {n} publishers from the registry".format(n=len(self.clients)))
+        # publishers retry every second, the ones still missing after their grace period are gone
+        self.loop.call_later(self.adopt_grace + 5, self.check_adopted)
+
+    def check_adopted(self):
+        for publisher, client in list(self.clients.items()):
+            if client.state == "adopting":
+                self.kill_subprocess(client)
+                self.supervisor.schedule(publisher, "not re-adopted after a control server restart")
+
+    def drain(self):
+        """
+        Refuse new publishers from now on, the running ones keep publishing.
+        """
+        self.draining = True
+        print("Draining, {n} publishers running".format(n=len(self.clients)))
+        return self.json_response(True, 1, {"publishers": len(self.clients)})
+
+    def handoff(self):
+        """
+        Drain and exit leaving the publishers running, for the next control server to adopt them.
+        """
+        if self.registry is None:
+            return self.json_response(False, -1, "Handoff needs a state directory (--state_dir)!")
+        self.draining = True
+        self.handed_off = True
+        for publisher in self.clients:
+            # pending restarts are left to the next control server as well
+            self.supervisor.forget(publisher)
+        self.persist()
+        print("Handing off {n} publishers".format(n=len(self.clients)))
+        self.loop.call_later(HANDOFF_DELAY, self.stop_serving)
+        return self.json_response(True, 1, "{n} publishers handed off".format(n=len(self.clients)))
+
+    def stop_serving(self):
+        if self.control_server is not None:
+            self.control_server.close()
+        if self.http is not None:
+            self.http.stop()
+
+    def give_up(self, publisher, reason):
+        """
+        Stop a publisher that keeps crashing instead of restarting it forever.
+        """
+        self.check_stop({'id': publisher})
+
+    @staticmethod
+    def resolve_start(client: RTSPClient, event, data):
+        if client.started is None or client.started.done():
+            return
+        if event == 'close':
+            client.started.set_result((True, data))
+        elif event == 'webrtc' and data == 'up':
+            client.started.set_result((True, None))
+        elif event == 'exception':
+            client.started.set_result((False, data))
 
     # Interact with subprocess
     def subprocess_msg(self, form):
@@ -394,24 +857,115 @@ class RequestHandler(BaseHTTPRequestHandler):
             publisher = str(form['id'])
             if publisher in self.clients:
                 client = self.clients[publisher]
-                client.queue.put(form)
                 event = form['event']
+                if form.get('generation', client.generation) != client.generation:
+                    # late event of a killed instance, it must not act on the current one
+                    print("Ignored event of a former instance of publisher ID: " + publisher)
+                    return self.json_response(True, 1, "")
+                self.resolve_start(client, event, str(form['data']))
                 if event == 'exception':
+                    client.state = "stopped"
                     self.kill_subprocess(client)
+                    self.supervisor.forget(publisher)
+                    self.persist()
                     print("Publisher ID: " + publisher + " Stopped!")
+                elif event == 'webrtc' and str(form['data']) == 'up':
+                    client.state = "up"
+                    client.came_up = True
+                    self.supervisor.up(publisher)
+                elif event == 'timeline':
+                    client.timeline = shift(json.loads(form['data']), client.launched)
+                    self.setup_histograms.observe(client.timeline)
                 elif event == 'error':
                     code = str(form['data'])
                     if code == '458':
                         # no such session, we restart it
-                        self.restart_client(publisher)
+                        self.supervisor.schedule(publisher, "error 458")
+                elif event == 'exit':
+                    # a publisher hosted by the engine ended on its own, unless it was stopped on an exception
+                    if client.state != "stopped":
+                        self.supervisor.schedule(publisher, "publisher exited")
+                elif event == 'rtsp':
+                    # the RTSP stream stalled or broke, reopening it takes a new publisher
+                    client.state = "rtsp " + str(form['data'])
+                    self.supervisor.schedule(publisher, "rtsp " + str(form['data']))
                 elif event == 'pc':
                     data = form['data']
+                    client.state = data
                     if data == 'failed':
                         # connection lost, we restart it
-                        self.restart_client(publisher)
+                        self.supervisor.schedule(publisher, "pc failed")
 
         return self.json_response(True, 1, "")
 
+    # Events from publishers hosted by the engine, called from its threads
+    def engine_msg(self, type, data, publisher, generation=None):
+        form = {'event': type, 'data': str(data), 'id': publisher}
+        if generation is not None:
+            form['generation'] = generation
+        self.loop.call_soon_threadsafe(self.subprocess_msg, form)
+
+
+async def serve(args):
+    if args.log_file:
+        logpipe.configure(args.log_file)
+    if args.cert_dir:
+        # before any publisher process starts, they inherit it
+        certstore.configure(args.cert_dir)
+    if args.demux_threads:
+        ingest.configure(args.demux_threads)
+    policy = RestartPolicy(max_delay=args.restart_max_delay, max_restarts=args.max_restarts)
+    capacity = None
+    if args.cpu_budget or args.bandwidth_budget or args.socket_budget:
+        capacity = CapacityModel(cpu=args.cpu_budget, bandwidth=args.bandwidth_budget * 1e6,
+                                 sockets=args.socket_budget)
+    registry = None
+    if args.state_dir:
+        if args.engine != "process" or platform.system() == "Windows":
+            raise RuntimeError("--state_dir needs --engine process and unix sockets")
+        registry = Registry(args.state_dir)
+    control = ControlServer(batch_concurrency=args.batch_concurrency, restart_policy=policy,
+                            restart_rate=args.restart_rate, capacity=capacity, admission_wait=args.admission_wait,
+                            registry=registry, adopt_grace=args.adopt_grace)
+    control.loop = asyncio.get_event_loop()
+
+    if args.engine == "inprocess":
+        from engine import PublisherEngine
+        control.engine = PublisherEngine(on_event=control.engine_msg, on_stats=control.engine_stats,
+                                         share_sessions=args.janus_sessions == "shared")
+        control.engine.start()
+    elif args.engine == "pool":
+        from workerpool import WorkerPool
+        control.engine = WorkerPool(args.workers, on_event=control.engine_msg, on_stats=control.engine_stats,
+                                    share_sessions=args.janus_sessions == "shared", loop=control.loop)
+        control.engine.start()
+    elif args.engine == "forkserver":
+        from zygote import Zygote
+        if not Zygote.available():
+            raise RuntimeError("forkserver is not supported on this platform")
+        control.zygote = Zygote()
+        control.zygote.start()
+
+    if registry is not None:
+        if os.path.exists(registry.socket_path):
+            os.unlink(registry.socket_path)
+        control.control_server = await asyncio.start_unix_server(control.attach_publisher, registry.socket_path)
+        control.restore()
+        # service managers stop us with SIGTERM: hand the publishers off to the next control server
+        control.loop.add_signal_handler(signal.SIGTERM, control.handoff)
+
+    server = HTTPServer(control.handle)
+    control.http = server
+    await server.start(args.host, args.p)
+    print('Started httpserver on port', args.p)
+
+    try:
+        await server.serve_forever()
+    finally:
+        print("Stopping now!")
+        if control.engine is not None:
+            control.engine.shutdown()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="accrtsprtc")
@@ -424,18 +978,108 @@ if __name__ == "__main__":
     parser.add_argument(
         "--host", default="0.0.0.0", help="Host for HTTP server (default: 0.0.0.0)"
     )
+    parser.add_argument(
+        "--engine",
+        choices=["process", "forkserver", "inprocess", "pool"],
+        default="process",
+        help="Run each publisher as a janus.py subprocess (process, default) or as a process forked "
+             "from a preloaded template (forkserver), host all of them in this process (inprocess) "
+             "or in a pool of worker processes (pool)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes for --engine pool, default is the number of CPUs",
+    )
+    parser.add_argument(
+        "--janus_sessions",
+        choices=["shared", "per-publisher"],
+        default="shared",
+        help="With --engine inprocess or pool, publishers of the same Janus server share one WebSocket and "
+             "Janus session (shared, default) or open their own (per-publisher)",
+    )
+    parser.add_argument(
+        "--batch_concurrency",
+        type=int,
+        default=BATCH_CONCURRENCY,
+        help="Maximum number of publishers a batch request starts or stops at the same time, "
+             "default is {n}".format(n=BATCH_CONCURRENCY),
+    )
+    parser.add_argument(
+        "--restart_rate",
+        type=float,
+        default=RESTART_RATE,
+        help="Maximum number of publisher restarts per second, restarts beyond it are delayed, "
+             "default is {n}".format(n=RESTART_RATE),
+    )
+    parser.add_argument(
+        "--restart_max_delay",
+        type=float,
+        default=60,
+        help="Upper bound in seconds of the exponential backoff between restarts of a publisher, default is 60",
+    )
+    parser.add_argument(
+        "--max_restarts",
+        type=int,
+        default=10,
+        help="Restarts of a publisher within 10 minutes after which it is stopped as crash looping, "
+             "default is 10",
+    )
+    parser.add_argument(
+        "--cpu_budget",
+        type=float,
+        default=0,
+        help="CPU cores publishers may use, new publishers are refused beyond it (0: no limit, default)",
+    )
+    parser.add_argument(
+        "--bandwidth_budget",
+        type=float,
+        default=0,
+        help="Upstream Mbps publishers may send, new publishers are refused beyond it (0: no limit, default)",
+    )
+    parser.add_argument(
+        "--socket_budget",
+        type=int,
+        default=0,
+        help="Sockets publishers may open, new publishers are refused beyond it (0: no limit, default)",
+    )
+    parser.add_argument(
+        "--admission_wait",
+        type=float,
+        default=0,
+        help="Seconds a start request waits for capacity before it is refused, default is 0",
+    )
+    parser.add_argument(
+        "--state_dir",
+        help="Directory of the publisher registry and control socket: publishers keep running across "
+             "a control server restart and are adopted again (--engine process only)",
+    )
+    parser.add_argument(
+        "--adopt_grace",
+        type=float,
+        default=ADOPT_GRACE,
+        help="Seconds publishers wait for a restarting control server, default is {n}".format(n=ADOPT_GRACE),
+    )
+    parser.add_argument(
+        "--log_file",
+        help="Write the server log to this file, rotated by size, instead of stdout",
+    )
+    parser.add_argument(
+        "--cert_dir",
+        default="cert",
+        help="Directory of the DTLS certificate shared by all publishers, default is cert ('' keeps it in memory)",
+    )
+    parser.add_argument(
+        "--demux_threads",
+        type=int,
+        default=ingest.DEFAULT_THREADS,
+        help="Threads demuxing the RTSP streams of each process, default is {n}".format(n=ingest.DEFAULT_THREADS),
+    )
     args = parser.parse_args()
 
-    server = ThreadedHTTPServer(('', args.p), RequestHandler)
-    print('Started httpserver on port', args.p)
-
     try:
-        server.serve_forever()
+        asyncio.run(serve(args))
     except (KeyboardInterrupt, Exception) as e:
         print("Received exception: ", e)
         pass
-    finally:
-        print("Stopping now!")
-        server.shutdown()
-        server.socket.close()
-
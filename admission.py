@@ -0,0 +1,184 @@
+"""
+Capacity-aware admission of new publishers.
+
+The cost of a publisher is measured on the process hosting it: CPU time
+(from /proc/<pid>/stat), open sockets (from /proc/<pid>/fd) and the
+bitrate it reports. A process shared by several publishers (in-process
+engine, pool workers) is split evenly among them. New publishers are
+admitted while the measured load plus the expected cost of the new one,
+the average of the running ones, stays within the host budget.
+"""
+import os
+import time
+
+# Cost assumed for a publisher before anything was measured
+DEFAULT_CPU = 0.1
+DEFAULT_BPS = 4000000
+DEFAULT_SOCKETS = 8
+# Minimum seconds between two samples of a process
+SAMPLE_INTERVAL = 1.0
+
+try:
+    CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+except (AttributeError, ValueError, OSError):
+    CLOCK_TICKS = 100
+
+
+def cpu_seconds(pid):
+    """
+    User plus system CPU time of `pid`, None when /proc is not available.
+    """
+    try:
+        with open("/proc/{p}/stat".format(p=pid)) as fp:
+            stat = fp.read()
+    except OSError:
+        return None
+    # the command name may contain spaces, the fields start after its closing parenthesis
+    fields = stat[stat.rfind(")") + 2:].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def socket_count(pid):
+    try:
+        fds = os.listdir("/proc/{p}/fd".format(p=pid))
+    except OSError:
+        return None
+    count = 0
+    for fd in fds:
+        try:
+            if os.readlink("/proc/{p}/fd/{f}".format(p=pid, f=fd)).startswith("socket:"):
+                count += 1
+        except OSError:
+            pass
+    return count
+
+
+class Cost:
+    def __init__(self, cpu=DEFAULT_CPU, bps=DEFAULT_BPS, sockets=DEFAULT_SOCKETS):
+        # CPU cores, bits per second, open sockets
+        self.cpu = cpu
+        self.bps = bps
+        self.sockets = sockets
+
+    def __add__(self, other):
+        return Cost(self.cpu + other.cpu, self.bps + other.bps, self.sockets + other.sockets)
+
+    def scaled(self, factor):
+        return Cost(self.cpu * factor, self.bps * factor, self.sockets * factor)
+
+    def as_dict(self):
+        return {"cpu": round(self.cpu, 3), "bps": int(self.bps), "sockets": round(self.sockets, 1)}
+
+
+class ProcessSample:
+    def __init__(self, when, cpu, sockets):
+        self.when = when
+        self.cpu = cpu
+        self.sockets = sockets
+        # CPU cores used since the previous sample
+        self.cpu_rate = None
+
+
+class CapacityModel:
+    """
+    `cpu` is the budget in CPU cores, `bandwidth` in bits per second and
+    `sockets` in open sockets; a budget of 0 is not enforced.
+    """
+
+    def __init__(self, cpu=0, bandwidth=0, sockets=0):
+        self.budget = Cost(cpu, bandwidth, sockets)
+        # pid -> last `ProcessSample`
+        self._processes = {}
+        # publisher id -> (time, bytesSent, bits per second)
+        self._bitrates = {}
+
+    def sample(self, publishers):
+        """
+        Measure `publishers`, a list of (publisher id, hosting pid or None, stats),
+        returns {publisher id: `Cost`}, with None for publishers not measured yet.
+        """
+        now = time.monotonic()
+        sharing = {}
+        for _, pid, _ in publishers:
+            if pid is not None:
+                sharing[pid] = sharing.get(pid, 0) + 1
+
+        for pid in sharing:
+            previous = self._processes.get(pid)
+            if previous is not None and now - previous.when < SAMPLE_INTERVAL:
+                continue
+            cpu = cpu_seconds(pid)
+            if cpu is None:
+                self._processes.pop(pid, None)
+                continue
+            sample = ProcessSample(now, cpu, socket_count(pid) or 0)
+            if previous is not None:
+                sample.cpu_rate = max(0.0, cpu - previous.cpu) / (now - previous.when)
+            self._processes[pid] = sample
+        for pid in list(self._processes):
+            if pid not in sharing:
+                self._processes.pop(pid)
+
+        costs = {}
+        for publisher, pid, stats in publishers:
+            bps = self._bitrate(publisher, now, stats.get("bytesSent"))
+            process = self._processes.get(pid)
+            if process is None or process.cpu_rate is None or bps is None:
+                costs[publisher] = None
+                continue
+            share = 1.0 / sharing[pid]
+            costs[publisher] = Cost(process.cpu_rate * share, bps, process.sockets * share)
+        for publisher in list(self._bitrates):
+            if publisher not in costs:
+                self._bitrates.pop(publisher)
+        return costs
+
+    def _bitrate(self, publisher, now, sent):
+        previous = self._bitrates.get(publisher)
+        if sent is None:
+            return None
+        if previous is None or sent < previous[1]:
+            self._bitrates[publisher] = (now, sent, None)
+            return None
+        if now - previous[0] < SAMPLE_INTERVAL:
+            return previous[2]
+        bps = (sent - previous[1]) * 8 / (now - previous[0])
+        self._bitrates[publisher] = (now, sent, bps)
+        return bps
+
+    @staticmethod
+    def expected(costs):
+        """
+        Expected cost of one more publisher: the average measured one.
+        """
+        measured = [cost for cost in costs.values() if cost is not None]
+        if not measured:
+            return Cost()
+        total = Cost(0, 0, 0)
+        for cost in measured:
+            total = total + cost
+        return total.scaled(1.0 / len(measured))
+
+    def load(self, costs, pending=0):
+        """
+        Measured load of the running publishers, unmeasured and `pending` ones counted at the expected cost.
+        """
+        expected = self.expected(costs)
+        total = Cost(0, 0, 0)
+        for cost in costs.values():
+            total = total + (cost if cost is not None else expected)
+        return total + expected.scaled(pending), expected
+
+    def admit(self, costs, pending=0):
+        """
+        (admitted, reason): whether one more publisher fits in the budget.
+        """
+        load, expected = self.load(costs, pending)
+        after = load + expected
+        for name, used, budget, unit in (("CPU", after.cpu, self.budget.cpu, "cores"),
+                                         ("bandwidth", after.bps / 1e6, self.budget.bps / 1e6, "Mbps"),
+                                         ("sockets", after.sockets, self.budget.sockets, "sockets")):
+            if budget and used > budget:
+                return False, "{n} budget exceeded: {u:.2f} of {b:.2f} {unit} with the new publisher".format(
+                    n=name, u=used, b=budget, unit=unit)
+        return True, None
@@ -8,7 +8,7 @@ import secrets
 import socket
 import threading
 from itertools import count
-from typing import Dict, List, Optional, Set, Text, Tuple, Union, cast
+from typing import Callable, Dict, List, Optional, Set, Text, Tuple, Union, cast
 
 import netifaces
 
@@ -398,11 +398,16 @@ class Connection:
                 self._check_list.append(pair)
         self.sort_check_list()
 
-    async def gather_candidates(self) -> None:
+    async def gather_candidates(
+        self, on_candidate: Optional[Callable[[Candidate], None]] = None
+    ) -> None:
         """
         Gather local candidates.
 
         You **must** call this coroutine before calling :meth:`connect`.
+
+        :param on_candidate: An optional callback receiving each candidate as
+                             soon as it is gathered, for trickle ICE.
         """
         if not self._local_candidates_start:
             self._local_candidates_start = True
@@ -410,7 +415,9 @@ class Connection:
                 use_ipv4=self._use_ipv4, use_ipv6=self._use_ipv6
             )
             coros = [
-                self.get_component_candidates(component=component, addresses=addresses)
+                self.get_component_candidates(
+                    component=component, addresses=addresses, on_candidate=on_candidate
+                )
                 for component in self._components
             ]
             for candidates in await asyncio.gather(*coros):
@@ -829,11 +836,24 @@ class Connection:
         return None
 
     async def get_component_candidates(
-        self, component: int, addresses: List[str], timeout: int = 5
+        self,
+        component: int,
+        addresses: List[str],
+        timeout: int = 5,
+        on_candidate: Optional[Callable[[Candidate], None]] = None,
     ) -> List[Candidate]:
         candidates = []
         loop = asyncio.get_event_loop()
 
+        def found(candidate: Candidate) -> None:
+            candidates.append(candidate)
+            if on_candidate is not None:
+                on_candidate(candidate)
+
+        def found_reflexive(task: asyncio.Future) -> None:
+            if not task.cancelled() and task.exception() is None:
+                found(task.result())
+
         # gather host candidates
         host_protocols = []
         for address in addresses:
@@ -859,38 +879,48 @@ class Connection:
                 port=candidate_address[1],
                 type="host",
             )
-            candidates.append(protocol.local_candidate)
+            found(protocol.local_candidate)
         self._protocols += host_protocols
 
+        # allocate on the TURN server while the STUN queries run
+        turn_task = None
+        if self.turn_server:
+            turn_task = asyncio.ensure_future(
+                turn.create_turn_endpoint(
+                    lambda: StunProtocol(self),
+                    server_addr=self.turn_server,
+                    username=self.turn_username,
+                    password=self.turn_password,
+                    ssl=self.turn_ssl,
+                    transport=self.turn_transport,
+                )
+            )
+
         # query STUN server for server-reflexive candidates (IPv4 only)
         if self.stun_server:
             tasks = []
             for protocol in host_protocols:
                 if ipaddress.ip_address(protocol.local_candidate.host).version == 4:
-                    tasks.append(
-                        asyncio.ensure_future(
-                            server_reflexive_candidate(protocol, self.stun_server)
-                        )
+                    task = asyncio.ensure_future(
+                        server_reflexive_candidate(protocol, self.stun_server)
                     )
+                    task.add_done_callback(found_reflexive)
+                    tasks.append(task)
             if len(tasks):
-                done, pending = await asyncio.wait(tasks, timeout=timeout)
-                candidates += [
-                    task.result() for task in done if task.exception() is None
-                ]
+                try:
+                    _, pending = await asyncio.wait(tasks, timeout=timeout)
+                except asyncio.CancelledError:
+                    for task in tasks + [turn_task]:
+                        if task is not None:
+                            task.cancel()
+                    raise
                 for task in pending:
+                    task.remove_done_callback(found_reflexive)
                     task.cancel()
 
         # connect to TURN server
-        if self.turn_server:
-            # create transport
-            _, protocol = await turn.create_turn_endpoint(
-                lambda: StunProtocol(self),
-                server_addr=self.turn_server,
-                username=self.turn_username,
-                password=self.turn_password,
-                ssl=self.turn_ssl,
-                transport=self.turn_transport,
-            )
+        if turn_task is not None:
+            _, protocol = await turn_task
             protocol = cast(StunProtocol, protocol)
             self._protocols.append(protocol)
 
@@ -908,7 +938,7 @@ class Connection:
                 related_address=related_address[0],
                 related_port=related_address[1],
             )
-            candidates.append(protocol.local_candidate)
+            found(protocol.local_candidate)
 
         return candidates
 
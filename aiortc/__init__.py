@@ -7,7 +7,6 @@ from .about import __version__
 from .exceptions import InvalidAccessError, InvalidStateError
 from .mediastreams import MediaStreamTrack, VideoStreamTrack
 from .rtcconfiguration import RTCConfiguration, RTCIceServer
-from .rtcdatachannel import RTCDataChannel, RTCDataChannelParameters
 from .rtcdtlstransport import (
     RTCCertificate,
     RTCDtlsFingerprint,
@@ -37,7 +36,6 @@ from .rtcrtpreceiver import (
 )
 from .rtcrtpsender import RTCRtpSender
 from .rtcrtptransceiver import RTCRtpTransceiver
-from .rtcsctptransport import RTCSctpCapabilities, RTCSctpTransport
 from .rtcsessiondescription import RTCSessionDescription
 from .stats import (
     RTCInboundRtpStreamStats,
@@ -48,6 +46,25 @@ from .stats import (
     RTCTransportStats,
 )
 
+# Optional subsystems, imported on first access.
+_LAZY = {
+    "RTCDataChannel": ".rtcdatachannel",
+    "RTCDataChannelParameters": ".rtcdatachannel",
+    "RTCSctpCapabilities": ".rtcsctptransport",
+    "RTCSctpTransport": ".rtcsctptransport",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        import importlib
+
+        value = getattr(importlib.import_module(_LAZY[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 # Disable PyAV's logging framework as it can lead to thread deadlocks.
 av.logging.restore_default_callback()
 
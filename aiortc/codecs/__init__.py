@@ -1,3 +1,4 @@
+import importlib
 from collections import OrderedDict
 from typing import Dict, List, Optional, Union
 
@@ -10,10 +11,35 @@ from ..rtcrtpparameters import (
     RTCRtpHeaderExtensionParameters,
 )
 from .base import Decoder, Encoder
-from .g711 import PcmaDecoder, PcmaEncoder, PcmuDecoder, PcmuEncoder
-from .h264 import H264Decoder, H264Encoder, h264_depayload
-from .opus import OpusDecoder, OpusEncoder
-from .vpx import Vp8Decoder, Vp8Encoder, vp8_depayload
+
+# Codec implementations pull in audioop, libvpx and the opus cffi module,
+# they are only imported when a decoder or encoder is actually needed.
+_IMPLEMENTATIONS = {
+    "PcmaDecoder": ".g711",
+    "PcmaEncoder": ".g711",
+    "PcmuDecoder": ".g711",
+    "PcmuEncoder": ".g711",
+    "H264Decoder": ".h264",
+    "H264Encoder": ".h264",
+    "h264_depayload": ".h264",
+    "OpusDecoder": ".opus",
+    "OpusEncoder": ".opus",
+    "Vp8Decoder": ".vpx",
+    "Vp8Encoder": ".vpx",
+    "vp8_depayload": ".vpx",
+}
+
+
+def __getattr__(name: str):
+    if name in _IMPLEMENTATIONS:
+        value = getattr(importlib.import_module(_IMPLEMENTATIONS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _load(name: str):
+    return globals().get(name) or __getattr__(name)
 
 PCMU_CODEC = RTCRtpCodecParameters(
     mimeType="audio/PCMU", clockRate=8000, channels=1, payloadType=0
@@ -102,9 +128,9 @@ def init_codecs() -> None:
 
 def depayload(codec: RTCRtpCodecParameters, payload: bytes) -> bytes:
     if codec.name == "VP8":
-        return vp8_depayload(payload)
+        return _load("vp8_depayload")(payload)
     elif codec.name == "H264":
-        return h264_depayload(payload)
+        return _load("h264_depayload")(payload)
     else:
         return payload
 
@@ -145,15 +171,15 @@ def get_decoder(codec: RTCRtpCodecParameters) -> Decoder:
     mimeType = codec.mimeType.lower()
 
     if mimeType == "audio/opus":
-        return OpusDecoder()
+        return _load("OpusDecoder")()
     elif mimeType == "audio/pcma":
-        return PcmaDecoder()
+        return _load("PcmaDecoder")()
     elif mimeType == "audio/pcmu":
-        return PcmuDecoder()
+        return _load("PcmuDecoder")()
     elif mimeType == "video/h264":
-        return H264Decoder()
+        return _load("H264Decoder")()
     elif mimeType == "video/vp8":
-        return Vp8Decoder()
+        return _load("Vp8Decoder")()
     else:
         raise ValueError(f"No decoder found for MIME type `{mimeType}`")
 
@@ -162,15 +188,15 @@ def get_encoder(codec: RTCRtpCodecParameters) -> Encoder:
     mimeType = codec.mimeType.lower()
 
     if mimeType == "audio/opus":
-        return OpusEncoder()
+        return _load("OpusEncoder")()
     elif mimeType == "audio/pcma":
-        return PcmaEncoder()
+        return _load("PcmaEncoder")()
     elif mimeType == "audio/pcmu":
-        return PcmuEncoder()
+        return _load("PcmuEncoder")()
     elif mimeType == "video/h264":
-        return H264Encoder()
+        return _load("H264Encoder")()
     elif mimeType == "video/vp8":
-        return Vp8Encoder()
+        return _load("Vp8Encoder")()
     else:
         raise ValueError(f"No encoder found for MIME type `{mimeType}`")
 
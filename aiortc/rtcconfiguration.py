@@ -31,3 +31,9 @@ class RTCConfiguration:
 
     iceServers: Optional[List[RTCIceServer]] = None
     "A list of :class:`RTCIceServer` objects to configure STUN / TURN servers."
+
+    certificates: Optional[List["RTCCertificate"]] = None  # noqa: F821
+    """
+    A list of :class:`RTCCertificate` objects the connection authenticates with,
+    a new certificate is generated when not set.
+    """
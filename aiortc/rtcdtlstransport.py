@@ -167,6 +167,7 @@ class RTCCertificate:
     def __init__(self, key: ec.EllipticCurvePrivateKey, cert: x509.Certificate) -> None:
         self._key = key
         self._cert = cert
+        self._ssl_context: Any = None
 
     @property
     def expires(self) -> datetime.datetime:
@@ -198,6 +199,15 @@ class RTCCertificate:
         cert = generate_certificate(key)
         return cls(key=key, cert=cert)
 
+    def _get_ssl_context(self) -> Any:
+        """
+        The SSL context of the certificate, created once and shared by every
+        transport using it.
+        """
+        if self._ssl_context is None:
+            self._ssl_context = self._create_ssl_context()
+        return self._ssl_context
+
     def _create_ssl_context(self) -> Any:
         ctx = lib.SSL_CTX_new(lib.DTLS_method())
         ctx = ffi.gc(ctx, lib.SSL_CTX_free)
@@ -372,7 +382,7 @@ class RTCDtlsTransport(AsyncIOEventEmitter):
         self._tx_srtp: Session = None
 
         # SSL init
-        self.__ctx = certificate._create_ssl_context()
+        self.__ctx = certificate._get_ssl_context()
 
         ssl = lib.SSL_new(self.__ctx)
         self.ssl = ffi.gc(ssl, lib.SSL_free)
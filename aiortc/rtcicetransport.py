@@ -192,12 +192,18 @@ class RTCIceGatherer(AsyncIOEventEmitter):
     async def gather(self) -> None:
         """
         Gather ICE candidates.
+
+        Each candidate is also announced by an `"icecandidate"` event as soon as
+        it is gathered.
         """
         if self.__state == "new":
             self.__setState("gathering")
-            await self._connection.gather_candidates()
+            await self._connection.gather_candidates(on_candidate=self.__on_candidate)
             self.__setState("completed")
 
+    def __on_candidate(self, candidate: Candidate) -> None:
+        self.emit("icecandidate", candidate_from_aioice(candidate))
+
     @classmethod
     def getDefaultIceServers(cls) -> List[RTCIceServer]:
         """
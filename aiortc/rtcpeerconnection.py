@@ -3,7 +3,7 @@ import copy
 import logging
 import uuid
 from collections import OrderedDict
-from typing import Dict, List, Optional, Set, Union
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Union
 
 from pyee import AsyncIOEventEmitter
 
@@ -13,7 +13,6 @@ from .events import RTCTrackEvent
 from .exceptions import InternalError, InvalidAccessError, InvalidStateError
 from .mediastreams import MediaStreamTrack
 from .rtcconfiguration import RTCConfiguration
-from .rtcdatachannel import RTCDataChannel, RTCDataChannelParameters
 from .rtcdtlstransport import RTCCertificate, RTCDtlsParameters, RTCDtlsTransport
 from .rtcicetransport import (
     RTCIceCandidate,
@@ -34,10 +33,13 @@ from .rtcrtpparameters import (
 from .rtcrtpreceiver import RemoteStreamTrack, RTCRtpReceiver
 from .rtcrtpsender import RTCRtpSender
 from .rtcrtptransceiver import RTCRtpTransceiver
-from .rtcsctptransport import RTCSctpTransport
 from .rtcsessiondescription import RTCSessionDescription
 from .stats import RTCStatsReport
 
+if TYPE_CHECKING:
+    # SCTP and data channels are only imported when a data channel is used
+    from .rtcsctptransport import RTCSctpTransport
+
 DISCARD_HOST = "0.0.0.0"
 DISCARD_PORT = 9
 MEDIA_KINDS = ["audio", "video"]
@@ -176,7 +178,7 @@ def allocate_mid(mids: Set[str]) -> str:
 
 
 def create_media_description_for_sctp(
-    sctp: RTCSctpTransport, legacy: bool, mid: str
+    sctp: "RTCSctpTransport", legacy: bool, mid: str
 ) -> sdp.MediaDescription:
     if legacy:
         media = sdp.MediaDescription(
@@ -274,19 +276,21 @@ class RTCPeerConnection(AsyncIOEventEmitter):
 
     def __init__(self, configuration: Optional[RTCConfiguration] = None) -> None:
         super().__init__()
-        self.__certificates = [RTCCertificate.generateCertificate()]
-        self.__cname = f"{uuid.uuid4()}"
         self.__configuration = configuration or RTCConfiguration()
+        self.__certificates = list(self.__configuration.certificates or []) or [
+            RTCCertificate.generateCertificate()
+        ]
+        self.__cname = f"{uuid.uuid4()}"
         self.__dtlsTransports: Set[RTCDtlsTransport] = set()
         self.__iceTransports: Set[RTCIceTransport] = set()
         self.__remoteDtls: Dict[
-            Union[RTCRtpTransceiver, RTCSctpTransport], RTCDtlsParameters
+            Union[RTCRtpTransceiver, "RTCSctpTransport"], RTCDtlsParameters
         ] = {}
         self.__remoteIce: Dict[
-            Union[RTCRtpTransceiver, RTCSctpTransport], RTCIceParameters
+            Union[RTCRtpTransceiver, "RTCSctpTransport"], RTCIceParameters
         ] = {}
         self.__seenMids: Set[str] = set()
-        self.__sctp: Optional[RTCSctpTransport] = None
+        self.__sctp: Optional["RTCSctpTransport"] = None
         self.__sctp_mline_index: Optional[int] = None
         self._sctpLegacySdp = True
         self.__sctpRemotePort: Optional[int] = None
@@ -297,6 +301,7 @@ class RTCPeerConnection(AsyncIOEventEmitter):
         self.__connectionState = "new"
         self.__iceConnectionState = "new"
         self.__iceGatheringState = "new"
+        self.__iceGatheringTask: Optional[asyncio.Future] = None
         self.__isClosed = False
         self.__signalingState = "stable"
 
@@ -355,7 +360,7 @@ class RTCPeerConnection(AsyncIOEventEmitter):
         return wrap_session_description(self.__remoteDescription())
 
     @property
-    def sctp(self) -> Optional[RTCSctpTransport]:
+    def sctp(self) -> Optional["RTCSctpTransport"]:
         """
         An :class:`RTCSctpTransport` describing the SCTP transport being used
         for datachannels or `None`.
@@ -463,6 +468,8 @@ class RTCPeerConnection(AsyncIOEventEmitter):
             return
         self.__isClosed = True
         self.__setSignalingState("closed")
+        if self.__iceGatheringTask is not None:
+            self.__iceGatheringTask.cancel()
 
         # stop senders / receivers
         for transceiver in self.__transceivers:
@@ -558,6 +565,8 @@ class RTCPeerConnection(AsyncIOEventEmitter):
 
         :rtype: :class:`RTCDataChannel`
         """
+        from .rtcdatachannel import RTCDataChannel, RTCDataChannelParameters
+
         if maxPacketLifeTime is not None and maxRetransmits is not None:
             raise ValueError("Cannot specify both maxPacketLifeTime and maxRetransmits")
 
@@ -712,13 +721,19 @@ class RTCPeerConnection(AsyncIOEventEmitter):
         return list(self.__transceivers)
 
     async def setLocalDescription(
-        self, sessionDescription: RTCSessionDescription
+        self, sessionDescription: RTCSessionDescription, trickle: bool = False
     ) -> None:
         """
         Change the local description associated with the connection.
 
+        Candidates are announced by `"icecandidate"` events as they are gathered,
+        followed by one with `None` once gathering is complete.
+
         :param sessionDescription: An :class:`RTCSessionDescription` generated
                                     by :meth:`createOffer` or :meth:`createAnswer()`.
+        :param trickle: Return without waiting for candidate gathering, the
+                        description then only holds the candidates gathered so
+                        far and the others must be trickled.
         """
         # parse and validate description
         description = sdp.SessionDescription.parse(sessionDescription.sdp)
@@ -763,7 +778,11 @@ class RTCPeerConnection(AsyncIOEventEmitter):
                 t._currentDirection = and_direction(t.direction, t._offerDirection)
 
         # gather candidates
-        await self.__gather()
+        if trickle:
+            self.__iceGatheringTask = asyncio.ensure_future(self.__gather())
+            self.__iceGatheringTask.add_done_callback(self.__gatheringDone)
+        else:
+            await self.__gather()
         for i, media in enumerate(description.media):
             if media.kind in ["audio", "video"]:
                 transceiver = self.__getTransceiverByMLineIndex(i)
@@ -962,6 +981,12 @@ class RTCPeerConnection(AsyncIOEventEmitter):
             self.__pendingRemoteDescription = description
 
     async def __connect(self) -> None:
+        if self.__iceGatheringTask is not None:
+            # ICE checks need every local candidate
+            try:
+                await asyncio.shield(self.__iceGatheringTask)
+            except Exception:
+                return
         for transceiver in self.__transceivers:
             dtlsTransport = transceiver._transport
             iceTransport = dtlsTransport.transport
@@ -995,8 +1020,30 @@ class RTCPeerConnection(AsyncIOEventEmitter):
                     )
 
     async def __gather(self) -> None:
-        coros = map(lambda t: t.iceGatherer.gather(), self.__iceTransports)
+        gathering = [t for t in self.__iceTransports if t.iceGatherer.state == "new"]
+        coros = map(lambda t: t.iceGatherer.gather(), gathering)
         await asyncio.gather(*coros)
+        if gathering:
+            self.emit("icecandidate", None)
+
+    def __gatheringDone(self, task: asyncio.Future) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            self.__log_debug("ICE gathering failed: %s", task.exception())
+            self.emit("icecandidateerror", task.exception())
+
+    def __emitIceCandidate(
+        self, dtlsTransport: RTCDtlsTransport, candidate: RTCIceCandidate
+    ) -> None:
+        if self.__sctp is not None and self.__sctp.transport is dtlsTransport:
+            candidate.sdpMid = self.__sctp.mid
+            candidate.sdpMLineIndex = self.__sctp_mline_index
+        else:
+            for transceiver in self.__transceivers:
+                if transceiver._transport is dtlsTransport:
+                    candidate.sdpMid = transceiver.mid
+                    candidate.sdpMLineIndex = transceiver._get_mline_index()
+                    break
+        self.emit("icecandidate", candidate)
 
     def __assertNotClosed(self) -> None:
         if self.__isClosed:
@@ -1020,6 +1067,10 @@ class RTCPeerConnection(AsyncIOEventEmitter):
         dtlsTransport = RTCDtlsTransport(iceTransport, self.__certificates)
         dtlsTransport.on("statechange", self.__updateConnectionState)
         self.__dtlsTransports.add(dtlsTransport)
+        iceGatherer.on(
+            "icecandidate",
+            lambda candidate: self.__emitIceCandidate(dtlsTransport, candidate),
+        )
 
         # update states
         self.__updateIceGatheringState()
@@ -1029,6 +1080,8 @@ class RTCPeerConnection(AsyncIOEventEmitter):
         return dtlsTransport
 
     def __createSctpTransport(self) -> None:
+        from .rtcsctptransport import RTCSctpTransport
+
         self.__sctp = RTCSctpTransport(self.__createDtlsTransport())
         self.__sctp._bundled = False
         self.__sctp.mid = None
@@ -14,6 +14,7 @@ from .mediastreams import EncodedStreamTrack, MediaStreamError, MediaStreamTrack
 from .rtcrtpparameters import RTCRtpCodecParameters, RTCRtpSendParameters
 from .rtp import (
     RTCP_PSFB_APP,
+    RTCP_PSFB_FIR,
     RTCP_PSFB_PLI,
     RTCP_RTPFB_NACK,
     AnyRtcpPacket,
@@ -91,12 +92,23 @@ class RTCRtpSender:
         self.__rtp_timestamp = 0
         self.__octet_count = 0
         self.__packet_count = 0
+        self.__nack_count = 0
+        self.__pli_count = 0
+        self.__fir_count = 0
         self.__rtt = None
+        self.__first_packet_time: Optional[float] = None
 
     @property
     def kind(self):
         return self.__kind
 
+    @property
+    def firstPacketTime(self) -> Optional[float]:
+        """
+        The :func:`time.monotonic` time the first RTP packet was sent at, `None` before.
+        """
+        return self.__first_packet_time
+
     @property
     def track(self) -> MediaStreamTrack:
         """
@@ -143,6 +155,9 @@ class RTCRtpSender:
                 bytesSent=self.__octet_count,
                 # RTCOutboundRtpStreamStats
                 trackId=str(id(self.track)),
+                nackCount=self.__nack_count,
+                pliCount=self.__pli_count,
+                firCount=self.__fir_count,
             )
         )
         self.__stats.update(self.transport._get_stats())
@@ -227,9 +242,15 @@ class RTCRtpSender:
                     )
                 )
         elif isinstance(packet, RtcpRtpfbPacket) and packet.fmt == RTCP_RTPFB_NACK:
+            self.__nack_count += 1
             for seq in packet.lost:
                 await self._retransmit(seq)
         elif isinstance(packet, RtcpPsfbPacket) and packet.fmt == RTCP_PSFB_PLI:
+            self.__pli_count += 1
+            self._send_keyframe()
+        elif isinstance(packet, RtcpPsfbPacket) and packet.fmt == RTCP_PSFB_FIR:
+            # full intra request (RFC 5104), answered like a PLI
+            self.__fir_count += 1
             self._send_keyframe()
         elif isinstance(packet, RtcpPsfbPacket) and packet.fmt == RTCP_PSFB_APP:
             try:
@@ -325,6 +346,8 @@ class RTCRtpSender:
                     self.__rtp_timestamp = packet.timestamp
                     self.__octet_count += len(payload)
                     self.__packet_count += 1
+                    if self.__first_packet_time is None:
+                        self.__first_packet_time = time.monotonic()
                     sequence_number = uint16_add(sequence_number, 1)
         except (asyncio.CancelledError, ConnectionError, MediaStreamError):
             pass
@@ -27,6 +27,7 @@ RTCP_RTPFB_NACK = 1
 RTCP_PSFB_PLI = 1
 RTCP_PSFB_SLI = 2
 RTCP_PSFB_RPSI = 3
+RTCP_PSFB_FIR = 4
 RTCP_PSFB_APP = 15
 
 
@@ -2,7 +2,7 @@ import ipaddress
 import re
 from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
 
 from . import rtp
 from .rtcdtlstransport import RTCDtlsFingerprint, RTCDtlsParameters
@@ -13,7 +13,10 @@ from .rtcrtpparameters import (
     RTCRtpHeaderExtensionParameters,
     RTCRtpParameters,
 )
-from .rtcsctptransport import RTCSctpCapabilities
+
+if TYPE_CHECKING:
+    # SCTP and data channels are only imported when an offer or answer has an application section
+    from .rtcsctptransport import RTCSctpCapabilities
 
 DIRECTIONS = ["inactive", "sendonly", "recvonly", "sendrecv"]
 
@@ -388,6 +391,8 @@ class SessionDescription:
                     elif attr == "ice-ufrag":
                         current_media.ice.usernameFragment = value
                     elif attr == "max-message-size":
+                        from .rtcsctptransport import RTCSctpCapabilities
+
                         current_media.sctpCapabilities = RTCSctpCapabilities(
                             maxMessageSize=int(value)
                         )
@@ -66,6 +66,9 @@ class RTCOutboundRtpStreamStats(RTCSentRtpStreamStats):
     """
 
     trackId: str
+    nackCount: int = 0
+    pliCount: int = 0
+    firCount: int = 0
 
 
 @dataclass
@@ -0,0 +1,121 @@
+"""
+Compare publisher launch paths: cold `python3 janus.py` subprocesses against
+processes forked from the preloaded zygote.
+
+For every publisher it reports the time from launch to `webrtc: up`, to the
+first RTP packet sent (polled through the IPC `stats` command), and its memory
+(RSS and, on Linux, PSS which accounts for copy-on-write sharing).
+
+Needs a reachable Janus server and RTSP camera, e.g.:
+
+    python3 benchmarks/bench_launch.py --janus ws://127.0.0.1:8188 \\
+        --rtsp rtsp://192.168.5.158:554/main.h264 --room 1234 -n 10
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from accrtsprtc import ControlServer, RTSPClient  # noqa: E402
+
+
+def memory_kb(pid):
+    """
+    (RSS, PSS) of `pid` in kB, both None when /proc/<pid>/smaps_rollup is not available.
+    """
+    rss = pss = None
+    try:
+        with open("/proc/{p}/smaps_rollup".format(p=pid)) as fp:
+            for line in fp:
+                if line.startswith("Rss:"):
+                    rss = int(line.split()[1])
+                elif line.startswith("Pss:"):
+                    pss = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, pss
+
+
+async def launch_one(control, index, args):
+    publisher = str(args.first_id + index)
+    client = RTSPClient(room=str(args.room), publisher=publisher, rtsp=args.rtsp,
+                        display="bench-" + publisher, mic="mute")
+    client.janus = args.janus
+    client.started = control.loop.create_future()
+    control.clients[publisher] = client
+
+    result = {"id": publisher, "up": None, "first_rtp": None, "rss": None, "pss": None}
+    begin = time.monotonic()
+    client.process = await control.launch_janus(client)
+    try:
+        success, _ = await asyncio.wait_for(asyncio.shield(client.started), args.timeout)
+    except asyncio.TimeoutError:
+        return result
+    if not success:
+        return result
+    result["up"] = time.monotonic() - begin
+
+    deadline = begin + args.timeout
+    while time.monotonic() < deadline:
+        control.send_command(client, "stats")
+        await asyncio.sleep(0.05)
+        if client.stats.get("packetsSent", 0) > 0:
+            result["first_rtp"] = time.monotonic() - begin
+            break
+
+    # let the stream settle before sampling memory
+    await asyncio.sleep(args.settle)
+    result["rss"], result["pss"] = memory_kb(client.process.pid)
+    return result
+
+
+def summary(name, values, unit, scale=1.0):
+    values = [v * scale for v in values if v is not None]
+    if not values:
+        return "{n:>12}: no samples".format(n=name)
+    return "{n:>12}: mean {m:9.1f} {u}  median {d:9.1f} {u}  max {x:9.1f} {u}  ({c} samples)".format(
+        n=name, m=statistics.mean(values), d=statistics.median(values), x=max(values), u=unit, c=len(values))
+
+
+async def run(mode, args):
+    control = ControlServer()
+    control.loop = asyncio.get_event_loop()
+    if mode == "forkserver":
+        from zygote import Zygote
+        control.zygote = Zygote()
+        begin = time.monotonic()
+        control.zygote.start()
+        print("zygote ready in {t:.2f}s".format(t=time.monotonic() - begin))
+
+    results = await asyncio.gather(*[launch_one(control, i, args) for i in range(args.count)])
+
+    for client in list(control.clients.values()):
+        control.kill_subprocess(client)
+    control.clients.clear()
+
+    print("== {m} ({n} publishers)".format(m=mode, n=args.count))
+    print(summary("webrtc up", [r["up"] for r in results], "ms", 1000))
+    print(summary("first RTP", [r["first_rtp"] for r in results], "ms", 1000))
+    print(summary("RSS", [r["rss"] for r in results], "MB", 1 / 1024))
+    print(summary("PSS", [r["pss"] for r in results], "MB", 1 / 1024))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publisher launch benchmark")
+    parser.add_argument("--janus", required=True, help="Janus root URL, e.g. ws://localhost:8188")
+    parser.add_argument("--rtsp", required=True, help="RTSP stream every publisher pushes")
+    parser.add_argument("--room", type=int, default=1234, help="Video room to publish in")
+    parser.add_argument("--first_id", type=int, default=900000, help="Publisher id of the first publisher")
+    parser.add_argument("-n", "--count", type=int, default=5, help="Publishers per launch path")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for each publisher")
+    parser.add_argument("--settle", type=float, default=3, help="Seconds to stream before sampling memory")
+    parser.add_argument("--modes", nargs="+", default=["process", "forkserver"],
+                        choices=["process", "forkserver"], help="Launch paths to compare")
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        asyncio.run(run(mode, args))
@@ -0,0 +1,81 @@
+"""
+Startup-time regression check for the publisher.
+
+Imports a module in a fresh interpreter with `python -X importtime`, fails
+when its cumulative import time exceeds the budget or when one of the
+optional subsystems that must stay lazy got imported on the way:
+
+    python3 benchmarks/check_importtime.py --budget 800
+    python3 benchmarks/check_importtime.py --module accrtsprtc --budget 900
+
+Exits with status 1 on a regression so it can gate CI. The import is run
+`--repeat` times and the fastest run is kept to filter out noise.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Optional subsystems a video-only RTSP publisher must not import at startup
+LAZY_MODULES = [
+    "aiortc.contrib.media",
+    "aiortc.rtcsctptransport",
+    "aiortc.rtcdatachannel",
+    "aiortc.codecs.opus",
+    "aiortc.codecs._opus",
+    "aiortc.codecs.vpx",
+    "aiortc.codecs.g711",
+]
+
+
+def import_times(module):
+    """
+    Run `import module` with -X importtime, returns {module name: cumulative microseconds}.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError("import {m} failed:\n{e}".format(m=module, e=result.stderr[-2000:]))
+
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue
+        times[fields[2].strip()] = cumulative
+    return times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time budget check")
+    parser.add_argument("--module", default="janus", help="Module to import (default: janus)")
+    parser.add_argument("--budget", type=float, default=800, help="Budget in milliseconds (default: 800)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs, the fastest one is kept")
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to list")
+    args = parser.parse_args()
+
+    runs = [import_times(args.module) for _ in range(max(1, args.repeat))]
+    best = min(runs, key=lambda t: t.get(args.module, 0))
+    total_ms = best.get(args.module, 0) / 1000
+
+    print("import {m}: {t:.1f} ms (budget {b:.1f} ms)".format(m=args.module, t=total_ms, b=args.budget))
+    for name, us in sorted(best.items(), key=lambda item: item[1], reverse=True)[1:args.top + 1]:
+        print("  {t:8.1f} ms  {n}".format(t=us / 1000, n=name))
+
+    failed = False
+    eager = [name for name in LAZY_MODULES if name in best]
+    if eager:
+        print("FAIL: optional modules imported eagerly: " + ", ".join(eager))
+        failed = True
+    if total_ms > args.budget:
+        print("FAIL: import time over budget by {t:.1f} ms".format(t=total_ms - args.budget))
+        failed = True
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,317 @@
+"""
+Stand-in for a Janus VideoRoom server, for load and latency tests without a
+Janus deployment.
+
+It speaks the subset of the Janus WebSocket API the publishers use: create,
+attach, join, configure, trickle, keepalive, detach and destroy. Each offer is
+answered by an aiortc receiver, so ICE, DTLS, SRTP and RTP run for real; the
+receiver decodes the video, counts frames and tracks the RTP arrival jitter
+(RFC 3550 estimator over frame timestamps).
+
+Serve only, publishers being started separately (e.g. by accrtsprtc.py with
+`janus=ws://127.0.0.1:8188`):
+
+    python3 benchmarks/fake_janus.py --port 8188
+
+Or start N publishers of an RTSP source against it and report their setup
+and reception once they streamed for `--duration` seconds:
+
+    python3 benchmarks/fake_janus.py --rtsp rtsp://127.0.0.1:8554/cam -n 20 --engine process
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiortc import RTCConfiguration, RTCPeerConnection, RTCSessionDescription  # noqa: E402
+from aiortc.sdp import candidate_from_sdp  # noqa: E402
+
+# Seconds an offer waits for the first trickled candidate before it is answered anyway
+TRICKLE_WAIT = 5
+
+ids = itertools.count(1000)
+
+
+class Receiver:
+    """
+    The receiving end of one publisher.
+    """
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+        # offline: host candidates only
+        self.pc = RTCPeerConnection(configuration=RTCConfiguration(iceServers=[]))
+        self.configured = None
+        self.first_frame = None
+        self.frames = 0
+        self.jitter = 0.0
+        self._transit = None
+        self._task = None
+        # candidates trickled before the offer, and set once one arrived
+        self.candidates = []
+        self.trickled = asyncio.Event()
+
+        @self.pc.on("track")
+        def on_track(track):
+            if track.kind == "video":
+                self._task = asyncio.ensure_future(self.consume(track))
+
+    async def consume(self, track):
+        while True:
+            try:
+                frame = await track.recv()
+            except Exception:
+                return
+            now = time.monotonic()
+            if self.first_frame is None:
+                self.first_frame = now
+            self.frames += 1
+            if frame.pts is None or frame.time_base is None:
+                continue
+            transit = now - float(frame.pts * frame.time_base)
+            if self._transit is not None:
+                self.jitter += (abs(transit - self._transit) - self.jitter) / 16
+            self._transit = transit
+
+    async def add_candidate(self, candidate):
+        if candidate.get("completed"):
+            return
+        sdp = candidate["candidate"]
+        if sdp.startswith("candidate:"):
+            sdp = sdp[len("candidate:"):]
+        ice = candidate_from_sdp(sdp)
+        ice.sdpMid = candidate.get("sdpMid")
+        ice.sdpMLineIndex = candidate.get("sdpMLineIndex")
+        if self.pc.remoteDescription is None:
+            self.candidates.append(ice)
+        else:
+            await self.pc.addIceCandidate(ice)
+        self.trickled.set()
+
+    async def answer(self, offer):
+        self.configured = time.monotonic()
+        await self.pc.setRemoteDescription(RTCSessionDescription(sdp=offer["sdp"], type=offer["type"]))
+        if offer.get("trickle", True):
+            # aioice gives up at once when it has no remote candidate to check
+            try:
+                await asyncio.wait_for(self.trickled.wait(), TRICKLE_WAIT)
+            except asyncio.TimeoutError:
+                pass
+        for candidate in self.candidates:
+            await self.pc.addIceCandidate(candidate)
+        self.candidates = []
+        await self.pc.setLocalDescription(await self.pc.createAnswer())
+        return {"type": self.pc.localDescription.type, "sdp": self.pc.localDescription.sdp}
+
+    def stats(self):
+        fps = None
+        if self.first_frame is not None and self.frames > 1:
+            elapsed = time.monotonic() - self.first_frame
+            fps = round((self.frames - 1) / elapsed, 1) if elapsed > 0 else None
+        return {
+            "frames": self.frames,
+            "fps": fps,
+            "first_frame": round(self.first_frame - self.configured, 3) if self.first_frame else None,
+            "jitter_ms": round(self.jitter * 1000, 2),
+        }
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self.pc.close()
+
+
+class FakeJanus:
+    def __init__(self):
+        # handle id -> `Receiver`, publisher id -> `Receiver` once joined
+        self.handles = {}
+        self.publishers = {}
+
+    async def serve(self, host, port):
+        return await websockets.serve(self.handle, host, port, subprotocols=["janus-protocol"])
+
+    async def handle(self, websocket, path=None):
+        session = None
+        handles = set()
+        tasks = set()
+
+        async def send(message):
+            if session is not None:
+                message.setdefault("session_id", session)
+            try:
+                await websocket.send(json.dumps(message))
+            except websockets.ConnectionClosed:
+                pass
+
+        try:
+            async for raw in websocket:
+                message = json.loads(raw)
+                janus = message.get("janus")
+                transaction = message.get("transaction")
+                handle = message.get("handle_id")
+                if janus == "create":
+                    session = next(ids)
+                    await send({"janus": "success", "transaction": transaction, "data": {"id": session}})
+                elif janus == "attach":
+                    handle = next(ids)
+                    handles.add(handle)
+                    self.handles[handle] = None
+                    await send({"janus": "success", "transaction": transaction, "data": {"id": handle}})
+                elif janus in ("keepalive", "trickle"):
+                    await send({"janus": "ack", "transaction": transaction})
+                    if janus == "trickle" and self.handles.get(handle) is not None:
+                        await self.handles[handle].add_candidate(message["candidate"])
+                elif janus == "message":
+                    await send({"janus": "ack", "transaction": transaction})
+                    # answering waits for candidates trickled after the offer, keep reading meanwhile
+                    task = asyncio.ensure_future(self.plugin_message(send, handle, message))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                elif janus == "detach":
+                    handles.discard(handle)
+                    await self.release(handle)
+                    await send({"janus": "success", "transaction": transaction})
+                elif janus == "destroy":
+                    await send({"janus": "success", "transaction": transaction})
+                else:
+                    await send({"janus": "error", "transaction": transaction,
+                                "error": {"code": 453, "reason": "Unknown request '{j}'".format(j=janus)}})
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            for handle in handles:
+                await self.release(handle)
+
+    async def plugin_message(self, send, handle, message):
+        body = message.get("body", {})
+        request = body.get("request")
+        reply = {"janus": "event", "sender": handle, "transaction": message.get("transaction"),
+                 "plugindata": {"plugin": "janus.plugin.videoroom", "data": {}}}
+        if request == "join":
+            publisher = str(body.get("id") or next(ids))
+            receiver = Receiver(publisher)
+            self.handles[handle] = receiver
+            self.publishers[publisher] = receiver
+
+            @receiver.pc.on("connectionstatechange")
+            async def on_connectionstatechange():
+                if receiver.pc.connectionState == "connected":
+                    await send({"janus": "webrtcup", "sender": handle})
+
+            reply["plugindata"]["data"] = {"videoroom": "joined", "room": body.get("room"), "id": int(publisher),
+                                           "publishers": []}
+        elif request == "configure" and self.handles.get(handle) is not None:
+            reply["plugindata"]["data"] = {"videoroom": "event", "room": body.get("room"), "configured": "ok"}
+            if "jsep" in message:
+                reply["jsep"] = await self.handles[handle].answer(message["jsep"])
+        else:
+            reply["plugindata"]["data"] = {"videoroom": "event", "error_code": 499,
+                                           "error": "Unsupported request '{r}'".format(r=request)}
+        await send(reply)
+
+    async def release(self, handle):
+        receiver = self.handles.pop(handle, None)
+        if receiver is not None:
+            await receiver.close()
+
+    def report(self):
+        return {publisher: receiver.stats() for publisher, receiver in self.publishers.items()}
+
+
+def summary(name, values, unit, scale=1.0):
+    values = [v * scale for v in values if v is not None]
+    if not values:
+        return "{n:>14}: no samples".format(n=name)
+    return "{n:>14}: mean {m:9.1f} {u}  median {d:9.1f} {u}  max {x:9.1f} {u}  ({c} samples)".format(
+        n=name, m=statistics.mean(values), d=statistics.median(values), x=max(values), u=unit, c=len(values))
+
+
+async def bench(fake, args):
+    from accrtsprtc import ControlServer, RTSPClient
+
+    control = ControlServer()
+    control.loop = asyncio.get_event_loop()
+    if args.engine == "inprocess":
+        from engine import PublisherEngine
+        control.engine = PublisherEngine(on_event=control.engine_msg, on_stats=control.engine_stats)
+        control.engine.start()
+
+    async def launch(index):
+        publisher = str(args.first_id + index)
+        client = RTSPClient(room=str(args.room), publisher=publisher, rtsp=args.rtsp,
+                            display="bench-" + publisher, mic="mute")
+        client.janus = "ws://127.0.0.1:{p}".format(p=args.port)
+        client.started = control.loop.create_future()
+        control.clients[publisher] = client
+        client.process = await control.launch_janus(client)
+        try:
+            await asyncio.wait_for(asyncio.shield(client.started), args.timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    await asyncio.gather(*[launch(i) for i in range(args.count)])
+    await asyncio.sleep(args.duration)
+
+    timelines = [client.timeline for client in control.clients.values()]
+    received = fake.report()
+    for client in list(control.clients.values()):
+        control.kill_subprocess(client)
+    control.clients.clear()
+    if control.engine is not None:
+        control.engine.shutdown()
+
+    print("== {n} publishers ({e})".format(n=args.count, e=args.engine))
+    for phase in ["janus_session", "joined", "rtsp_opened", "offer_sent", "ice_connected", "dtls_connected",
+                  "first_rtp_sent", "webrtc_up"]:
+        print(summary(phase, [timeline.get(phase) for timeline in timelines], "ms", 1000))
+    print(summary("first frame", [r["first_frame"] for r in received.values()], "ms", 1000))
+    print(summary("fps", [r["fps"] for r in received.values()], "fps"))
+    print(summary("jitter", [r["jitter_ms"] for r in received.values()], "ms"))
+
+
+async def main(args):
+    fake = FakeJanus()
+    server = await fake.serve(args.host, args.port)
+    print("Fake Janus listening on ws://{h}:{p}".format(h=args.host, p=args.port))
+    try:
+        if args.rtsp:
+            await bench(fake, args)
+            return
+        while True:
+            await asyncio.sleep(args.interval)
+            for publisher, stats in fake.report().items():
+                print(publisher, stats)
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Janus VideoRoom server")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8188, help="Port to listen on")
+    parser.add_argument("--interval", type=float, default=5, help="Seconds between receiver reports when serving")
+    parser.add_argument("--rtsp", help="Start publishers of this RTSP stream and report, instead of only serving")
+    parser.add_argument("-n", "--count", type=int, default=10, help="Publishers to start")
+    parser.add_argument("--engine", default="process", choices=["process", "inprocess"],
+                        help="How the publishers are hosted")
+    parser.add_argument("--room", type=int, default=1234, help="Video room to publish in")
+    parser.add_argument("--first_id", type=int, default=900000, help="Publisher id of the first publisher")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for each publisher")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to stream before reporting")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,115 @@
+"""
+DTLS certificate reused by every peer connection.
+
+aiortc generates a new key and self-signed certificate for each
+RTCPeerConnection. The store hands out one certificate instead, kept in
+memory for the connections of a process and, when `ACCRTSPRTC_CERT_DIR` is
+set, in a file of that directory shared by every publisher process (and
+inherited by the forkserver and pool workers). A certificate is replaced
+`ROTATE_BEFORE` its expiry, connections already using it are not affected.
+"""
+import datetime
+import os
+
+from logpipe import timestamped_print as print
+
+# Directory of the shared certificate, inherited by every publisher process
+DIRECTORY_ENV = "ACCRTSPRTC_CERT_DIR"
+CERTIFICATE_FILE = "dtls.pem"
+# aiortc certificates are valid 30 days
+ROTATE_BEFORE = datetime.timedelta(days=7)
+
+
+class CertificateStore:
+    def __init__(self, directory=None, margin=ROTATE_BEFORE):
+        self.directory = directory
+        self.margin = margin
+        self._certificate = None
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, CERTIFICATE_FILE) if self.directory else None
+
+    def get(self):
+        """
+        A certificate valid for at least `margin`, loaded or generated when the cached one is not.
+        """
+        if not self.fresh(self._certificate):
+            certificate = self.load()
+            if not self.fresh(certificate):
+                certificate = self.generate()
+            self._certificate = certificate
+        return self._certificate
+
+    def fresh(self, certificate):
+        if certificate is None:
+            return False
+        return certificate.expires - datetime.datetime.now(datetime.timezone.utc) > self.margin
+
+    def load(self):
+        if self.path is None:
+            return None
+        from aiortc import RTCCertificate
+        from cryptography import x509
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        try:
+            with open(self.path, "rb") as fp:
+                data = fp.read()
+            key = serialization.load_pem_private_key(data, password=None, backend=default_backend())
+            cert = x509.load_pem_x509_certificate(data, default_backend())
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print("DTLS certificate load exception: ", e)
+            return None
+        return RTCCertificate(key=key, cert=cert)
+
+    def generate(self):
+        from aiortc import RTCCertificate
+        certificate = RTCCertificate.generateCertificate()
+        if self.path is not None:
+            try:
+                self.save(certificate)
+            except OSError as e:
+                print("DTLS certificate save exception: ", e)
+        return certificate
+
+    def save(self, certificate):
+        """
+        Write the key and certificate, replacing the file atomically: processes
+        rotating at the same time each keep a valid certificate, the last one wins.
+        """
+        from cryptography.hazmat.primitives import serialization
+        os.makedirs(self.directory, exist_ok=True)
+        data = certificate._key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        ) + certificate._cert.public_bytes(serialization.Encoding.PEM)
+        temporary = "{p}.{pid}.tmp".format(p=self.path, pid=os.getpid())
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temporary, self.path)
+
+
+STORE = CertificateStore(os.environ.get(DIRECTORY_ENV) or None)
+
+
+def configure(directory):
+    """
+    Keep the certificate in `directory`, for this process and the publisher processes it starts.
+    """
+    directory = os.path.abspath(directory)
+    os.environ[DIRECTORY_ENV] = directory
+    STORE.directory = directory
+    STORE._certificate = None
+
+
+def certificate():
+    """
+    The DTLS certificate for a new peer connection.
+    """
+    return STORE.get()
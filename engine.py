@@ -0,0 +1,123 @@
+import asyncio
+import functools
+import threading
+
+from janus import JanusGateway, WebRTCClient
+from logpipe import timestamped_print as print
+
+
+class PublisherEngine(threading.Thread):
+    """
+    Hosts many publishers inside a single asyncio event loop, instead of
+    starting one `janus.py` process per camera.
+
+    `on_event` is called as `on_event(type, data, publisher, generation)` from the
+    engine thread, with the same events `janus.py` reports over its IPC channel,
+    plus `exit` when a publisher ends without being killed. `generation` is the one of
+    the client when it was launched, telling the events of a killed instance apart.
+    `on_stats` is called as `on_stats(stats, publisher)` after `request_stats`.
+    With `share_sessions`, publishers of the same Janus server share one
+    WebSocket and Janus session (see `JanusSession`).
+    """
+
+    def __init__(self, on_event, on_stats=None, share_sessions=True):
+        threading.Thread.__init__(self)
+        self.name = "PublisherEngine"
+        self.daemon = True
+        self.on_event = on_event
+        self.on_stats = on_stats
+        self.share_sessions = share_sessions
+        self.loop = asyncio.new_event_loop()
+        # publisher id -> running `WebRTCClient.run` task
+        self.tasks = {}
+        # publisher id -> its `WebRTCClient`
+        self.rtc_clients = {}
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def launch(self, client):
+        """
+        Start publishing `client` (an accrtsprtc `RTSPClient`), safe to call from any thread.
+        """
+        self.loop.call_soon_threadsafe(self._launch, client)
+
+    def restart(self, client):
+        """
+        Tear down and start `client` again, safe to call from any thread.
+        """
+        self.loop.call_soon_threadsafe(self._launch, client)
+
+    def kill(self, publisher):
+        """
+        Stop publishing `publisher`, safe to call from any thread.
+        """
+        self.loop.call_soon_threadsafe(self._kill, publisher)
+
+    def request_stats(self):
+        """
+        Report the counters of every publisher to `on_stats`, safe to call from any thread.
+        """
+        asyncio.run_coroutine_threadsafe(self._report_stats(), self.loop)
+
+    def shutdown(self, timeout=10):
+        future = asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+        try:
+            future.result(timeout)
+        except Exception as e:
+            print("Publisher engine shutdown exception: ", e)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _launch(self, client):
+        self._kill(client.publisher)
+
+        signaling = JanusGateway(client.janus, shared=self.share_sessions)
+        on_event = functools.partial(self._event, client.generation)
+        rtc_client = WebRTCClient(signaling, client.rtsp, client.mic, client.publisher, on_event=on_event)
+        if client.turn is not None and client.turn_user is not None and client.turn_passwd is not None:
+            rtc_client.turn = client.turn
+            rtc_client.turn_user = client.turn_user
+            rtc_client.turn_passwd = client.turn_passwd
+        rtc_client.stun = client.stun
+
+        task = self.loop.create_task(rtc_client.run(room=client.room, display=client.display))
+        task.add_done_callback(lambda t: self._forget(client.publisher, t, client.generation))
+        self.tasks[client.publisher] = task
+        self.rtc_clients[client.publisher] = rtc_client
+
+    def _kill(self, publisher):
+        task = self.tasks.pop(publisher, None)
+        self.rtc_clients.pop(publisher, None)
+        if task is not None:
+            task.cancel()
+
+    def _event(self, generation, type, data, publisher):
+        self.on_event(type, data, publisher, generation)
+
+    def _forget(self, publisher, task, generation):
+        if self.tasks.get(publisher) is task:
+            self.tasks.pop(publisher, None)
+            self.rtc_clients.pop(publisher, None)
+            # not killed: it ended on its own, like a publisher process exiting
+            try:
+                self.on_event('exit', 'ended', publisher, generation)
+            except Exception as e:
+                print("Publisher exit event exception: ", e)
+
+    async def _report_stats(self):
+        if self.on_stats is None:
+            return
+        for publisher, rtc_client in list(self.rtc_clients.items()):
+            try:
+                self.on_stats(await rtc_client.get_stats(), publisher)
+            except Exception as e:
+                print("Publisher stats exception: ", e)
+
+    async def _shutdown(self):
+        tasks = list(self.tasks.values())
+        self.tasks.clear()
+        self.rtc_clients.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,5 +1,6 @@
 import asyncio
 import math
+import time
 import av
 from queue import Queue
 from struct import pack
@@ -8,6 +9,7 @@ from typing import Iterator, List, Tuple, Optional
 from aiortc.mediastreams import EncodedStreamTrack
 from aiortc.mediastreams import VIDEO_TIME_BASE, convert_timebase
 from streamplayer import StreamPlayer
+from logpipe import print_limited, timestamped_print as print
 from av import Packet
 from av.filter import Graph
 
@@ -21,6 +23,17 @@ FU_A_HEADER_SIZE = 2
 LENGTH_FIELD_SIZE = 2
 STAP_A_HEADER_SIZE = NAL_HEADER_SIZE + LENGTH_FIELD_SIZE
 
+NAL_TYPE_SPS = 7
+# How much faster than real time a cached GOP is sent, by bytes against the stream bitrate
+BURST_SPEED = 3
+# Seconds between two recoveries on PLI/FIR, the one in progress covers the requests meanwhile
+PLI_INTERVAL = 1.0
+# Largest and oldest (seconds of stream since its keyframe) cached GOP sent again on PLI/FIR.
+# Every viewer gets the resend, Janus asks for a keyframe on each new subscriber: beyond these
+# the live frames go on and the requester recovers at the camera's next keyframe
+RESEND_MAX_BYTES = 512 * 1024
+RESEND_MAX_AGE = 0.5
+
 
 class H264EncodedStreamTrack(EncodedStreamTrack):
     kind = "video"
@@ -35,6 +48,9 @@ class H264EncodedStreamTrack(EncodedStreamTrack):
         self._frame_time = 1 / video_rate
         self._clock_rate = clock_rate
         self.nal_buffer = None
+        # time.monotonic() of the last PLI/FIR acted on, and dropping frames until a keyframe
+        self._last_recovery = None
+        self._skipping = False
         print("Init h264 codec successfully.")
 
     def write(self, buf: bytes):
@@ -172,13 +188,27 @@ class H264EncodedStreamTrack(EncodedStreamTrack):
             if buf_type != 0x06:  # Make sure to discard SEI NALUs
                 yield buf[nal_start:nal_end]
 
+    def _keyframe_due(self):
+        """
+        Whether to act on a PLI/FIR now, at most once per `PLI_INTERVAL`.
+        """
+        now = time.monotonic()
+        if self._last_recovery is not None and now - self._last_recovery < PLI_INTERVAL:
+            return False
+        self._last_recovery = now
+        return True
+
     async def recv_encoded(self, keyframe=False):
+        if keyframe and self._keyframe_due():
+            # P-frames cannot be decoded until the next keyframe, do not send them
+            self._skipping = True
         while True:
             if self.nal_queue.empty():
                 await asyncio.sleep(self._frame_time)
                 continue
             nal = self.nal_queue.get()
-            if (nal[4] & 0x1F) != 0x01 or not keyframe:
+            if (nal[4] & 0x1F) != 0x01 or not self._skipping:
+                self._skipping = False
                 break
         packets = self._packetize(self._split_bitstream(nal))
         if len(packets) > 0:
@@ -193,15 +223,94 @@ class FFmpegH264Track(H264EncodedStreamTrack):
     def __init__(self, player: StreamPlayer):
         super().__init__()
         self.player = player
-        player.start()
+        # cached GOP still to send, None until the first frame is asked for, and the dts it ends at
+        self._burst = None
+        self._burst_dts = None
+        # time.monotonic() the burst started, bytes sent since and bytes per second allowed (None: unpaced)
+        self._burst_start = None
+        self._burst_sent = 0
+        self._burst_rate = None
+        # RTP timestamp of the last frame sent, and of the next one while a GOP is sent again
+        self._sent_timestamp = None
+        self._restamp = None
+        # a republished connection gets a new track on the running player
+        if not player.started:
+            player.start()
 
     async def recv_encoded(self, keyframe=False):
+        if self._burst is None:
+            # start on the last keyframe rather than wait for the next one
+            self._burst = self.player.cached_gop()
+            if self._burst:
+                self._burst_dts = self._burst[-1].dts
+                self._pace(self._burst)
+                return self._send_burst(parameter_sets=self.player.parameter_sets)
+        elif keyframe and self._keyframe_due():
+            gop = self.player.cached_gop()
+            if gop and self._sent_timestamp is not None and self._resendable(gop):
+                # the GOP again, stamped right after the last frame sent so that the
+                # receiver neither drops it as late nor waits for it: references are
+                # rebuilt at once and the live frames follow
+                self._burst = gop
+                self._burst_dts = max(self._burst_dts, gop[-1].dts) if self._burst_dts is not None else gop[-1].dts
+                self._restamp = self._sent_timestamp + 1
+                self._pace(self._burst)
+                return self._send_burst(parameter_sets=self.player.parameter_sets)
+        if self._burst:
+            delay = self._burst_start + self._burst_sent / self._burst_rate - time.monotonic() \
+                if self._burst_rate else 0
+            # a zero sleep still lets the other tracks of the loop send
+            await asyncio.sleep(max(delay, 0))
+            return self._send_burst()
+        self._restamp = None
         while True:
             packet = await self.player.packets.get()
-            if packet.dts is not None:
-                break
-        timestamp = convert_timebase(packet.pts, packet.time_base, VIDEO_TIME_BASE)
-        packets = self._packetize(self._split_bitstream(packet.to_bytes()))
+            if packet.dts is None:
+                continue
+            # already sent from the cache
+            if self._burst_dts is not None and packet.dts <= self._burst_dts:
+                continue
+            break
+        return self._encode(packet)
+
+    @staticmethod
+    def _resendable(gop):
+        """
+        Whether `gop` is small and recent enough to be replayed to every viewer.
+        """
+        age = float((gop[-1].dts - gop[0].dts) * gop[0].time_base)
+        return age <= RESEND_MAX_AGE and sum(p.size for p in gop) <= RESEND_MAX_BYTES
+
+    def _pace(self, gop):
+        """
+        Start sending `gop` at `BURST_SPEED` times the stream bitrate, measured on the
+        last complete GOP or else on `gop` itself.
+        """
+        bitrate = self.player.bitrate
+        if bitrate is None and len(gop) > 1:
+            span = float((gop[-1].dts - gop[0].dts) * gop[0].time_base)
+            if span > 0:
+                bitrate = sum(p.size for p in gop[:-1]) / span
+        self._burst_rate = bitrate * BURST_SPEED if bitrate else None
+        self._burst_start = time.monotonic()
+        self._burst_sent = 0
+
+    def _send_burst(self, parameter_sets=b""):
+        packet = self._burst.pop(0)
+        self._burst_sent += packet.size
+        return self._encode(packet, parameter_sets=parameter_sets)
+
+    def _encode(self, packet, parameter_sets=b""):
+        data = packet.to_bytes()
+        if parameter_sets and not any((nal[0] & 0x1F) == NAL_TYPE_SPS for nal in self._split_bitstream(data)):
+            data = parameter_sets + data
+        if self._restamp is not None:
+            timestamp = self._restamp
+            self._restamp += 1
+        else:
+            timestamp = convert_timebase(packet.pts, packet.time_base, VIDEO_TIME_BASE)
+        self._sent_timestamp = timestamp
+        packets = self._packetize(self._split_bitstream(data))
         return packets, timestamp
 
 
@@ -302,18 +411,18 @@ class MixTrack(H264EncodedStreamTrack):
             if frame is not None:
                 encoded_packets = self.__out_video_stream.encode(frame)
                 if len(encoded_packets) > 0:
-                    print("----------- Merged Frame ----------")
+                    print_limited((id(self), "merged"), "----------- Merged Frame ----------")
                     encoded_packet = encoded_packets[0]
                     self.__record_container.mux(encoded_packet)
                     packets = self._packetize(self._split_bitstream(encoded_packet.to_bytes()))
                     timestamp = convert_timebase(encoded_packet.pts, encoded_packet.time_base, VIDEO_TIME_BASE)
                 else:
-                    print("----------- Encode Failed ----------")
+                    print_limited((id(self), "encode failed"), "----------- Encode Failed ----------")
                     packets = self._packetize(self._split_bitstream(packet.to_bytes()))
                     timestamp = convert_timebase(packet.pts, packet.time_base, VIDEO_TIME_BASE)
                 return packets, timestamp
             else:
-                print("----------- Camera Only ----------")
+                print_limited((id(self), "camera only"), "----------- Camera Only ----------")
                 timestamp = convert_timebase(packet.pts, packet.time_base, VIDEO_TIME_BASE)
                 packets = self._packetize(self._split_bitstream(packet.to_bytes()))
                 return packets, timestamp
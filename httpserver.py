@@ -0,0 +1,261 @@
+import asyncio
+import json
+
+from email.parser import BytesParser
+from email.policy import HTTP
+from http import HTTPStatus
+from urllib.parse import parse_qsl
+
+from logpipe import timestamped_print as print
+
+MAX_HEADER_LINES = 100
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+
+class BadRequest(ValueError):
+    """
+    The request cannot be understood, answered with 400 also when a handler raises it.
+    """
+
+
+class Request:
+    def __init__(self, method, target, version, headers, body=b""):
+        self.method = method
+        self.target = target
+        self.version = version
+        # header names are lower-cased
+        self.headers = headers
+        self.body = body
+
+        self.path, _, self.query_string = target.partition('?')
+        self.query = dict(parse_qsl(self.query_string, keep_blank_values=True))
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    @property
+    def content_type(self):
+        return self.headers.get("content-type", "")
+
+    def json(self):
+        try:
+            return json.loads(self.body.decode("utf-8"))
+        except ValueError as e:
+            raise BadRequest("Malformed JSON body: {e}".format(e=e))
+
+    def form(self):
+        """
+        Decode an urlencoded, multipart or JSON object body into a flat dict of strings.
+        """
+        content_type = self.content_type.lower()
+        if content_type.startswith("multipart/form-data"):
+            return self._multipart_form()
+        if content_type.startswith("application/json"):
+            data = self.json()
+            if not isinstance(data, dict):
+                raise BadRequest("JSON body must be an object")
+            return {str(k): str(v) for k, v in data.items()}
+        try:
+            return dict(parse_qsl(self.body.decode("utf-8"), keep_blank_values=True))
+        except UnicodeDecodeError:
+            raise BadRequest("Form body is not UTF-8")
+
+    def _multipart_form(self):
+        head = "Content-Type: {t}\r\n\r\n".format(t=self.content_type).encode("latin-1")
+        message = BytesParser(policy=HTTP).parsebytes(head + self.body)
+        if not message.is_multipart():
+            raise BadRequest("Malformed multipart body")
+        form = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name is None:
+                continue
+            payload = part.get_payload(decode=True) or b""
+            form[name] = payload.decode(part.get_content_charset() or "utf-8")
+        return form
+
+
+class Response:
+    def __init__(self, status=200, body=b"", content_type="text/html", headers=None):
+        self.status = status
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.body = body
+        self.headers = {"Content-Type": content_type}
+        if headers:
+            self.headers.update(headers)
+
+    @classmethod
+    def json(cls, obj, status=200):
+        return cls(status, json.dumps(obj, indent=4).encode(encoding='utf_8'), content_type="application/json")
+
+    @classmethod
+    def error(cls, status, message=None):
+        if message is None:
+            message = HTTPStatus(status).phrase
+        return cls(status, "{c} {m}".format(c=status, m=message), content_type="text/plain")
+
+    def framing_header(self):
+        return "Content-Length: {l}".format(l=len(self.body))
+
+    def head(self, keep_alive):
+        lines = ["HTTP/1.1 {c} {r}".format(c=self.status, r=HTTPStatus(self.status).phrase)]
+        for name, value in self.headers.items():
+            lines.append("{n}: {v}".format(n=name, v=value))
+        framing = self.framing_header()
+        if framing is not None:
+            lines.append(framing)
+        lines.append("Connection: {c}".format(c="keep-alive" if keep_alive else "close"))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def write(self, writer, keep_alive, version="HTTP/1.1"):
+        """
+        Send the response, returns whether the connection can take another request.
+        """
+        writer.write(self.head(keep_alive) + self.body)
+        await writer.drain()
+        return keep_alive
+
+
+class StreamResponse(Response):
+    """
+    Response whose body is produced by the async iterator `chunks` (of str or bytes),
+    each chunk is sent with chunked transfer encoding as soon as it is ready.
+    HTTP/1.0 has no chunked encoding: the body then ends when the connection is closed.
+    """
+
+    def __init__(self, chunks, status=200, content_type="application/x-ndjson", headers=None):
+        super().__init__(status, content_type=content_type, headers=headers)
+        self.chunks = chunks
+        self.chunked = True
+
+    def framing_header(self):
+        return "Transfer-Encoding: chunked" if self.chunked else None
+
+    async def write(self, writer, keep_alive, version="HTTP/1.1"):
+        self.chunked = version != "HTTP/1.0"
+        keep_alive = keep_alive and self.chunked
+        writer.write(self.head(keep_alive))
+        try:
+            async for chunk in self.chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                if not chunk:
+                    continue
+                writer.write(b"%x\r\n" % len(chunk) + chunk + b"\r\n" if self.chunked else chunk)
+                await writer.drain()
+        finally:
+            # run the producer's cleanup now when the client went away
+            if hasattr(self.chunks, "aclose"):
+                await self.chunks.aclose()
+        if self.chunked:
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        return keep_alive
+
+
+class HTTPServer:
+    """
+    Minimal asyncio HTTP/1.1 server with keep-alive connections.
+
+    `handler` is a coroutine function receiving a `Request` and returning a `Response`.
+    """
+
+    def __init__(self, handler, idle_timeout=75):
+        self.handler = handler
+        self.idle_timeout = idle_timeout
+        self.server = None
+        self._stopping = False
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self._serve, host, port)
+        return self.server
+
+    async def serve_forever(self):
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                if not self._stopping:
+                    raise
+
+    def stop(self):
+        """
+        Stop accepting connections, `serve_forever` returns.
+        """
+        self._stopping = True
+        self.server.close()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), self.idle_timeout)
+                except (BadRequest, ValueError) as e:
+                    await Response.error(400, str(e)).write(writer, False)
+                    break
+                if request is None:
+                    break
+
+                try:
+                    response = await self.handler(request)
+                except BadRequest as e:
+                    response = Response.error(400, str(e))
+                except Exception as e:
+                    print("Response error", e)
+                    response = Response.error(500, "Internal error")
+
+                keep_alive = await response.write(writer, request.keep_alive, request.version)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise BadRequest("Malformed request line")
+
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, sep, value = line.decode("latin-1").partition(":")
+            if not sep:
+                raise BadRequest("Malformed header line")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise BadRequest("Too many headers")
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # skip trailers
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                body += await reader.readexactly(size)
+                await reader.readline()
+                if len(body) > MAX_BODY_SIZE:
+                    raise BadRequest("Body too large")
+        else:
+            length = int(headers.get("content-length", 0) or 0)
+            if length > MAX_BODY_SIZE:
+                raise BadRequest("Body too large")
+            body = await reader.readexactly(length) if length > 0 else b""
+
+        return Request(method.upper(), target, version.upper(), headers, body)
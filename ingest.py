@@ -0,0 +1,234 @@
+"""
+Demux threads shared by the RTSP streams of a process.
+
+Instead of a thread per `StreamPlayer`, a fixed pool of threads serves every
+stream in turns: a thread takes the stream that has been ready longest, reads
+at most `SLICE_PACKETS` packets or `SLICE` seconds from it and queues it again
+behind the others. RTSP over TCP reads block until the stream's next packet:
+a stream that is behind is read at once, a caught-up camera holds the thread
+for at most a frame interval, and a silent one for the read timeout of the
+player, after which it gives the thread back and waits up to `IDLE_MAX`
+before its next turn. A stream is ended as stalled after `STALL_TIMEOUT`
+seconds silent in its own reads and waits; time spent queued behind other
+streams is not charged to it. A watchdog ends the streams whose read did not
+return for `STALL_TIMEOUT` seconds. The pool size comes from
+`ACCRTSPRTC_DEMUX_THREADS`, inherited by the publisher processes, and threads
+are only started as streams are added.
+
+Packets reach the event loop through a `PacketBuffer` per stream.
+"""
+import collections
+import itertools
+import os
+import queue
+import threading
+import time
+
+from logpipe import timestamped_print as print
+
+THREADS_ENV = "ACCRTSPRTC_DEMUX_THREADS"
+DEFAULT_THREADS = 4
+# Most packets and seconds of a turn
+SLICE_PACKETS = 8
+SLICE = 0.02
+# Seconds before a stream that had nothing to read is read again, doubled for each turn in a row without
+# a packet up to `IDLE_MAX`
+IDLE_WAIT = 0.005
+IDLE_MAX = 1.0
+# Seconds silent before a stream is ended, and between two checks of the watchdog
+STALL_TIMEOUT = 10
+WATCH_INTERVAL = 1
+# Bytes of packets waiting for the event loop, per stream
+BUFFER_BUDGET = 2 * 1024 * 1024
+
+
+class DemuxReactor:
+    def __init__(self, threads=DEFAULT_THREADS):
+        self.threads = threads
+        # (time the stream can be read, sequence, `StreamPlayer`)
+        self._ready = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._workers = []
+        self._lock = threading.Lock()
+        # streams added and not closed yet, for the watchdog
+        self._players = set()
+        # `StreamPlayer` -> turns in a row without a packet
+        self._idle_turns = {}
+        self._watchdog = None
+
+    def add(self, player):
+        """
+        Read `player` until it stops or ends.
+        """
+        with self._lock:
+            self._players.add(player)
+            if self._watchdog is None:
+                self._watchdog = threading.Thread(target=self._watch, name="DemuxWatchdog", daemon=True)
+                self._watchdog.start()
+            if len(self._workers) < self.threads:
+                worker = threading.Thread(target=self._work, name="Demux-{n}".format(n=len(self._workers)),
+                                          daemon=True)
+                self._workers.append(worker)
+                worker.start()
+        self._schedule(player, time.monotonic())
+
+    def _schedule(self, player, when):
+        self._ready.put((when, next(self._sequence), player))
+
+    def _work(self):
+        while True:
+            when, _, player = self._ready.get()
+            delay = when - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if not player.isRunning:
+                self._close(player)
+                continue
+            try:
+                read = self._serve(player)
+            except Exception as e:
+                print("Demux exception: ", e, "rtsp=" + player.rtsp)
+                player.end("ended")
+                self._close(player)
+                continue
+            self._schedule(player, time.monotonic() + (0 if read else self._idle(player)))
+
+    def _idle(self, player):
+        """
+        Seconds `player`, which had nothing to read, waits before its next turn. They count
+        as silent, with its reads: past `STALL_TIMEOUT` the stream is ended.
+        """
+        turns = self._idle_turns.get(player, 0)
+        self._idle_turns[player] = turns + 1
+        wait = min(IDLE_WAIT * 2 ** turns, IDLE_MAX)
+        player.silent += wait
+        if player.silent > STALL_TIMEOUT and player.isRunning:
+            print("RTSP stream stalled for {t}s: {r}".format(t=STALL_TIMEOUT, r=player.rtsp))
+            player.end("stalled")
+        return wait
+
+    def _close(self, player):
+        # closed here rather than by `stop`, never in the middle of a read
+        with self._lock:
+            self._players.discard(player)
+        self._idle_turns.pop(player, None)
+        player.close()
+
+    def _serve(self, player):
+        """
+        One turn of `player`, returns whether it read anything.
+        """
+        begin = time.monotonic()
+        read = 0
+        while read < SLICE_PACKETS and player.isRunning and player.read():
+            read += 1
+            if time.monotonic() - begin > SLICE:
+                break
+        if read:
+            self._idle_turns.pop(player, None)
+        return read > 0
+
+    def _watch(self):
+        """
+        End the streams whose read has not returned for `STALL_TIMEOUT` seconds, the read
+        timeout did not interrupt it: their publisher is restarted without waiting for it.
+        """
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            now = time.monotonic()
+            with self._lock:
+                players = list(self._players)
+            for player in players:
+                reading_since = player.reading_since
+                if player.isRunning and reading_since is not None and now - reading_since > STALL_TIMEOUT:
+                    print("RTSP read blocked for {t}s: {r}".format(t=STALL_TIMEOUT, r=player.rtsp))
+                    player.end("stalled")
+
+
+class PacketBuffer:
+    """
+    Packets handed from a demux thread to the event loop.
+
+    `put` appends to a deque and wakes the loop with `call_soon_threadsafe`
+    only when no wakeup is pending, so the loop takes the packets in batches
+    instead of paying a coroutine, a future and a wakeup per packet. At most
+    `budget` bytes wait for the consumer: past it packets are dropped up to the
+    next keyframe, the frames in between could not be decoded anyway.
+    """
+
+    def __init__(self, loop, budget=BUFFER_BUDGET):
+        self.loop = loop
+        self.budget = budget
+        self._packets = collections.deque()
+        self._waiter = None
+        self._wakeup_pending = False
+        self._dropping = False
+        # bytes put and taken, each written by a single thread
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def put(self, packet):
+        """
+        Queue `packet`, from the demux thread. Returns False when it was dropped.
+        """
+        if self._dropping and not packet.is_keyframe:
+            return False
+        if self.bytes_in - self.bytes_out + packet.size > self.budget:
+            self._dropping = True
+            return False
+        self._dropping = False
+        self.bytes_in += packet.size
+        self._packets.append(packet)
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self.loop.call_soon_threadsafe(self._wakeup)
+        return True
+
+    def _wakeup(self):
+        # cleared first: a packet put from now on schedules another wakeup
+        self._wakeup_pending = False
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def get(self):
+        while not self._packets:
+            self._waiter = self.loop.create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self.get_nowait()
+
+    def get_nowait(self):
+        packet = self._packets.popleft()
+        self.bytes_out += packet.size
+        return packet
+
+    def clear(self):
+        while self._packets:
+            self.get_nowait()
+
+    def qsize(self):
+        return len(self._packets)
+
+    def empty(self):
+        return not self._packets
+
+    @property
+    def queued_bytes(self):
+        return self.bytes_in - self.bytes_out
+
+
+REACTOR = DemuxReactor(int(os.environ.get(THREADS_ENV) or DEFAULT_THREADS))
+
+
+def configure(threads):
+    """
+    Serve the streams of this process, and of the publisher processes it starts, with `threads` threads.
+    """
+    os.environ[THREADS_ENV] = str(threads)
+    REACTOR.threads = threads
+
+
+def reactor():
+    return REACTOR
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import socket
+import struct
+import threading
+
+from logpipe import timestamped_print as print
+
+# Every message is a JSON object prefixed with its length as a big-endian uint32.
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class FrameError(Exception):
+    pass
+
+
+def encode_frame(message):
+    payload = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    return HEADER.pack(len(payload)) + payload
+
+
+def decode_payload(payload):
+    message = json.loads(payload.decode("utf-8"))
+    if not isinstance(message, dict):
+        raise FrameError("Frame payload must be a JSON object")
+    return message
+
+
+def check_size(size):
+    if size > MAX_FRAME_SIZE:
+        raise FrameError("Frame of {s} bytes exceeds the limit".format(s=size))
+
+
+async def read_frame(reader):
+    """
+    Read one message from an `asyncio.StreamReader`, None once the peer closed the channel.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+        size, = HEADER.unpack(header)
+        check_size(size)
+        payload = await reader.readexactly(size)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return decode_payload(payload)
+
+
+def _read_exactly(fp, size):
+    data = b""
+    while len(data) < size:
+        chunk = fp.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_frame_sync(fp):
+    """
+    Read one message from a binary file object, None once the peer closed the channel.
+    """
+    header = _read_exactly(fp, HEADER.size)
+    if header is None:
+        return None
+    size, = HEADER.unpack(header)
+    check_size(size)
+    payload = _read_exactly(fp, size)
+    if payload is None:
+        return None
+    return decode_payload(payload)
+
+
+def event_message(type, data, publisher):
+    return {"type": "event", "event": type, "data": data, "id": publisher}
+
+
+def stats_message(stats, publisher):
+    return {"type": "stats", "stats": stats, "id": publisher}
+
+
+def hello_message(publisher, pid):
+    return {"type": "hello", "id": publisher, "pid": pid}
+
+
+def command_message(command, **kwargs):
+    message = {"type": "command", "command": command}
+    message.update(kwargs)
+    return message
+
+
+class PipeChannel:
+    """
+    Publisher side of the channel: commands are read from `rfile`,
+    events and stats are written to `wfile` (both binary file objects,
+    normally the stdin/stdout pipes set up by the control server).
+    `rfile` should be unbuffered: the reader thread may still be blocked
+    in it at interpreter shutdown.
+    """
+
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self._lock = threading.Lock()
+        self._reader = None
+
+    @classmethod
+    def connect(cls, path):
+        """
+        Channel over a connection to the control server's unix socket at `path`,
+        None while nobody listens there.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            return None
+        # janus.py sets a default timeout, commands may be minutes apart
+        sock.settimeout(None)
+        return cls(sock.makefile('rb', buffering=0), sock.makefile('wb'))
+
+    def send(self, message):
+        frame = encode_frame(message)
+        with self._lock:
+            try:
+                self.wfile.write(frame)
+                self.wfile.flush()
+            except (OSError, ValueError) as e:
+                print("Send msg to main process exception", e)
+
+    def send_event(self, type, data, publisher):
+        self.send(event_message(type, data, publisher))
+
+    def send_stats(self, stats, publisher):
+        self.send(stats_message(stats, publisher))
+
+    def listen(self, loop, on_command):
+        """
+        Read commands on a background thread, `on_command(message)` runs on `loop`.
+        `on_command(None)` signals that the control server closed the channel.
+        """
+
+        def read():
+            while True:
+                try:
+                    message = read_frame_sync(self.rfile)
+                except (OSError, ValueError, FrameError) as e:
+                    print("Read command from main process exception", e)
+                    message = None
+                loop.call_soon_threadsafe(on_command, message)
+                if message is None:
+                    return
+
+        self._reader = threading.Thread(target=read, name="IPCReader", daemon=True)
+        self._reader.start()
@@ -1,41 +1,38 @@
 import argparse
 import asyncio
 import logging
+import os
 import platform
 import random
 import string
+import sys
 import time
 import websockets
 import json
 import attr
-import datetime
+import functools
+import certstore
+import logpipe
 
 from urllib.parse import urlencode
 from urllib.request import Request, urlopen
 from websockets.exceptions import ConnectionClosed, ConnectionClosedError
-from aiortc.contrib.media import MediaPlayer
 from collections import OrderedDict
 from h264track import FFmpegH264Track
+from ipc import PipeChannel, hello_message
 from aiortc import RTCPeerConnection, RTCRtpSender, RTCSessionDescription, RTCConfiguration, RTCIceServer
 from aiortc.rtcrtpparameters import RTCRtpCodecCapability
+from aiortc.sdp import candidate_to_sdp
 from streamplayer import StreamPlayer
+from timeline import Timeline
 from typing import Optional
 
 import socket
 socket.setdefaulttimeout(5)
 
 
-old_print = print
-
-
-def timestamped_print(*args, **kwargs):
-    time_str = datetime.datetime.now(datetime.timezone(datetime.timedelta(0))).astimezone().isoformat(
-        sep=' ',
-        timespec='milliseconds')
-    old_print(time_str, *args, **kwargs)
-
-
-print = timestamped_print
+# Timestamped and written by the log pipe's background thread
+print = logpipe.timestamped_print
 
 
 capabilities = RTCRtpSender.getCapabilities("video")
@@ -51,6 +48,14 @@ h264_capability = RTCRtpCodecCapability(
 )
 preferences = [h264_capability]
 RATE = 30
+# Seconds after WebRTC up the setup timeline waits for the first RTP packet before it is reported
+TIMELINE_WAIT = 5
+# Seconds between keepalives of a Janus session, well within Janus' default 60s session timeout
+SESSION_KEEPALIVE = 25
+# In-place republishes in a row without WebRTC up before the publisher gives up to a full restart
+REPUBLISH_ATTEMPTS = 3
+# Seconds a republish waits for Janus to hang up the failed PeerConnection
+UNPUBLISH_WAIT = 2
 
 
 @attr.s
@@ -63,6 +68,7 @@ class PluginData(JanusEvent):
     plugin = attr.ib(validator=attr.validators.instance_of(str))
     data = attr.ib()
     jsep = attr.ib()
+    transaction = attr.ib(default=None)
 
 
 @attr.s
@@ -109,110 +115,300 @@ class Jsep:
     type = attr.ib(validator=attr.validators.in_(["offer", "pranswer", "answer", "rollback"]))
 
 
+class JanusSession:
+    """
+    A WebSocket and Janus session, with a plugin handle per publisher.
+
+    A reader task dispatches every incoming frame: replies complete the future
+    of the request with the same transaction, events go to the queue of their
+    `sender` handle. Requests can therefore be pipelined without racing for
+    `conn.recv()`. A single keepalive covers every handle and the session is
+    destroyed when its last user releases it.
+
+    Publishers running in the same event loop can share the session of a Janus
+    server (`acquire`) to save a WebSocket and keepalive each.
+    """
+
+    # (event loop, server) -> future of the shared `JanusSession`
+    sessions = {}
+
+    def __init__(self, server):
+        self.server = server
+        self.conn = None
+        self.session = None
+        self.users = 0
+        # handle id -> queue of its frames
+        self.handles = {}
+        # transaction -> `Transaction` waiting for its reply
+        self.transactions = {}
+        self._tasks = []
+        # sends not written yet
+        self._sending = set()
+        # set when the reader stopped, nothing reaches the session anymore
+        self._reader_exited = False
+
+    @classmethod
+    async def acquire(cls, server):
+        """
+        The session shared by the publishers of `server` in this event loop.
+        """
+        key = (asyncio.get_event_loop(), server)
+        future = cls.sessions.get(key)
+        if future is None or (future.done() and (future.exception() or future.result().closed)):
+            future = asyncio.ensure_future(cls(server).open())
+            cls.sessions[key] = future
+        try:
+            session = await asyncio.shield(future)
+        except Exception:
+            if cls.sessions.get(key) is future:
+                cls.sessions.pop(key, None)
+            raise
+        session.users += 1
+        return session
+
+    @classmethod
+    async def private(cls, server):
+        """
+        A session of its own.
+        """
+        session = await cls(server).open()
+        session.users += 1
+        return session
+
+    @property
+    def closed(self):
+        return self.conn is None or self.conn.closed or self._reader_exited
+
+    async def open(self):
+        self.conn = await websockets.connect(self.server, subprotocols=['janus-protocol'])
+        loop = asyncio.get_event_loop()
+        self._tasks = [loop.create_task(self._read())]
+        try:
+            parsed = await self.request({"janus": "create"})
+        except BaseException:
+            await self._shutdown()
+            raise
+        print(parsed)
+        assert parsed["janus"] == "success", "Failed creating session"
+        self.session = parsed["data"]["id"]
+        self._tasks.append(loop.create_task(self._keepalive()))
+        return self
+
+    def transact(self, message, handle=None, ack=False):
+        """
+        Send `message` and return a future of its reply: the `ack` when `ack` is set,
+        otherwise the final answer (success, error or the plugin event).
+        The transaction, session and handle ids are filled in.
+        """
+        transaction = message.get("transaction") or transaction_id()
+        message["transaction"] = transaction
+        if self.session is not None:
+            message["session_id"] = self.session
+        if handle is not None:
+            message["handle_id"] = handle
+        future = asyncio.get_event_loop().create_future()
+        self.transactions[transaction] = Transaction(handle, ack, future)
+        future.add_done_callback(lambda f: self.transactions.pop(transaction, None))
+
+        async def send():
+            try:
+                await self.conn.send(json.dumps(message))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+
+        sending = asyncio.ensure_future(send())
+        self._sending.add(sending)
+        sending.add_done_callback(self._sending.discard)
+        return future
+
+    async def request(self, message, handle=None, ack=False):
+        return await self.transact(message, handle, ack)
+
+    async def attach(self, plugin):
+        """
+        New handle on `plugin`, returns its id and the queue receiving its events.
+        """
+        parsed = await self.request({"janus": "attach", "plugin": plugin})
+        assert parsed["janus"] == "success", "Failed attaching to {}".format(plugin)
+        handle = parsed["data"]["id"]
+        queue = asyncio.Queue()
+        self.handles[handle] = queue
+        return handle, queue
+
+    async def detach(self, handle):
+        self.handles.pop(handle, None)
+        if not self.closed:
+            # nobody waits for the reply
+            self.transact({"janus": "detach"}, handle).add_done_callback(_ignore_result)
+
+    async def release(self):
+        self.users -= 1
+        if self.users > 0:
+            return
+        self._unshare()
+        if self._sending:
+            # detach the handles before destroying the session
+            await asyncio.wait(list(self._sending))
+        if not self.closed and self.session is not None:
+            await self.conn.send(json.dumps({
+                "janus": "destroy",
+                "session_id": self.session,
+                "transaction": transaction_id()
+            }))
+        await self._shutdown()
+
+    def _unshare(self):
+        key = (asyncio.get_event_loop(), self.server)
+        future = self.sessions.get(key)
+        if (future is not None and future.done() and not future.cancelled() and not future.exception()
+                and future.result() is self):
+            self.sessions.pop(key, None)
+
+    async def _shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        if self.conn is not None and not self.conn.closed:
+            await self.conn.close()
+
+    async def _read(self):
+        try:
+            while True:
+                raw = json.loads(await self.conn.recv())
+                self._dispatch(raw)
+        except (ConnectionClosed, ConnectionClosedError) as e:
+            closed = e
+        except Exception as e:
+            print("Janus session reader exception: ", e)
+            closed = e
+            asyncio.ensure_future(self.conn.close())
+        finally:
+            self._reader_exited = True
+            # later `acquire` calls open a new session
+            self._unshare()
+        # every handle and pending request of the session is gone
+        for queue in self.handles.values():
+            queue.put_nowait(closed)
+        for pending in list(self.transactions.values()):
+            if not pending.future.done():
+                pending.future.set_exception(closed)
+
+    def _dispatch(self, raw):
+        janus = raw.get("janus")
+        pending = self.transactions.get(raw.get("transaction"))
+        if pending is not None and not pending.future.done() and (janus != "ack" or pending.ack):
+            pending.future.set_result(raw)
+
+        handle = raw.get("sender")
+        if handle is None and pending is not None and janus == "error":
+            # errors of fire-and-forget requests still reach the publisher
+            handle = pending.handle
+        if handle in self.handles:
+            if janus != "ack":
+                self.handles[handle].put_nowait(raw)
+        elif janus == "timeout":
+            print("Janus session timed out: ", raw)
+            asyncio.ensure_future(self.conn.close())
+        elif pending is None and janus != "ack":
+            print("Unroutable Janus message: ", raw)
+
+    async def _keepalive(self):
+        while not self.closed:
+            await asyncio.sleep(SESSION_KEEPALIVE)
+            try:
+                await self.conn.send(json.dumps({
+                    "janus": "keepalive",
+                    "session_id": self.session,
+                    "transaction": transaction_id()
+                }))
+            except (ConnectionClosed, ConnectionClosedError):
+                return
+
+
+@attr.s
+class Transaction:
+    handle = attr.ib()
+    # resolved by the ack rather than the final reply
+    ack = attr.ib()
+    future = attr.ib()
+
+
+def _ignore_result(future):
+    if not future.cancelled():
+        future.exception()
+
+
 @attr.s
 class JanusGateway:
     server = attr.ib(validator=attr.validators.instance_of(str))
-    _messages = attr.ib(factory=set)
+    # Share one WebSocket and Janus session with the other publishers of the server (see `JanusSession`)
+    shared = attr.ib(default=False)
+    _janus_session = attr.ib(default=None, init=False)
+    _queue = attr.ib(default=None, init=False)
 
     async def connect(self):
-        self.conn = await websockets.connect(self.server, subprotocols=['janus-protocol'])
-        transaction = transaction_id()
-        await self.conn.send(json.dumps({
-            "janus": "create",
-            "transaction": transaction
-        }))
-        resp = await self.conn.recv()
-        print(resp)
-        parsed = json.loads(resp)
-        assert parsed["janus"] == "success", "Failed creating session"
-        assert parsed["transaction"] == transaction, "Incorrect transaction"
-        self.session = parsed["data"]["id"]
+        if self.shared:
+            self._janus_session = await JanusSession.acquire(self.server)
+        else:
+            self._janus_session = await JanusSession.private(self.server)
+        self.conn = self._janus_session.conn
+        self.session = self._janus_session.session
 
     async def close(self):
-        await self.conn.close()
+        if self._janus_session is not None:
+            session, self._janus_session = self._janus_session, None
+            await session.release()
 
     async def leave(self):
         if self.conn.closed:
             return
-        transaction = transaction_id()
-        await self.conn.send(json.dumps({
-            "janus": "destroy",
-            "session_id": self.session,
-            "transaction": transaction
-        }))
-        # resp = await self.conn.recv()
-        # print ("left room: ", resp)
+        if hasattr(self, "handle"):
+            await self._janus_session.detach(self.handle)
 
     async def attach(self, plugin):
         assert hasattr(self, "session"), "Must connect before attaching to plugin"
-        transaction = transaction_id()
-        await self.conn.send(json.dumps({
-            "janus": "attach",
-            "session_id": self.session,
-            "plugin": plugin,
-            "transaction": transaction
-        }))
-        resp = await self.conn.recv()
-        parsed = json.loads(resp)
-        assert parsed["janus"] == "success", "Failed attaching to {}".format(plugin)
-        assert parsed["transaction"] == transaction, "Incorrect transaction"
-        self.handle = parsed["data"]["id"]
+        self.handle, self._queue = await self._janus_session.attach(plugin)
 
-    async def sendtrickle(self, candidate):
+    def sendtrickle(self, candidate):
+        """
+        Trickle `candidate` (None once gathering completed), returns a future of the ack.
+        """
         assert hasattr(self, "session"), "Must connect before sending messages"
         assert hasattr(self, "handle"), "Must attach before sending messages"
-        transaction = transaction_id()
-        janus_message = {
-            "janus": "trickle",
-            "session_id": self.session,
-            "handle_id": self.handle,
-            "transaction": transaction,
-            "candidate": candidate
-        }
-        await self.conn.send(json.dumps(janus_message))
-
-    async def sendmessage(self, body, jsep=None):
+        if candidate is None:
+            candidate = {"completed": True}
+        future = self._janus_session.transact({"janus": "trickle", "candidate": candidate}, self.handle, ack=True)
+        future.add_done_callback(_ignore_result)
+        return future
+
+    def sendmessage(self, body, jsep=None, transaction=None):
+        """
+        Send a plugin request, returns a future of its final reply (the plugin event or an error).
+        The reply is also delivered by `recv`, awaiting the future is optional.
+        """
         assert hasattr(self, "session"), "Must connect before sending messages"
         assert hasattr(self, "handle"), "Must attach before sending messages"
-        transaction = transaction_id()
         janus_message = {
             "janus": "message",
-            "session_id": self.session,
-            "handle_id": self.handle,
-            "transaction": transaction,
             "body": body
         }
         if jsep is not None:
             janus_message["jsep"] = jsep
-        await self.conn.send(json.dumps(janus_message))
-
-    async def keepalive(self):
-        assert hasattr(self, "session"), "Must connect before sending messages"
-        assert hasattr(self, "handle"), "Must attach before sending messages"
-
-        while True:
-            try:
-                if self.conn.closed:
-                    return
-                await asyncio.sleep(60)
-                transaction = transaction_id()
-                await self.conn.send(json.dumps({
-                    "janus": "keepalive",
-                    "session_id": self.session,
-                    "handle_id": self.handle,
-                    "transaction": transaction
-                }))
-            except (KeyboardInterrupt, ConnectionClosed, ConnectionClosedError) as e:
-                return
+        if transaction is not None:
+            janus_message["transaction"] = transaction
+        future = self._janus_session.transact(janus_message, self.handle)
+        future.add_done_callback(_ignore_result)
+        return future
 
     async def recv(self):
-        if len(self._messages) > 0:
-            return self._messages.pop()
-        else:
-            return await self._recv_and_parse()
+        return await self._recv_and_parse()
 
     async def _recv_and_parse(self):
-        raw = json.loads(await self.conn.recv())
+        raw = await self._queue.get()
+        if isinstance(raw, Exception):
+            # the connection is gone
+            self._queue.put_nowait(raw)
+            raise raw
         print("Received: ", raw)
         janus = raw["janus"]
 
@@ -221,7 +417,8 @@ class JanusGateway:
                 sender=raw["sender"],
                 plugin=raw["plugindata"]["plugin"],
                 data=raw["plugindata"]["data"],
-                jsep=raw["jsep"] if "jsep" in raw else None
+                jsep=raw["jsep"] if "jsep" in raw else None,
+                transaction=raw.get("transaction")
             )
         elif janus == "webrtcup":
             return WebrtcUp(
@@ -258,7 +455,7 @@ class JanusGateway:
 
 
 class WebRTCClient:
-    def __init__(self, signaling: JanusGateway, rtsp, mic, publisher):
+    def __init__(self, signaling: JanusGateway, rtsp, mic, publisher, on_event=None):
         self.signaling = signaling
         self.rtsp = rtsp
         self.mic = mic
@@ -269,10 +466,89 @@ class WebRTCClient:
         self.turn_user = None
         self.turn_passwd = None
         self.stun = None
+        # DTLS certificate of the peer connections, the shared one from certstore when None
+        self.certificate = None
+        # Callback receiving (type, data, publisher) for every event the main process cares about.
+        self.on_event = on_event or print_event
+        # setup phases, reported with the stats and once complete as a `timeline` event
+        self.timeline = Timeline()
+        self.timeline_task: Optional[asyncio.Task] = None
+        # `prepare` running ahead of the join, and the RTSP open it started
+        self.prepared: Optional[asyncio.Task] = None
+        self.media_task: Optional[asyncio.Task] = None
+        # local candidates waiting for the offer to be sent, None once it is
+        self.early_candidates = None
+        # republish after the PeerConnection failed, and how many in a row did not reach WebRTC up
+        self.republish_task: Optional[asyncio.Task] = None
+        self.republishes = 0
+        # transactions of requests whose error replies are expected
+        self.tolerated = set()
+
+    def notify(self, type, data):
+        self.on_event(type, data, self.publisher)
+
+    async def get_stats(self):
+        """
+        Counters of the outgoing RTP streams summed over all senders, the worst
+        round-trip time and loss reported by Janus, and the RTSP player counters.
+        """
+        stats = {"packetsSent": 0, "bytesSent": 0, "nackCount": 0, "pliCount": 0, "firCount": 0}
+        player = self.stream_player
+        if player is not None:
+            stats["queueDepth"] = player.packets.qsize()
+            stats["queueBytes"] = player.packets.queued_bytes
+            stats["packetsDemuxed"] = player.packets_demuxed
+            stats["packetsDropped"] = player.packets_dropped
+            stats["demuxErrors"] = player.demux_errors
+        stats["timeline"] = self.timeline_report()
+        if self.pc is None:
+            return stats
+        for sender in self.pc.getSenders():
+            report = await sender.getStats()
+            for s in report.values():
+                if s.type == "outbound-rtp":
+                    stats["packetsSent"] += s.packetsSent
+                    stats["bytesSent"] += s.bytesSent
+                    stats["nackCount"] += s.nackCount
+                    stats["pliCount"] += s.pliCount
+                    stats["firCount"] += s.firCount
+                elif s.type == "remote-inbound-rtp":
+                    if s.roundTripTime is not None:
+                        stats["roundTripTime"] = max(stats.get("roundTripTime", 0), s.roundTripTime)
+                    # RTCP fixed point, 1/256 units
+                    stats["fractionLost"] = max(stats.get("fractionLost", 0), s.fractionLost / 256)
+        return stats
+
+    def timeline_report(self):
+        # phases reached outside the event loop or without a callback
+        player = self.stream_player
+        if player is not None and player.first_packet_time is not None \
+                and player.first_packet_time >= self.timeline.start:
+            self.timeline.mark("first_packet", player.first_packet_time)
+        if self.pc is not None:
+            sent = [sender.firstPacketTime for sender in self.pc.getSenders() if sender.firstPacketTime is not None]
+            if sent:
+                self.timeline.mark("first_rtp_sent", min(sent))
+        return self.timeline.report()
+
+    async def report_timeline(self):
+        """
+        Report the setup timeline once the first RTP packet went out, or `TIMELINE_WAIT` after WebRTC up.
+        """
+        deadline = time.monotonic() + TIMELINE_WAIT
+        report = self.timeline_report()
+        while "first_rtp_sent" not in report["marks"] and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+            report = self.timeline_report()
+        print("Setup timeline: ", self.timeline.summary())
+        self.notify('timeline', json.dumps(report))
 
     async def destroy(self):
-        await self.http_session.close()
-        await self.signaling.leave()
+        for task in (self.prepared, self.media_task, self.timeline_task, self.republish_task):
+            if task is not None:
+                task.cancel()
+        if hasattr(self.signaling, "conn"):
+            await self.signaling.leave()
         if self.pc is not None:
             await self.pc.close()
         if self.stream_player is not None:
@@ -280,12 +556,16 @@ class WebRTCClient:
 
     async def handle_plugin_data(self, data):
         print("handle plugin data: \n", data)
+        if data.transaction in self.tolerated:
+            self.tolerated.discard(data.transaction)
+            return
 
         if data.jsep is not None:
             await self.handle_sdp(data.jsep)
         if data.data is not None:
             events_type = data.data["videoroom"]
             if events_type == "joined":
+                self.timeline.mark("joined")
                 await self.publish()
                 publishers = data.data["publishers"]
                 print("Publishes in the room: ", publishers)
@@ -305,6 +585,7 @@ class WebRTCClient:
             sdp = msg['sdp']
             assert (msg['type'] == 'answer')
             print('Received answer:\n%s' % sdp)
+            self.timeline.mark("answer")
 
             # apply answer
             await self.pc.setRemoteDescription(
@@ -314,7 +595,12 @@ class WebRTCClient:
                 if t.kind == "video":
                     t.setCodecPreferences(preferences)
 
-    async def publish(self):
+    async def prepare(self):
+        """
+        Create the PeerConnection and its offer, which starts ICE gathering, and
+        start opening the RTSP stream: neither needs Janus, so both run while
+        signaling. Returns the configure request to send with the offer.
+        """
         ice_configs = []
         if self.turn is not None and \
                 self.turn_user is not None \
@@ -324,31 +610,33 @@ class WebRTCClient:
         if self.stun is not None:
             ice_configs.append(RTCIceServer(self.stun))
 
+        certificates = [self.certificate if self.certificate is not None else certstore.certificate()]
         if len(ice_configs) > 0:
-            pc = RTCPeerConnection(configuration=RTCConfiguration(ice_configs))
+            pc = RTCPeerConnection(configuration=RTCConfiguration(ice_configs, certificates=certificates))
         else:
-            pc = RTCPeerConnection()
+            pc = RTCPeerConnection(configuration=RTCConfiguration(certificates=certificates))
         self.pc = pc
 
-        # @pc.on("iceconnectionstatechange")
-        # async def on_iceconnectionstatechange():
-        #     print("ICE connection state is", pc.iceConnectionState)
-        #     send_msg_to_main('ice', pc.iceConnectionState, self.publisher)
+        @pc.on("iceconnectionstatechange")
+        def on_iceconnectionstatechange():
+            if pc.iceConnectionState == "completed":
+                self.timeline.mark("ice_connected")
 
         @pc.on("connectionstatechange")
         async def on_connectionstatechange():
             print("Connection state is", pc.connectionState)
-            if pc.connectionState == 'failed':
-                await pc.close()
-                print("Connection closed, releasing resource...")
-                if self.stream_player is not None:
-                    self.stream_player.stop()
-                send_msg_to_main('pc', pc.connectionState, self.publisher)
+            if pc.connectionState == 'connected':
+                # every DTLS transport is connected
+                self.timeline.mark("dtls_connected")
+            elif pc.connectionState == 'failed' and self.pc is pc:
+                self.republish_task = asyncio.ensure_future(self.republish(pc))
 
         request = {"request": "configure", "audio": False, "video": True}
         # configure media
         if self.rtsp is not None:
             if self.mic != 'mute':
+                # contrib.media is only needed for capture devices, not for RTSP passthrough
+                from aiortc.contrib.media import MediaPlayer
                 print("Current mic is: ", self.mic)
                 if platform.system() == "Darwin":
                     player = MediaPlayer(':0', format='avfoundation', options={
@@ -368,63 +656,180 @@ class WebRTCClient:
                     request["audio"] = True
                     pc.addTrack(player.audio)
             if self.rtsp == 'screen':
+                from aiortc.contrib.media import MediaPlayer
                 player = MediaPlayer('video=screen-capture-recorder', format="dshow", options={
                     '-framerate': '30', '-b:v': '4M', '-video_size': '1920x1080'
                 })
                 pc.addTrack(player.video)
             else:
-                rtsp_player = StreamPlayer(self.rtsp)
-                video_track = FFmpegH264Track(rtsp_player)
-                # self.camera = GstH264Player(video_track, self.rtsp)
-                pc.addTrack(video_track)
-                self.stream_player = rtsp_player
+                # the offer does not depend on the stream, its track is set once the RTSP handshake is done
+                video = pc.addTransceiver("video")
+                if self.stream_player is not None:
+                    # republishing, the RTSP stream is still up
+                    video.sender.replaceTrack(FFmpegH264Track(self.stream_player))
+                else:
+                    self.media_task = asyncio.ensure_future(self.open_media(pc, video.sender))
         else:
             raise Exception("No Media Input! Stop Now.")
 
-        # send offer
-        await pc.setLocalDescription(await pc.createOffer())
+        # candidates gathered before the offer went out
+        self.early_candidates = []
 
-        if len(ice_configs) > 0:
-            sdp = {"sdp": pc.localDescription.sdp, "trickle": True, "type": pc.localDescription.type}
-        else:
-            sdp = {"sdp": pc.localDescription.sdp, "trickle": False, "type": pc.localDescription.type}
+        @pc.on("icecandidate")
+        def on_icecandidate(candidate):
+            if candidate is None:
+                self.timeline.mark("gathering_done")
+            if self.early_candidates is not None:
+                self.early_candidates.append(candidate)
+            else:
+                self.trickle(candidate)
+
+        @pc.on("icecandidateerror")
+        async def on_icecandidateerror(error):
+            print("ICE gathering failed: ", error)
+            await pc.close()
+            if self.stream_player is not None:
+                self.stream_player.stop()
+            self.notify('pc', 'failed')
+
+        # the offer does not wait for STUN/TURN candidates, they are trickled as they come
+        await pc.setLocalDescription(await pc.createOffer(), trickle=True)
+        self.timeline.mark("offer_created")
+        return request
+
+    async def open_media(self, pc, sender):
+        # av.open blocks until the RTSP handshake is done, keep it off the event loop
+        loop = asyncio.get_event_loop()
+        opening = loop.run_in_executor(None, StreamPlayer, self.rtsp, loop, self.media_ended)
+        try:
+            rtsp_player = await asyncio.shield(opening)
+        except asyncio.CancelledError:
+            # the publisher went away during the handshake
+            opening.add_done_callback(lambda f: not f.cancelled() and f.exception() is None and f.result().stop())
+            raise
+        if self.pc is not pc:
+            rtsp_player.stop()
+            return
+        self.timeline.mark("rtsp_opened")
+        video_track = FFmpegH264Track(rtsp_player)
+        # self.camera = GstH264Player(video_track, self.rtsp)
+        sender.replaceTrack(video_track)
+        self.stream_player = rtsp_player
 
-        await self.signaling.sendmessage(request, sdp)
+    def media_ended(self, reason):
+        print("RTSP stream {r}: ".format(r=reason), self.rtsp)
+        self.notify('rtsp', reason)
+
+    async def publish(self):
+        if self.prepared is None:
+            self.prepared = asyncio.ensure_future(self.prepare())
+        prepared, self.prepared = self.prepared, None
+        request = await prepared
+        pc = self.pc
+        sdp = {"sdp": pc.localDescription.sdp, "trickle": True, "type": pc.localDescription.type}
+
+        # the answer is handled by `loop` like every other event
+        self.signaling.sendmessage(request, sdp)
+        self.timeline.mark("offer_sent")
+        early_candidates, self.early_candidates = self.early_candidates, None
+        for candidate in early_candidates:
+            self.trickle(candidate)
+
+    def trickle(self, candidate):
+        """
+        Send a local ICE candidate to Janus, None once gathering is complete.
+        """
+        if candidate is not None:
+            candidate = {
+                "candidate": "candidate:" + candidate_to_sdp(candidate),
+                "sdpMid": candidate.sdpMid,
+                "sdpMLineIndex": candidate.sdpMLineIndex
+            }
+        self.signaling.sendtrickle(candidate)
 
     async def republish(self, pc):
+        """
+        Publish again on a new PeerConnection after `pc` failed, keeping the RTSP
+        stream and the Janus handle: recovering costs an ICE and DTLS handshake
+        rather than an RTSP handshake and a new Janus session. After
+        `REPUBLISH_ATTEMPTS` in a row without WebRTC up, or when the RTSP stream
+        is gone as well, the control server restarts the publisher instead.
+        """
         await pc.close()
+        player = self.stream_player
+        self.republishes += 1
+        if self.republishes > REPUBLISH_ATTEMPTS or player is None or not player.is_alive():
+            print("Connection closed, releasing resource...")
+            if player is not None:
+                player.stop()
+            self.notify('pc', 'failed')
+            return
         print("Republishing...")
-        if self.stream_player is not None:
-            self.stream_player.stop()
-        time.sleep(3)
+        self.notify('pc', 'republishing')
+        # Janus takes a new offer once it hung up the failed PeerConnection (or it already did)
+        transaction = transaction_id()
+        self.tolerated.add(transaction)
+        try:
+            await asyncio.wait_for(self.signaling.sendmessage({"request": "unpublish"}, transaction=transaction),
+                                   UNPUBLISH_WAIT)
+        except asyncio.TimeoutError:
+            print("Unpublish timed out, republishing anyway")
+        # packets queued meanwhile are stale
+        player.packets.clear()
+        self.timeline = Timeline()
+        self.timeline_task = None
         await self.publish()
 
+    async def next_message(self, signaling):
+        """
+        The next Janus message, raising the error of `prepare` or of the RTSP open if they fail first.
+        """
+        while True:
+            background = [task for task in (self.prepared, self.media_task, self.republish_task)
+                          if task is not None and not task.done()]
+            if not background:
+                return await signaling.recv()
+            recv = asyncio.ensure_future(signaling.recv())
+            done, _ = await asyncio.wait([recv] + background, return_when=asyncio.FIRST_COMPLETED)
+            if recv in done:
+                return recv.result()
+            recv.cancel()
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+
     async def loop(self, signaling, room, display):
+        # RTSP open and ICE gathering run while joining the room
+        self.prepared = asyncio.ensure_future(self.prepare())
+
         await signaling.connect()
+        self.timeline.mark("janus_session")
         await signaling.attach("janus.plugin.videoroom")
-
-        loop = asyncio.get_event_loop()
-        loop.create_task(signaling.keepalive())
+        self.timeline.mark("attached")
 
         message = {"request": "join", "ptype": "publisher", "room": int(room), "pin": str(room), "display": display,
                    "id": int(self.publisher)}
-        await signaling.sendmessage(message)
+        signaling.sendmessage(message)
 
         assert signaling.conn
 
         while True:
             try:
-                msg = await signaling.recv()
+                msg = await self.next_message(signaling)
                 if isinstance(msg, PluginData):
                     await self.handle_plugin_data(msg)
                 elif isinstance(msg, Media):
                     print(msg)
                 elif isinstance(msg, JanusError):
-                    send_msg_to_main('error', msg.code, self.publisher)
+                    self.notify('error', msg.code)
                     print(msg)
                 elif isinstance(msg, WebrtcUp):
-                    send_msg_to_main('webrtc', 'up', self.publisher)
+                    self.timeline.mark("webrtc_up")
+                    self.republishes = 0
+                    self.notify('webrtc', 'up')
                     print(msg)
+                    if self.timeline_task is None:
+                        self.timeline_task = asyncio.ensure_future(self.report_timeline())
                 elif isinstance(msg, SlowLink):
                     print(msg)
                 elif isinstance(msg, HangUp):
@@ -435,13 +840,98 @@ class WebRTCClient:
                 print("---------- Websocket exception: ", e)
                 return
 
+    async def run(self, room, display):
+        """
+        Publish until the Janus session ends, reporting failures through `on_event`
+        and releasing every resource on the way out (also when cancelled).
+        """
+        try:
+            await self.loop(signaling=self.signaling, room=room, display=display)
+        except Exception as e:
+            print("------------------------Exception: ", e)
+            if e.args:
+                content = e.args[0]
+            else:
+                content = 'Unknown exception'
+            self.notify('exception', content)
+        finally:
+            print("========= RTSP ", self.rtsp)
+            print("WebSocket server stopped")
+            # 销毁 RTC client
+            await self.destroy()
+            # 关闭 WS
+            if hasattr(self.signaling, "conn"):
+                await self.signaling.close()
+
 
 def transaction_id():
     return "".join(random.choice(string.ascii_letters) for x in range(12))
 
 
-def send_msg_to_main(type, data, publisher):
-    url = 'http://127.0.0.1:9001/camera/subprocess'
+def attach(rtc_client: WebRTCClient, task, path, grace):
+    """
+    Connect to the control server listening on the unix socket `path`, retrying for `grace`
+    seconds (while it restarts), and stop publishing when it does not come back.
+    Events reported in the meantime are delivered once connected.
+    """
+    pending = []
+    rtc_client.on_event = lambda type, data, publisher: pending.append((type, data, publisher))
+
+    async def connect():
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + grace
+        while True:
+            channel = await loop.run_in_executor(None, PipeChannel.connect, path)
+            if channel is not None:
+                break
+            if loop.time() >= deadline:
+                print("Control server did not come back, stopping...")
+                task.cancel()
+                return
+            await asyncio.sleep(1)
+        channel.send(hello_message(rtc_client.publisher, os.getpid()))
+        for event in pending:
+            channel.send_event(*event)
+        rtc_client.on_event = channel.send_event
+        channel.listen(loop, lambda message: handle_command(rtc_client, channel, task, message, path, grace))
+
+    return asyncio.ensure_future(connect())
+
+
+def handle_command(rtc_client: WebRTCClient, channel: PipeChannel, task, message, control_socket=None, grace=0):
+    """
+    Execute a command received from the control server over the IPC channel.
+    """
+    if message is None:
+        if control_socket is not None:
+            # the control server is restarting, it adopts us again when it is back
+            print("IPC channel closed, waiting for the control server...")
+            attach(rtc_client, task, control_socket, grace)
+            return
+        # control server went away, nobody is left to report to
+        print("IPC channel closed, stopping...")
+        task.cancel()
+        return
+    command = message.get("command")
+    if command == "stop":
+        task.cancel()
+    elif command == "stats":
+        async def send_stats():
+            channel.send_stats(await rtc_client.get_stats(), rtc_client.publisher)
+
+        asyncio.ensure_future(send_stats())
+    else:
+        print("Unknown IPC command: ", message)
+
+
+def print_event(type, data, publisher):
+    print("Event for", publisher, type, data)
+
+
+def send_msg_to_main(url, type, data, publisher):
+    """
+    Legacy `--http_callback`: POST the event to `url` of a control server without IPC.
+    """
     msg = {'event': type, 'data': data, 'id': publisher}
     try:
         request = Request(url, urlencode(msg).encode())
@@ -453,7 +943,13 @@ def send_msg_to_main(type, data, publisher):
         print("Send msg to main process exception", e)
 
 
-if __name__ == "__main__":
+def main(argv=None, channel=None):
+    """
+    Publish one camera as described by the command line `argv`.
+
+    `channel` is the IPC channel to the control server when it was set up by the caller
+    (see zygote.py).
+    """
     parser = argparse.ArgumentParser(description="Janus")
     parser.add_argument("url", help="Janus root URL, e.g. ws://localhost:8188")
     parser.add_argument("--rtsp", help="RTSP stream address.")
@@ -466,47 +962,67 @@ if __name__ == "__main__":
     parser.add_argument("--turn_passwd", help="WebRTC turn server passwd")
     parser.add_argument("--stun", help="WebRTC stun server")
     parser.add_argument("--log_level", "-L", default=0, help="Log level")
-    args = parser.parse_args()
+    parser.add_argument("--log_file", help="Write the log to this file, rotated by size")
+    parser.add_argument("--ipc", action="store_true",
+                        help="Exchange framed messages with the control server over stdin/stdout")
+    parser.add_argument("--control_socket",
+                        help="Exchange framed messages with the control server over this unix socket, "
+                             "and keep publishing while it restarts")
+    parser.add_argument("--adopt_grace", type=float, default=30,
+                        help="Seconds to wait for a restarting control server before stopping (default: 30)")
+    parser.add_argument("--http_callback",
+                        help="Legacy: POST events to this URL, e.g. http://127.0.0.1:9001/camera/subprocess, "
+                             "instead of only printing them when there is no IPC channel")
+    args = parser.parse_args(argv)
+
+    if args.ipc and channel is None:
+        channel = PipeChannel(sys.stdin.buffer.raw, sys.stdout.buffer)
+        # stdout carries the IPC frames now, print to stderr
+        sys.stdout = sys.stderr
+    if args.log_file:
+        logpipe.configure(args.log_file, redirect_stderr=True)
     print("Received Params:", args)
 
     if args.log_level:
         log_level = int(args.log_level)
         if log_level == 1:
-            logging.basicConfig(level=logging.WARN)
+            level = logging.WARN
         elif log_level == 2:
-            logging.basicConfig(level=logging.INFO)
+            level = logging.INFO
         elif log_level == 3:
-            logging.basicConfig(level=logging.DEBUG)
+            level = logging.DEBUG
         else:
-            logging.basicConfig(level=logging.ERROR)
+            level = logging.ERROR
+        logging.basicConfig(level=level, handlers=[logpipe.log_handler()])
     rtsp = args.rtsp
     # create signaling client
     signaling = JanusGateway(args.url)
     # create webrtc client
-    rtc_client = WebRTCClient(signaling, rtsp, args.mic, args.id)
+    if channel is not None:
+        on_event = channel.send_event
+    elif args.http_callback:
+        on_event = functools.partial(send_msg_to_main, args.http_callback)
+    else:
+        on_event = None
+    rtc_client = WebRTCClient(signaling, rtsp, args.mic, args.id, on_event=on_event)
     rtc_client.turn = args.turn
     rtc_client.turn_user = args.turn_user
     rtc_client.turn_passwd = args.turn_passwd
     rtc_client.stun = args.stun
 
     loop = asyncio.get_event_loop()
+    print("========= RTSP ", rtsp)
+    print("WebSocket server started")
+    task = loop.create_task(rtc_client.run(room=args.room, display=args.name))
+    if channel is not None:
+        channel.listen(loop, lambda message: handle_command(rtc_client, channel, task, message))
+    elif args.control_socket:
+        attach(rtc_client, task, args.control_socket, args.adopt_grace)
     try:
-        print("========= RTSP ", rtsp)
-        print("WebSocket server started")
-        loop.run_until_complete(
-            rtc_client.loop(signaling=signaling, room=args.room, display=args.name)
-        )
-    except Exception as e:
-        print("------------------------Exception: ", e)
-        if e.args:
-            content = e.args[0]
-        else:
-            content = 'Unknown exception'
-        send_msg_to_main('exception', content, args.id)
-    finally:
-        print("========= RTSP ", rtsp)
-        print("WebSocket server stopped")
-        # 销毁 RTC client
-        loop.run_until_complete(rtc_client.destroy())
-        # 关闭 WS
-        loop.run_until_complete(signaling.close())
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        print("Publisher stopped by the control server")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+Non-blocking log output.
+
+Callers only format a line and put it on a bounded queue, a background thread
+writes the lines in batches and rotates the log file by size. A full queue
+drops lines (and counts them) rather than stalling the media thread or the
+event loop. Bursts of the same message, like demux EAGAIN errors, are sampled
+with `RateLimiter`.
+"""
+import atexit
+import builtins
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+QUEUE_SIZE = 10000
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 3
+# Lines written in one go by the writer thread
+BATCH_SIZE = 256
+
+_builtin_print = builtins.print
+
+
+class Timestamp:
+    """
+    `2023-01-01 08:00:00.123+08:00` timestamps, the date and time part is only rebuilt once a second.
+    """
+
+    def __init__(self):
+        # (second, date and time, UTC offset), replaced as a whole so that threads never mix them
+        self._cache = (None, "", "")
+
+    def now(self):
+        now = time.time()
+        second = int(now)
+        cache = self._cache
+        if cache[0] != second:
+            local = time.localtime(second)
+            offset = local.tm_gmtoff // 60
+            cache = (second, time.strftime("%Y-%m-%d %H:%M:%S", local),
+                     "{s}{h:02d}:{m:02d}".format(s="-" if offset < 0 else "+", h=abs(offset) // 60, m=abs(offset) % 60))
+            self._cache = cache
+        return "{p}.{ms:03d}{o}".format(p=cache[1], ms=int((now - second) * 1000), o=cache[2])
+
+
+class LogPipe:
+    """
+    Bounded queue of log lines drained by a writer thread into `path`
+    (rotated to `path.1` ... `path.<backup_count>` past `max_bytes`),
+    or into the current `sys.stdout` without a path.
+    With `redirect_stderr`, fd 2 follows the log file so that native
+    ffmpeg/OpenSSL output and tracebacks land in it as well.
+    """
+
+    def __init__(self, path=None, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT,
+                 queue_size=QUEUE_SIZE, redirect_stderr=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.redirect_stderr = redirect_stderr
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self._file = None
+        self._size = 0
+        self._thread = None
+        self._closed = False
+
+    def start(self):
+        if self.path is not None:
+            self._open()
+        self._thread = threading.Thread(target=self._run, name="LogWriter", daemon=True)
+        self._thread.start()
+
+    def write(self, line):
+        """
+        Queue `line` (including its newline), never blocks.
+        """
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=2):
+        """
+        Write what is queued and stop the writer.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open(self):
+        self._file = open(self.path, 'a', encoding='utf-8', errors='replace')
+        self._size = self._file.tell()
+        if self.redirect_stderr:
+            sys.stderr.flush()
+            os.dup2(self._file.fileno(), 2)
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = "{p}.{i}".format(p=self.path, i=index)
+            if os.path.exists(source):
+                os.replace(source, "{p}.{i}".format(p=self.path, i=index + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _run(self):
+        while True:
+            lines = [self.queue.get()]
+            while len(lines) < BATCH_SIZE:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in lines
+            lines = [line for line in lines if line is not None]
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append("{t} Log queue full, dropped {n} lines\n".format(t=TIMESTAMP.now(), n=dropped))
+            self._write("".join(lines))
+            if stop:
+                return
+
+    def _write(self, text):
+        try:
+            if self._file is None:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+                return
+            self._file.write(text)
+            self._file.flush()
+            self._size += len(text)
+            if self.max_bytes and self._size >= self.max_bytes:
+                self._rotate()
+        except (OSError, ValueError) as e:
+            _builtin_print("Log write exception: ", e, file=sys.__stderr__)
+
+
+class RateLimiter:
+    """
+    Lets `burst` messages per key through every `interval` seconds and counts the rest.
+    """
+
+    def __init__(self, burst=5, interval=10.0):
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """
+        (allowed, suppressed): whether to log the message now, and how many
+        messages of this key were suppressed since the last one logged.
+        """
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+                return True, suppressed
+            if window[1] < self.burst:
+                window[1] += 1
+                return True, 0
+            window[2] += 1
+            return False, 0
+
+
+class PipeHandler(logging.Handler):
+    """
+    Sends `logging` records (aiortc, aioice, ...) through the pipe.
+    """
+
+    def emit(self, record):
+        try:
+            write(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+TIMESTAMP = Timestamp()
+LIMITER = RateLimiter()
+_pipe = None
+_pipe_lock = threading.Lock()
+
+
+def pipe():
+    global _pipe
+    if _pipe is None:
+        with _pipe_lock:
+            if _pipe is None:
+                _pipe = LogPipe()
+                _pipe.start()
+    return _pipe
+
+
+def configure(path=None, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT, redirect_stderr=False):
+    """
+    Send the log to `path` from now on (stdout when None).
+    """
+    global _pipe
+    new = LogPipe(path, max_bytes=max_bytes, backup_count=backup_count, redirect_stderr=redirect_stderr)
+    new.start()
+    with _pipe_lock:
+        old, _pipe = _pipe, new
+    if old is not None:
+        old.close()
+    return new
+
+
+def write(message):
+    pipe().write("{t} {m}\n".format(t=TIMESTAMP.now(), m=message))
+
+
+def timestamped_print(*args, sep=' ', end='\n', file=None, flush=False):
+    if file is not None and file is not sys.stdout:
+        # explicit destinations are not part of the log
+        _builtin_print(*args, sep=sep, end=end, file=file, flush=flush)
+        return
+    pipe().write(TIMESTAMP.now() + " " + sep.join(str(arg) for arg in args) + end)
+
+
+def print_limited(key, *args, **fields):
+    """
+    Print like `timestamped_print` unless messages of `key` arrive in a burst,
+    then only a sample of them is printed with the number suppressed in between.
+    `fields` are appended as `name=value`.
+    """
+    allowed, suppressed = LIMITER.allow(key)
+    if not allowed:
+        return
+    if fields:
+        args += tuple("{k}={v}".format(k=k, v=v) for k, v in fields.items())
+    if suppressed:
+        args += ("(suppressed {n} similar messages)".format(n=suppressed),)
+    timestamped_print(*args)
+
+
+def log_handler(level=logging.NOTSET):
+    handler = PipeHandler(level)
+    handler.setFormatter(logging.Formatter("%(levelname)s %(name)s %(message)s"))
+    return handler
+
+
+@atexit.register
+def _flush():
+    if _pipe is not None:
+        _pipe.close()
+
+
+def _after_fork():
+    # the writer thread does not survive a fork, forked publishers start their own
+    global _pipe, _pipe_lock
+    _pipe = None
+    _pipe_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,90 @@
+"""
+Prometheus text exposition of the publisher counters.
+
+Every publisher reports the dictionary built by `WebRTCClient.get_stats`,
+`PUBLISHER_METRICS` maps its keys to metric families labelled by publisher
+and room. Rates (bitrate, demux errors per second, ...) are left to the
+scraper: counters are exported as `_total`.
+"""
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# (metric name, type, help, key in the publisher stats)
+PUBLISHER_METRICS = [
+    ("accrtsprtc_rtp_packets_sent_total", "counter", "RTP packets sent to Janus", "packetsSent"),
+    ("accrtsprtc_rtp_bytes_sent_total", "counter", "RTP payload bytes sent to Janus", "bytesSent"),
+    ("accrtsprtc_rtt_seconds", "gauge", "Round-trip time to Janus from RTCP receiver reports", "roundTripTime"),
+    ("accrtsprtc_fraction_lost", "gauge", "Fraction of packets lost reported by Janus (0-1)", "fractionLost"),
+    ("accrtsprtc_nacks_received_total", "counter", "RTCP NACK packets received and served", "nackCount"),
+    ("accrtsprtc_plis_received_total", "counter", "RTCP picture loss indications received", "pliCount"),
+    ("accrtsprtc_firs_received_total", "counter", "RTCP full intra requests received", "firCount"),
+    ("accrtsprtc_player_queue_depth", "gauge", "Packets waiting between the RTSP demuxer and the track",
+     "queueDepth"),
+    ("accrtsprtc_player_packets_total", "counter", "Packets demuxed from the RTSP stream", "packetsDemuxed"),
+    ("accrtsprtc_player_dropped_packets_total", "counter", "Packets dropped because the player queue was full",
+     "packetsDropped"),
+    ("accrtsprtc_demux_errors_total", "counter", "RTSP demux errors, reads that timed out excluded", "demuxErrors"),
+]
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def labels(**kwargs):
+    return "{" + ",".join('{k}="{v}"'.format(k=k, v=escape(v)) for k, v in kwargs.items()) + "}"
+
+
+def family(lines, name, type, help):
+    lines.append("# HELP {n} {h}".format(n=name, h=help))
+    lines.append("# TYPE {n} {t}".format(n=name, t=type))
+
+
+def render(clients, restarts, capacity=None, setup=None):
+    """
+    Exposition of `clients` (accrtsprtc `RTSPClient`s with their last `stats`),
+    of the `restarts` done by the supervisor, of the `capacity`, a pair of
+    admission `Cost`s (estimated load, budget), and of the `setup` phases
+    (timeline `PhaseHistograms`).
+    """
+    lines = []
+    if setup is not None:
+        family(lines, "accrtsprtc_setup_phase_seconds", "histogram",
+               "Seconds from the publisher launch to each setup phase")
+        for phase in setup.ordered():
+            counts, total, count = setup.phases[phase]
+            for bound, n in zip(setup.buckets, counts):
+                lines.append("accrtsprtc_setup_phase_seconds_bucket{l} {n}".format(
+                    l=labels(phase=phase, le=bound), n=n))
+            lines.append("accrtsprtc_setup_phase_seconds_bucket{l} {n}".format(
+                l=labels(phase=phase, le="+Inf"), n=count))
+            lines.append("accrtsprtc_setup_phase_seconds_sum{l} {v}".format(l=labels(phase=phase), v=round(total, 3)))
+            lines.append("accrtsprtc_setup_phase_seconds_count{l} {n}".format(l=labels(phase=phase), n=count))
+    if capacity is not None:
+        load, budget = capacity
+        for resource, used, limit, help in (("cpu_cores", load.cpu, budget.cpu, "CPU cores"),
+                                            ("bandwidth_bps", load.bps, budget.bps, "Upstream bits per second"),
+                                            ("sockets", load.sockets, budget.sockets, "Open sockets")):
+            family(lines, "accrtsprtc_capacity_" + resource, "gauge",
+                   help + " used by the publishers and their budget (0: no limit)")
+            lines.append("accrtsprtc_capacity_{r}{l} {v}".format(r=resource, l=labels(kind="used"), v=round(used, 3)))
+            lines.append("accrtsprtc_capacity_{r}{l} {v}".format(r=resource, l=labels(kind="budget"), v=limit))
+    family(lines, "accrtsprtc_publishers", "gauge", "Publishers running or being started, stopped ones excluded")
+    lines.append("accrtsprtc_publishers {n}".format(n=sum(1 for client in clients if client.state != "stopped")))
+    family(lines, "accrtsprtc_restarts_total", "counter", "Publisher restarts done by the supervisor")
+    lines.append("accrtsprtc_restarts_total {n}".format(n=restarts))
+
+    family(lines, "accrtsprtc_publisher_restarts_total", "counter", "Restarts of each publisher")
+    for client in clients:
+        lines.append("accrtsprtc_publisher_restarts_total{l} {n}".format(
+            l=labels(publisher=client.publisher, room=client.room), n=client.restarts))
+
+    for name, type, help, key in PUBLISHER_METRICS:
+        family(lines, name, type, help)
+        for client in clients:
+            value = client.stats.get(key)
+            if value is None:
+                continue
+            lines.append("{n}{l} {v}".format(n=name, l=labels(publisher=client.publisher, room=client.room),
+                                             v=value))
+    return "\n".join(lines) + "\n"
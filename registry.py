@@ -0,0 +1,142 @@
+"""
+Publishers that outlive the control server.
+
+With a state directory, publishers are started in their own session and talk
+to the control server over a unix socket in it instead of stdin/stdout. The
+running publishers are recorded in `registry.json` there: a control server
+started after a handoff reads it back and re-adopts every publisher that
+reconnects, instead of republishing all cameras.
+"""
+import json
+import os
+import subprocess
+import time
+
+REGISTRY_FILE = "registry.json"
+SOCKET_FILE = "control.sock"
+
+# Fields of an accrtsprtc `RTSPClient` needed to republish it
+CLIENT_FIELDS = ["room", "publisher", "rtsp", "display", "mic", "janus", "turn", "turn_user", "turn_passwd", "stun",
+                 "debug_log_level"]
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def start_time(pid):
+    """
+    When `pid` started, in clock ticks after boot, None when unknown (no /proc).
+    """
+    try:
+        with open("/proc/{p}/stat".format(p=pid)) as fp:
+            stat = fp.read()
+    except OSError:
+        return None
+    # the command name may contain spaces and parentheses, the fields start after its last ')'
+    return int(stat[stat.rindex(")") + 2:].split()[19])
+
+
+def is_publisher(pid, publisher, started=None):
+    """
+    Whether `pid` is still the `janus.py` process of `publisher` started at `started`
+    (see `start_time`), and not another process that got its pid after a reboot or
+    pid reuse. Without /proc only the pid can be checked.
+    """
+    if not pid_alive(pid):
+        return False
+    if not os.path.isdir("/proc/self"):
+        return True
+    try:
+        with open("/proc/{p}/cmdline".format(p=pid), "rb") as fp:
+            argv = fp.read().decode("utf-8", "replace").split("\0")
+    except OSError:
+        return False
+    if not any(arg.endswith("janus.py") for arg in argv):
+        return False
+    if not any(arg == "--id" and value == str(publisher) for arg, value in zip(argv, argv[1:])):
+        return False
+    return started is None or start_time(pid) == started
+
+
+class AdoptedProcess:
+    """
+    A publisher process started by a previous control server, with the part of
+    the `subprocess.Popen` interface used on publishers. It is not our child:
+    init reaps it, waiting only polls for its exit. It counts as exited as soon
+    as its pid no longer belongs to the publisher, and is never signalled then.
+    """
+
+    def __init__(self, pid, publisher, started=None):
+        self.pid = pid
+        self.publisher = publisher
+        self.started = started
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and not is_publisher(self.pid, self.publisher, self.started):
+            self.returncode = 0
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(str(self.pid), timeout)
+            time.sleep(0.05)
+        return self.returncode
+
+    def terminate(self):
+        self._signal(15)
+
+    def kill(self):
+        self._signal(9)
+
+    def _signal(self, signum):
+        if self.poll() is not None:
+            return
+        try:
+            os.kill(self.pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+class Registry:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, REGISTRY_FILE)
+        self.socket_path = os.path.join(directory, SOCKET_FILE)
+
+    def save(self, clients):
+        """
+        Record `clients` (accrtsprtc `RTSPClient`s), replacing the file atomically.
+        """
+        entries = []
+        for client in clients:
+            entry = {name: getattr(client, name) for name in CLIENT_FIELDS}
+            entry["pid"] = client.process.pid if client.process is not None else None
+            entry["started"] = start_time(entry["pid"]) if entry["pid"] is not None else None
+            entries.append(entry)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as fp:
+            json.dump({"saved": time.time(), "publishers": entries}, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temporary, self.path)
+
+    def load(self):
+        """
+        The entries recorded by the previous control server, an empty list when there are none.
+        """
+        try:
+            with open(self.path) as fp:
+                return json.load(fp).get("publishers", [])
+        except (OSError, ValueError):
+            return []
@@ -4,54 +4,164 @@ import threading
 import asyncio
 import errno
 import time
-import datetime
 
+import ingest
+from logpipe import print_limited, timestamped_print as print
 
-class StreamPlayer (threading.Thread):
-    def __init__(self, rtsp, loop=asyncio.get_event_loop()):
-        threading.Thread.__init__(self)
-        # flag to indicate that the thread should stop
+# Seconds the RTSP handshake may take, and a read may wait for a packet before it gives the reactor
+# thread back. An interrupted read flushes the parser, whose pending frame comes out without timestamps:
+# keep it above the frame interval of the slowest camera
+OPEN_TIMEOUT = 10
+READ_TIMEOUT = 0.25
+# Longest GOP cached for new connections, in packets and bytes; longer ones are not cached
+GOP_MAX_PACKETS = 300
+GOP_MAX_BYTES = 1024 * 1024
+ANNEXB_START_CODES = (b"\x00\x00\x01", b"\x00\x00\x00\x01")
+
+
+class StreamPlayer:
+    """
+    An RTSP stream, demuxed by the threads of the `ingest` reactor once started.
+    """
+
+    def __init__(self, rtsp, loop=asyncio.get_event_loop(), on_end=None):
+        # flag to indicate that the stream should stop
         self.isRunning = False
+        self.started = False
         self.rtsp = rtsp
-        self.packets = asyncio.Queue(30)
-        self.name = "StreamPlayer--" + rtsp
+        self.packets = ingest.PacketBuffer(loop)
+        # counters read by the publisher's stats
+        self.packets_demuxed = 0
+        self.packets_dropped = 0
+        self.demux_errors = 0
+        # demux generator, made again after a read that returned EAGAIN ended it
+        self._demux = None
+        # time.monotonic() of the first demuxed packet, and of the last one (or of the start)
+        self.first_packet_time = None
+        self.last_packet_time = None
+        # seconds spent reading or waiting for a turn without getting a packet (see `ingest`),
+        # and time.monotonic() the read in progress started
+        self.silent = 0.0
+        self.reading_since = None
         self.loop = loop
+        # called in `loop` with "stalled" or "ended" when the stream stops by itself
+        self.on_end = on_end
+        # packets from the last keyframe on, so that a new connection starts with a picture
+        self.gop = []
+        self.gop_bytes = 0
+        self._gop_lock = threading.Lock()
+        # bytes per second of the last complete GOP, None until one was demuxed,
+        # and the bytes and first dts (seconds) of the GOP in progress
+        self.bitrate = None
+        self._rate_bytes = 0
+        self._rate_start = None
 
+        # reads block until a packet arrives, the timeout bounds how long a silent camera holds a reactor thread
         options = {'rtsp_transport': 'tcp'}
-        self.container = av.open(rtsp, mode="r", metadata_encoding='utf-8', options=options)
+        self.container = av.open(rtsp, mode="r", metadata_encoding='utf-8', options=options,
+                                 timeout=(OPEN_TIMEOUT, READ_TIMEOUT))
+        self.video_stream = self.container.streams.video[0]
+        # SPS/PPS of the SDP, for cameras that do not repeat them before every IDR
+        extradata = self.video_stream.codec_context.extradata or b""
+        self.parameter_sets = extradata if extradata.startswith(ANNEXB_START_CODES) else b""
+
+    def start(self):
+        print("starting player")
+        self.isRunning = True
+        self.started = True
+        self.last_packet_time = time.monotonic()
+        ingest.reactor().add(self)
+
+    def is_alive(self):
+        return self.isRunning
 
-    def run(self):
+    def read(self):
         """
-        start the thread until a stop is requested.
-        :return:
+        Demux a packet and queue it for the track, returns False when there was none.
+        Called by a reactor thread, blocks until the next packet or at most `READ_TIMEOUT`.
         """
-        print("starting player thread")
-        self.isRunning = True
-        video_stream = self.container.streams.video[0]
-
-        while self.isRunning:
-            if not self.isRunning:
-                break
-            try:
-                packet = next(self.container.demux(video_stream))
-                # print(self.debug_desc + " Original Decoded Frame: ", frame)
-            except (av.AVError, BlockingIOError, StopIteration) as exc:
-                time_str = datetime.datetime.now(datetime.timezone(datetime.timedelta(0))).astimezone().isoformat(
-                    sep=' ',
-                    timespec='milliseconds')
-                print("{r} Video exception: {o}".format(r=time_str, o=exc))
-                if isinstance(exc, av.FFmpegError) and exc.errno == errno.EAGAIN:
-                    time.sleep(0.01)
-                    continue
+        if self._demux is None:
+            self._demux = self.container.demux(self.video_stream)
+        self.reading_since = time.monotonic()
+        try:
+            packet = next(self._demux)
+            # print(self.debug_desc + " Original Decoded Frame: ", frame)
+        except (av.AVError, BlockingIOError, StopIteration) as exc:
+            self._demux = None
+            if isinstance(exc, (BlockingIOError, av.error.ExitError)) or \
+                    (isinstance(exc, av.FFmpegError) and exc.errno == errno.EAGAIN):
+                # nothing within READ_TIMEOUT
+                self.silent += time.monotonic() - self.reading_since
+                return False
+            self.demux_errors += 1
+            # errors come in bursts, only a sample of each kind is logged
+            print_limited((self.rtsp, type(exc).__name__, getattr(exc, 'errno', None)),
+                          "Video exception:", exc, rtsp=self.rtsp)
+            self.end("ended")
+            return False
+        finally:
+            self.reading_since = None
+        now = time.monotonic()
+        if self.first_packet_time is None:
+            self.first_packet_time = now
+        self.last_packet_time = now
+        self.silent = 0.0
+        self.packets_demuxed += 1
+        self.cache(packet)
+        if not self.packets.put(packet):
+            self.packets_dropped += 1
+        return True
+
+    def end(self, reason):
+        """
+        Stop a stream that broke or stalled, and tell `on_end`.
+        """
+        if not self.isRunning:
+            return
+        self.isRunning = False
+        if self.on_end is not None:
+            self.loop.call_soon_threadsafe(self.on_end, reason)
+
+    def cache(self, packet):
+        if packet.dts is None:
+            return
+        if packet.is_keyframe:
+            dts = float(packet.dts * packet.time_base)
+            if self._rate_start is not None and dts > self._rate_start:
+                self.bitrate = self._rate_bytes / (dts - self._rate_start)
+            self._rate_bytes = 0
+            self._rate_start = dts
+        self._rate_bytes += packet.size
+        with self._gop_lock:
+            if packet.is_keyframe:
+                self.gop = [packet]
+                self.gop_bytes = packet.size
+            elif self.gop:
+                if len(self.gop) >= GOP_MAX_PACKETS or self.gop_bytes + packet.size > GOP_MAX_BYTES:
+                    # too long to burst, wait for the next keyframe
+                    self.gop = []
+                    self.gop_bytes = 0
                 else:
-                    break
-            if not self.packets.full():
-                asyncio.run_coroutine_threadsafe(self.packets.put(packet), self.loop)
+                    self.gop.append(packet)
+                    self.gop_bytes += packet.size
 
-        return
+    def cached_gop(self):
+        """
+        The packets of the current GOP demuxed so far, starting with its keyframe (empty when not cached).
+        """
+        with self._gop_lock:
+            return list(self.gop)
 
     def stop(self):
         if self.isRunning:
+            # the reactor closes the container at its next turn
             self.isRunning = False
+        elif not self.started:
             self.container.close()
         print("H264 Streaming Player was shutdown!")
+
+    def close(self):
+        try:
+            self.container.close()
+        except Exception as e:
+            print("Closing RTSP container exception: ", e)
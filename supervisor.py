@@ -0,0 +1,131 @@
+import asyncio
+import random
+import time
+
+from collections import deque
+
+from logpipe import timestamped_print as print
+
+
+class RestartPolicy:
+    """
+    Jittered exponential backoff with crash-loop detection.
+
+    The n-th restart within `window` seconds waits `base * factor ** (n - 1)`
+    seconds (capped by `max_delay`), randomised by +/- `jitter`. More than
+    `max_restarts` restarts within `window` is a crash loop. A publisher that
+    stayed up for `stable_after` seconds starts over with a clean history.
+    """
+
+    def __init__(self, base=1.0, factor=2.0, max_delay=60.0, jitter=0.5,
+                 window=600.0, max_restarts=10, stable_after=120.0):
+        self.base = base
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.window = window
+        self.max_restarts = max_restarts
+        self.stable_after = stable_after
+
+    def delay(self, attempt):
+        delay = min(self.max_delay, self.base * self.factor ** max(0, attempt - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class RestartHistory:
+    def __init__(self):
+        self.restarts = deque()
+        self.up_since = None
+        self.handle = None
+
+
+class Supervisor:
+    """
+    Schedules publisher restarts so that a Janus outage does not turn into a
+    restart storm: each publisher backs off on its own, and all restarts
+    together are spread to at most `max_rate` per second.
+
+    `restart` is a coroutine function called with the publisher id,
+    `give_up` is called with the publisher id and the reason once it crash loops.
+    """
+
+    def __init__(self, restart, give_up, policy=None, max_rate=5.0):
+        self.restart = restart
+        self.give_up = give_up
+        self.policy = policy or RestartPolicy()
+        self.max_rate = max_rate
+        self.histories = {}
+        self.restart_count = 0
+        self._next_slot = 0.0
+
+    def history(self, publisher):
+        if publisher not in self.histories:
+            self.histories[publisher] = RestartHistory()
+        return self.histories[publisher]
+
+    def up(self, publisher):
+        """
+        The publisher reported `webrtc: up`.
+        """
+        self.history(publisher).up_since = time.monotonic()
+
+    def schedule(self, publisher, reason):
+        """
+        Restart `publisher` after its backoff delay, returns False when it crash loops.
+        A restart already pending for the publisher absorbs this one.
+        """
+        history = self.history(publisher)
+        if history.handle is not None:
+            return True
+
+        now = time.monotonic()
+        if history.up_since is not None and now - history.up_since >= self.policy.stable_after:
+            history.restarts.clear()
+        history.up_since = None
+        while history.restarts and now - history.restarts[0] > self.policy.window:
+            history.restarts.popleft()
+
+        if len(history.restarts) >= self.policy.max_restarts:
+            print("Publisher ID: {p} crash loops ({n} restarts in {w:.0f}s), giving up after: {r}".format(
+                p=publisher, n=len(history.restarts), w=self.policy.window, r=reason))
+            self.forget(publisher)
+            self.give_up(publisher, reason)
+            return False
+
+        history.restarts.append(now)
+        delay = self.policy.delay(len(history.restarts))
+        # spread restarts of all publishers over time
+        if self.max_rate > 0:
+            slot = max(now + delay, self._next_slot)
+            self._next_slot = slot + 1.0 / self.max_rate
+            delay = slot - now
+
+        print("Publisher ID: {p} restarts in {d:.1f}s ({n}/{m}): {r}".format(
+            p=publisher, d=delay, n=len(history.restarts), m=self.policy.max_restarts, r=reason))
+        history.handle = asyncio.get_event_loop().call_later(delay, self._fire, publisher)
+        return True
+
+    def _fire(self, publisher):
+        history = self.histories.get(publisher)
+        if history is None:
+            return
+        history.handle = None
+        self.restart_count += 1
+        task = asyncio.get_event_loop().create_task(self.restart(publisher))
+        task.add_done_callback(lambda t: self._restarted(publisher, t))
+
+    def _restarted(self, publisher, task):
+        if task.cancelled() or task.exception() is None:
+            return
+        print("Publisher ID: {p} restart exception: ".format(p=publisher), task.exception())
+        if publisher in self.histories:
+            # back off and try again, like a crash right after the restart
+            self.schedule(publisher, "restart failed: {e}".format(e=task.exception()))
+
+    def forget(self, publisher):
+        """
+        The publisher was stopped, drop its pending restart and history.
+        """
+        history = self.histories.pop(publisher, None)
+        if history is not None and history.handle is not None:
+            history.handle.cancel()
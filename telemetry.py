@@ -0,0 +1,86 @@
+"""
+Live telemetry of all publishers as a Server-Sent Events stream.
+
+One collector task runs while there are subscribers: every `interval` it
+refreshes the stats of every publisher once, turns the counters into rates
+and pushes the same compact frame to every subscriber. A subscriber that
+does not keep up loses its oldest frames instead of slowing down the others.
+"""
+import asyncio
+import json
+import time
+
+# Frames buffered for a slow subscriber before the oldest ones are dropped
+SUBSCRIBER_QUEUE = 5
+
+
+class Telemetry:
+    def __init__(self, control, interval=1.0):
+        self.control = control
+        self.interval = interval
+        self.subscribers = set()
+        self._task = None
+        # publisher id -> (time, bytesSent, packetsDemuxed) of the previous frame
+        self._last = {}
+
+    def subscribe(self):
+        queue = asyncio.Queue(SUBSCRIBER_QUEUE)
+        self.subscribers.add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self.run())
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    async def run(self):
+        while self.subscribers:
+            begin = time.monotonic()
+            await self.control.collect_stats(timeout=self.interval * 0.8)
+            frame = json.dumps(self.frame(), separators=(",", ":"))
+            for queue in list(self.subscribers):
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(frame)
+            await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - begin)))
+        self._last.clear()
+
+    def frame(self):
+        now = time.monotonic()
+        publishers = {}
+        last = {}
+        for publisher, client in list(self.control.clients.items()):
+            stats = client.stats
+            counters = (now, stats.get("bytesSent", 0), stats.get("packetsDemuxed", 0))
+            kbps = fps = None
+            previous = self._last.get(publisher)
+            if previous is not None and now > previous[0]:
+                elapsed = now - previous[0]
+                kbps = round(max(0, counters[1] - previous[1]) * 8 / 1000 / elapsed, 1)
+                # one demuxed packet is one H.264 access unit
+                fps = round(max(0, counters[2] - previous[2]) / elapsed, 1)
+            last[publisher] = counters
+            publishers[publisher] = {
+                "room": client.room,
+                "state": client.state,
+                "kbps": kbps,
+                "fps": fps,
+                "queue": stats.get("queueDepth"),
+                "rtt": stats.get("roundTripTime"),
+                "loss": stats.get("fractionLost"),
+            }
+        self._last = last
+        return {"time": round(time.time(), 3), "publishers": publishers}
+
+    async def events(self, queue):
+        """
+        The Server-Sent Events of one subscriber.
+        """
+        try:
+            # let the browser reconnect quickly after a control server restart
+            yield "retry: 2000\n\n"
+            while True:
+                frame = await queue.get()
+                yield "event: telemetry\ndata: " + frame + "\n\n"
+        finally:
+            self.unsubscribe(queue)
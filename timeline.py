@@ -0,0 +1,89 @@
+"""
+Per-phase timeline of a publisher setup.
+
+Every phase is recorded once, as seconds since the setup started, so that
+overlapping phases (RTSP open, ICE gathering, Janus signaling) can be told
+apart from the ones that actually hold back the first frame. The control
+server shifts the timelines reported by publishers to its own launch time
+and aggregates the completed ones in `PhaseHistograms`.
+"""
+import time
+
+# Phases of a setup, in their usual order
+PHASES = ["launch", "process_start", "janus_session", "attached", "joined", "rtsp_opened", "first_packet",
+          "gathering_done", "offer_sent", "answer", "ice_connected", "dtls_connected", "first_rtp_sent",
+          "webrtc_up"]
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30, 60]
+
+
+class Timeline:
+    def __init__(self):
+        # wall clock time of the start, to line up with the control server
+        self.origin = time.time()
+        self.start = time.monotonic()
+        # phase -> seconds since `start`, in the order they happened
+        self.marks = {"process_start": 0.0}
+
+    def mark(self, phase, when=None):
+        """
+        Record `phase` now, or at `when` (a `time.monotonic()` time), unless it already was.
+        """
+        if phase not in self.marks:
+            when = time.monotonic() if when is None else when
+            self.marks[phase] = round(when - self.start, 3)
+
+    def summary(self):
+        marks = sorted(self.marks.items(), key=lambda mark: mark[1])
+        return " ".join("{p}=+{t:.3f}s".format(p=phase, t=elapsed) for phase, elapsed in marks)
+
+    def report(self):
+        return {"origin": self.origin, "marks": dict(self.marks)}
+
+
+def shift(report, launched):
+    """
+    The marks of a publisher `report` as seconds since `launched`, the control server's launch time.
+    """
+    offset = report["origin"] - launched if launched else 0.0
+    marks = {"launch": 0.0} if launched else {}
+    for phase, elapsed in report["marks"].items():
+        marks[phase] = round(elapsed + offset, 3)
+    return marks
+
+
+class PhaseHistograms:
+    """
+    Cumulative histograms of the time each phase was reached at, over completed setups.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # phase -> [count per bucket (cumulative), sum, count]
+        self.phases = {}
+
+    def observe(self, marks):
+        for phase, elapsed in marks.items():
+            if phase == "launch":
+                continue
+            histogram = self.phases.setdefault(phase, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += elapsed
+            histogram[2] += 1
+
+    def ordered(self):
+        known = [phase for phase in PHASES if phase in self.phases]
+        return known + sorted(phase for phase in self.phases if phase not in PHASES)
+
+    def as_dict(self):
+        histograms = {}
+        for phase in self.ordered():
+            counts, total, count = self.phases[phase]
+            histograms[phase] = {
+                "count": count,
+                "sum": round(total, 3),
+                "buckets": {str(bound): n for bound, n in zip(self.buckets, counts)},
+            }
+        return histograms
@@ -0,0 +1,258 @@
+import bisect
+import hashlib
+import multiprocessing
+import threading
+import types
+
+from engine import PublisherEngine
+from logpipe import timestamped_print as print
+
+# Fields of an accrtsprtc `RTSPClient` a worker needs to start publishing.
+CLIENT_FIELDS = ["room", "publisher", "rtsp", "display", "mic", "janus", "turn", "turn_user", "turn_passwd", "stun",
+                 "generation"]
+# Workers start from a fresh interpreter rather than a fork of the control server, whose
+# threads (event loop, log writer, worker readers) may hold locks at the time of the fork
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+class HashRing:
+    """
+    Consistent hash ring, placing every key on one of `nodes`.
+
+    Each node owns `replicas` virtual points so keys spread evenly, and
+    adding or removing a node only moves the keys next to its points.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        self.replicas = replicas
+        self._points = []
+        self._nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(str(key).encode("utf-8")).hexdigest()[:16], 16)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = self._hash("{n}#{i}".format(n=node, i=i))
+            bisect.insort(self._points, point)
+            self._nodes[point] = node
+
+    def remove(self, node):
+        for i in range(self.replicas):
+            point = self._hash("{n}#{i}".format(n=node, i=i))
+            self._points.remove(point)
+            self._nodes.pop(point, None)
+
+    def node_for(self, key):
+        if not self._points:
+            raise LookupError("Hash ring is empty")
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._nodes[self._points[index]]
+
+
+def worker_main(conn, share_sessions=True):
+    """
+    Entry point of a pool worker: host publishers in a `PublisherEngine` and
+    execute the commands received on `conn` until the pool closes it.
+    """
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            try:
+                conn.send(message)
+            except (OSError, EOFError) as e:
+                print("Send event to main process exception", e)
+
+    def on_event(type, data, publisher, generation):
+        send(("event", type, data, publisher, generation))
+
+    def on_stats(stats, publisher):
+        send(("stats", stats, publisher))
+
+    engine = PublisherEngine(on_event=on_event, on_stats=on_stats, share_sessions=share_sessions)
+    engine.start()
+    try:
+        while True:
+            command, arg = conn.recv()
+            if command == "start":
+                engine.launch(types.SimpleNamespace(**arg))
+            elif command == "restart":
+                engine.restart(types.SimpleNamespace(**arg))
+            elif command == "stop":
+                engine.kill(arg)
+            elif command == "stats":
+                engine.request_stats()
+            elif command == "shutdown":
+                break
+    except (EOFError, OSError, KeyboardInterrupt):
+        pass
+    finally:
+        engine.shutdown()
+        conn.close()
+
+
+class Worker:
+    def __init__(self, index, on_event, on_stats=None, share_sessions=True, on_exit=None, context=None):
+        self.index = index
+        self.on_event = on_event
+        self.on_stats = on_stats
+        # called with the worker when its process is gone
+        self.on_exit = on_exit
+        # publisher id -> generation, of the publishers started on the worker and not stopped
+        self.publishers = {}
+        context = context or multiprocessing.get_context(START_METHOD)
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_conn, share_sessions),
+                                       name="PublisherWorker-{i}".format(i=index), daemon=True)
+        self.send_lock = threading.Lock()
+        self.reader = threading.Thread(target=self.read_events, name="PublisherWorkerReader-{i}".format(i=index),
+                                       daemon=True)
+        self._child_conn = child_conn
+
+    def start(self):
+        self.process.start()
+        # the child owns its end now
+        self._child_conn.close()
+        self.reader.start()
+
+    def send(self, command, arg=None):
+        with self.send_lock:
+            self.conn.send((command, arg))
+
+    def read_events(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                print("Publisher worker", self.index, "exited")
+                if self.on_exit is not None:
+                    self.on_exit(self)
+                return
+            if message[0] == "event":
+                _, type, data, publisher, generation = message
+                try:
+                    self.on_event(type, data, publisher, generation)
+                except Exception as e:
+                    print("Handle worker event exception: ", e)
+            elif message[0] == "stats" and self.on_stats is not None:
+                _, stats, publisher = message
+                try:
+                    self.on_stats(stats, publisher)
+                except Exception as e:
+                    print("Handle worker stats exception: ", e)
+
+
+class WorkerPool:
+    """
+    Fixed pool of worker processes, each hosting many publishers.
+
+    The publisher id picks the owning worker through consistent hashing, so
+    start, stop and restart commands for a camera always reach the same process.
+    Exposes the same `launch`/`restart`/`kill`/`request_stats`/`shutdown` interface as `PublisherEngine`.
+    Dead workers are replaced from `loop`, the event loop thread, when given.
+    """
+
+    def __init__(self, size, on_event, on_stats=None, share_sessions=True, loop=None):
+        self.on_event = on_event
+        self.on_stats = on_stats
+        self.share_sessions = share_sessions
+        self.loop = loop
+        self.context = multiprocessing.get_context(START_METHOD)
+        self.workers = [self._worker(i) for i in range(size)]
+        self.ring = HashRing(range(size))
+        # replacing a dead worker and sending to a worker exclude each other
+        self.lock = threading.Lock()
+        self.closing = False
+
+    def _worker(self, index):
+        return Worker(index, self.on_event, self.on_stats, self.share_sessions, on_exit=self._worker_exited,
+                      context=self.context)
+
+    def _worker_exited(self, worker):
+        # called from the reader thread of the worker
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._replace, worker)
+                return
+            except RuntimeError:
+                # the loop is closed, we are shutting down
+                return
+        self._replace(worker)
+
+    def _replace(self, worker):
+        """
+        A worker process died: start another one in its place and report its
+        publishers as exited, the control server restarts them on the new one.
+        """
+        with self.lock:
+            if self.closing or self.workers[worker.index] is not worker:
+                return
+            replacement = self._worker(worker.index)
+            self.workers[worker.index] = replacement
+            replacement.start()
+            publishers = list(worker.publishers.items())
+        print("Restarted publisher worker", worker.index, "with", len(publishers), "publishers to restart")
+        worker.process.join(0)
+        for publisher, generation in publishers:
+            try:
+                self.on_event('exit', 'worker exited', publisher, generation)
+            except Exception as e:
+                print("Handle worker event exception: ", e)
+
+    def _send(self, publisher, command, arg):
+        with self.lock:
+            worker = self.worker_for(publisher)
+            if command == "stop":
+                worker.publishers.pop(publisher, None)
+            else:
+                worker.publishers[publisher] = arg["generation"]
+            try:
+                worker.send(command, arg)
+            except (OSError, EOFError) as e:
+                # the worker is dying, its reader reports the publishers once it is gone
+                print("Send to publisher worker {i} exception: ".format(i=worker.index), e)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        print("Started", len(self.workers), "publisher workers")
+
+    def worker_for(self, publisher):
+        return self.workers[self.ring.node_for(publisher)]
+
+    @staticmethod
+    def describe(client):
+        return {name: getattr(client, name) for name in CLIENT_FIELDS}
+
+    def launch(self, client):
+        self._send(client.publisher, "start", self.describe(client))
+
+    def restart(self, client):
+        self._send(client.publisher, "restart", self.describe(client))
+
+    def kill(self, publisher):
+        self._send(publisher, "stop", publisher)
+
+    def request_stats(self):
+        for worker in self.workers:
+            try:
+                worker.send("stats")
+            except (OSError, EOFError):
+                pass
+
+    def shutdown(self, timeout=10):
+        with self.lock:
+            self.closing = True
+        for worker in self.workers:
+            try:
+                worker.send("shutdown")
+            except (OSError, EOFError):
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
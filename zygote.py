@@ -0,0 +1,101 @@
+"""
+Preloaded template process for publishers.
+
+A forkserver imports av, aiortc, aioice, websockets, the opus cffi module and
+janus.py once and loads the DTLS certificate (see certstore.py). Every publisher is then forked
+from it instead of cold starting `python3 janus.py`: it skips the imports and
+the key generation, and shares the preloaded pages copy-on-write.
+"""
+import asyncio
+import importlib
+import multiprocessing
+import os
+import socket
+import sys
+
+from ipc import PipeChannel
+
+# Modules imported by the template process, the publisher code first so its imports come along
+PRELOAD = ["janus", "av", "aioice", "aiortc", "aiortc.codecs.opus", "websockets"]
+# Set while the forkserver starts so that only the template process warms up on import
+ZYGOTE_ENV = "ACCRTSPRTC_ZYGOTE"
+
+
+def warm_up():
+    # publishers forked from here must not warm up again
+    os.environ.pop(ZYGOTE_ENV, None)
+    for name in PRELOAD:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print("Zygote preload exception: ", e, file=sys.stderr)
+    try:
+        # forked publishers inherit it with its SSL context, the store rotates it when it gets old
+        import certstore
+        certstore.certificate()._get_ssl_context()
+    except ImportError as e:
+        print("Zygote certificate exception: ", e, file=sys.stderr)
+
+
+def publisher_main(sock, argv):
+    """
+    Entry point of a forked publisher: `argv` are `janus.py` arguments and `sock`
+    the IPC channel to the control server.
+    """
+    # native ffmpeg / OpenSSL output is discarded unless `--log_file` redirects it
+    log = open(os.devnull, 'w')
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    sys.stdout = sys.stderr = log
+
+    # the control server's default socket timeout came along, commands may be minutes apart
+    sock.settimeout(None)
+    channel = PipeChannel(sock.makefile('rb', buffering=0), sock.makefile('wb'))
+
+    import janus
+    janus.main(argv, channel=channel)
+
+
+class Zygote:
+    """
+    Forks publishers from the preloaded template process.
+    """
+
+    def __init__(self):
+        self.context = multiprocessing.get_context("forkserver")
+        self.context.set_forkserver_preload(["zygote"])
+
+    @staticmethod
+    def available():
+        return "forkserver" in multiprocessing.get_all_start_methods()
+
+    def start(self):
+        """
+        Start the template process now rather than on the first publisher.
+        """
+        from multiprocessing import forkserver
+        os.environ[ZYGOTE_ENV] = "1"
+        try:
+            forkserver.ensure_running()
+        finally:
+            os.environ.pop(ZYGOTE_ENV, None)
+
+    async def spawn(self, argv, name="Publisher"):
+        """
+        Fork a publisher running `janus.py argv`, returns the process and the
+        (reader, writer) asyncio streams of its IPC channel.
+        """
+        parent_sock, child_sock = socket.socketpair()
+        # daemonic: terminated together with the control server, like the subprocess publishers
+        process = self.context.Process(target=publisher_main, args=(child_sock, argv),
+                                       name=name, daemon=True)
+        try:
+            process.start()
+        finally:
+            child_sock.close()
+        reader, writer = await asyncio.open_connection(sock=parent_sock)
+        return process, reader, writer
+
+
+if os.environ.get(ZYGOTE_ENV) == "1":
+    warm_up()